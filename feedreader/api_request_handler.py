@@ -3,25 +3,41 @@ import base64
 import httplib
 import json
 import jsonschema
+import logging
 import tornado.web
 import pbkdf2
 
+from tornado import gen
+from tornado.concurrent import Future
+
 from feedreader import database
+from feedreader.async_database import AsyncDatabase, DatabaseTimeoutError
+from feedreader.executor import ExecutorSaturatedError
+
+logger = logging.getLogger(__name__)
 
 
 class APIRequestHandler(tornado.web.RequestHandler):
     """Base RequestHandler for use by API endpoints."""
 
     def initialize(self, create_session, tasks, celery_poller,
-                   enable_dummy_data=False):
+                   enable_dummy_data=False, credential_cache=None,
+                   session_tokens=None, hash_executor=None, db=None):
         self.create_session = create_session
+        # run queries on the IOLoop if no AsyncDatabase was provided
+        self.db = db or AsyncDatabase(create_session)
         self.tasks = tasks
         self.celery_poller = celery_poller
         self.enable_dummy_data = enable_dummy_data
+        self.credential_cache = credential_cache
+        self.session_tokens = session_tokens
+        self.hash_executor = hash_executor
 
         self.use_www_authenticate = True
+        # set once the user is authenticated
+        self.username = None
 
-    def require_auth(self, session):
+    def require_auth(self, session, allow_token=True):
         """Return the authorized user's username.
 
         If authorization fails, raise HTTPError. This doesn't attempt to
@@ -35,27 +51,158 @@ class APIRequestHandler(tornado.web.RequestHandler):
         general CSRF attacks. The user's browser will not automatically include
         our auth header in arbitrary requests to our API, even when the user is
         logged in due to our usage of xBasic.
+
+        If a credential_cache was provided, credentials it has recently seen
+        verified against the user's current password hash skip PBKDF2.
+
+        If allow_token is True and session_tokens were provided, a Bearer
+        token from POST /sessions/ is also accepted. Tokens are verified
+        without touching the database.
+
+        This verifies passwords on the IOLoop, see authenticate for a version
+        that doesn't block.
+        """
+        with self._auth_errors():
+            user, passwd = self._parse_auth_header(allow_token)
+            if passwd is not None:
+                passwd_hash = self._load_password_hash(session, user)
+                if not self._is_cached(user, passwd, passwd_hash):
+                    self._check_password(user, passwd, passwd_hash,
+                                         pbkdf2.crypt(passwd, passwd_hash))
+        self.username = user
+        return user
+
+    @gen.coroutine
+    def authenticate(self, allow_token=True):
+        """Coroutine version of require_auth.
+
+        The user is looked up with run_db and passwords are verified in the
+        hash_executor, so neither stalls other requests. Raises HTTPError 503
+        if either is saturated.
+        """
+        with self._auth_errors():
+            user, passwd = self._parse_auth_header(allow_token)
+            if passwd is not None:
+                passwd_hash = yield self._call_db(
+                    self.db.run_read_only, user, self._load_password_hash,
+                    user
+                )
+                if not self._is_cached(user, passwd, passwd_hash):
+                    crypted = yield self.crypt_password(passwd, passwd_hash)
+                    self._check_password(user, passwd, passwd_hash, crypted)
+        self.username = user
+        raise gen.Return(user)
+
+    @gen.coroutine
+    def run_db(self, fn, *args, **kwargs):
+        """Return fn(session, *args, **kwargs) run in its own session by db.
+
+        With a threaded AsyncDatabase, slow queries don't stall other
+        requests. fn may raise HTTPError. Raises HTTPError 503 if the
+        database executor is saturated or the call times out.
+
+        fn is run on the primary database, and the authenticated user's
+        reads go to the primary for a while afterwards so they see what
+        fn changed.
+        """
+        result = yield self._call_db(self.db.run, fn, *args, **kwargs)
+        if self.username is not None:
+            self.db.wrote(self.username)
+        raise gen.Return(result)
+
+    def read_db(self, fn, *args, **kwargs):
+        """Like run_db, but fn may be run on a read replica.
+
+        fn must not change anything.
+        """
+        return self._call_db(self.db.run_read_only, self.username, fn,
+                             *args, **kwargs)
+
+    @gen.coroutine
+    def _call_db(self, run, *args, **kwargs):
+        """Wait for run(*args, **kwargs), turning database errors into
+           HTTPErrors."""
+        try:
+            future = run(*args, **kwargs)
+        except ExecutorSaturatedError:
+            logger.warning("Database executor is saturated")
+            raise tornado.web.HTTPError(503, reason="Server is busy")
+        try:
+            result = yield future
+        except DatabaseTimeoutError as e:
+            logger.warning(str(e))
+            raise tornado.web.HTTPError(503, reason="Database timed out")
+        raise gen.Return(result)
+
+    def crypt_password(self, passwd, salt=None):
+        """Return a Future for the result of pbkdf2.crypt(passwd, salt).
+
+        Hashing is done in the hash_executor if one was provided. Raises
+        HTTPError 503 if the executor is saturated.
         """
+        if self.hash_executor is None:
+            future = Future()
+            future.set_result(pbkdf2.crypt(passwd, salt))
+            return future
+        try:
+            return self.hash_executor.submit(pbkdf2.crypt, passwd, salt)
+        except ExecutorSaturatedError:
+            logger.warning("Password hashing executor is saturated")
+            raise tornado.web.HTTPError(503, reason="Server is busy")
+
+    @contextmanager
+    def _auth_errors(self):
+        """Turn ValueErrors raised while authorizing into HTTPError 401."""
         try:
-            auth_header = self.request.headers.get("Authorization")
-            if auth_header is None:
-                raise ValueError("No Authorization header provided")
-            auth_type, auth_digest = auth_header.split(" ", 1)
-            user, passwd = base64.decodestring(auth_digest).split(":", 1)
-            if auth_type not in ["Basic", "xBasic"]:
-                raise ValueError("Authorization type is not Basic")
-            self.use_www_authenticate = auth_type == "Basic"
-            user_model = session.query(database.User).get(user)
-            if user_model is None:
-                raise ValueError("Invalid username or password")
-            passwd_hash = user_model.password_hash
-            if pbkdf2.crypt(passwd, passwd_hash) != passwd_hash:
-                raise ValueError("Invalid username or password")
+            yield
         except ValueError as e:
             msg = "Authorization failed: {}".format(e)
             raise tornado.web.HTTPError(401, msg)
-        else:
-            return user
+
+    def _parse_auth_header(self, allow_token):
+        """Return (username, password) from the Authorization header.
+
+        The password is None if the user was authorized by session token.
+        Raises ValueError.
+        """
+        auth_header = self.request.headers.get("Authorization")
+        if auth_header is None:
+            raise ValueError("No Authorization header provided")
+        auth_type, auth_digest = auth_header.split(" ", 1)
+        if auth_type == "Bearer" and allow_token and \
+                self.session_tokens is not None:
+            self.use_www_authenticate = False
+            return self.session_tokens.verify(auth_digest), None
+        if auth_type not in ["Basic", "xBasic"]:
+            raise ValueError("Authorization type is not Basic")
+        user, passwd = base64.decodestring(auth_digest).split(":", 1)
+        self.use_www_authenticate = auth_type == "Basic"
+        return user, passwd
+
+    @staticmethod
+    def _load_password_hash(session, user):
+        """Return the user's password hash, or None if they don't exist."""
+        user_model = session.query(database.User).get(user)
+        return None if user_model is None else user_model.password_hash
+
+    def _is_cached(self, user, passwd, passwd_hash):
+        """Return True if the password was recently verified.
+
+        Raises ValueError if the user does not exist.
+        """
+        if passwd_hash is None:
+            if self.credential_cache is not None:
+                self.credential_cache.invalidate(user)
+            raise ValueError("Invalid username or password")
+        return self.credential_cache is not None and \
+            self.credential_cache.is_verified(user, passwd, passwd_hash)
+
+    def _check_password(self, user, passwd, passwd_hash, crypted):
+        """Raise ValueError if crypted does not match passwd_hash."""
+        if crypted != passwd_hash:
+            raise ValueError("Invalid username or password")
+        if self.credential_cache is not None:
+            self.credential_cache.add(user, passwd, passwd_hash)
 
     def require_body_schema(self, schema):
         """Return json body of the request.
@@ -0,0 +1,183 @@
+"""Run database work from coroutines without blocking the IOLoop."""
+
+import logging
+import threading
+
+from sqlalchemy import exc
+from tornado.concurrent import TracebackFuture, dummy_executor
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseTimeoutError(Exception):
+    """A database call took longer than the timeout."""
+    pass
+
+
+class _Call(object):
+    """Decides once whether a call commits or times out."""
+
+    RUNNING, COMMITTING, TIMED_OUT = range(3)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = self.RUNNING
+
+    def start_commit(self):
+        """Return True if the call may commit, it can't time out after."""
+        with self._lock:
+            if self._state == self.RUNNING:
+                self._state = self.COMMITTING
+            return self._state == self.COMMITTING
+
+    def time_out(self):
+        """Return True if the call timed out, it can't commit after."""
+        with self._lock:
+            if self._state == self.RUNNING:
+                self._state = self.TIMED_OUT
+            return self._state == self.TIMED_OUT
+
+
+class AsyncDatabase(object):
+    """Runs functions that use a database session in a thread pool.
+
+    executor is usually a BoundedExecutor. If it is None, functions are run
+    immediately on the calling thread, which is useful in tests.
+
+    If timeout is given, calls that don't finish in time fail with
+    DatabaseTimeoutError. The database can't be interrupted, so the call
+    keeps running in its thread, but when it finishes its session is rolled
+    back rather than committed so a failed request doesn't change anything.
+    Calls that have started committing don't time out, their result is
+    waited for instead.
+
+    If a ReplicaRouter is given, run_read_only sends work to read replicas.
+    """
+
+    def __init__(self, create_session, executor=None, timeout=None,
+                 router=None):
+        self.create_session = create_session
+        self._executor = executor or dummy_executor
+        self._timeout = timeout
+        self._router = router
+        self._lock = threading.Lock()
+
+        self.timeouts = 0
+
+    def run(self, fn, *args, **kwargs):
+        """Return a Future for the result of fn(session, *args, **kwargs).
+
+        The session is committed if fn returns and rolled back if it raises.
+        It is closed before the Future completes, so fn should return plain
+        values rather than model instances.
+
+        Raises ExecutorSaturatedError if the executor's queue is full.
+        """
+        return self._submit(self._run_in_session, self.create_session,
+                            fn, args, kwargs)
+
+    def run_read_only(self, username, fn, *args, **kwargs):
+        """Like run, but fn may be run on a read replica.
+
+        fn must not change anything. It is run on the primary if there are
+        no replicas, none are working, or username wrote recently. If the
+        replica can't be reached, fn is run again on the primary.
+        """
+        if self._router is None:
+            return self.run(fn, *args, **kwargs)
+        return self._submit(self._run_on_replica, username, fn, args,
+                            kwargs)
+
+    def wrote(self, username):
+        """Record that username changed something, see ReplicaRouter."""
+        if self._router is not None:
+            self._router.wrote(username)
+
+    def stats(self):
+        """Return a dict of executor counters and timeouts."""
+        stats = {}
+        if hasattr(self._executor, "stats"):
+            stats.update(self._executor.stats())
+        if self._router is not None:
+            stats.update(self._router.stats())
+        with self._lock:
+            stats["timeouts"] = self.timeouts
+        return stats
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+    def _submit(self, run, *args):
+        call = _Call()
+        future = self._executor.submit(run, call, *args)
+        if self._timeout is None or future.done():
+            return future
+        return self._with_timeout(future, call)
+
+    def _run_on_replica(self, call, username, fn, args, kwargs):
+        choice = self._router.choose(username)
+        if choice is not None:
+            replica, create_session = choice
+            try:
+                return self._run_in_session(call, create_session, fn, args,
+                                            kwargs)
+            except (exc.DBAPIError, exc.TimeoutError) as e:
+                # only give up on the replica if it couldn't be reached
+                if not isinstance(e, (exc.OperationalError,
+                                      exc.TimeoutError)) and \
+                        not e.connection_invalidated:
+                    raise
+                logger.warning("Read replica {} failed: {}"
+                               .format(replica, e))
+                self._router.failed(replica)
+        return self._run_in_session(call, self.create_session, fn, args,
+                                    kwargs)
+
+    def _run_in_session(self, call, create_session, fn, args, kwargs):
+        session = create_session()
+        try:
+            result = fn(session, *args, **kwargs)
+            if call.start_commit():
+                session.commit()
+            else:
+                session.rollback()
+            return result
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _with_timeout(self, future, call):
+        """Return a Future that fails if future takes longer than timeout,
+           unless it has started committing."""
+        result = TracebackFuture()
+        io_loop = IOLoop.current()
+
+        def on_timeout():
+            # a call that is committing may have changed something, so its
+            # result has to be reported
+            if result.done() or not call.time_out():
+                return
+            with self._lock:
+                self.timeouts += 1
+            result.set_exception(DatabaseTimeoutError(
+                "Database call took longer than {}".format(self._timeout)
+            ))
+
+        def on_done(future):
+            io_loop.remove_timeout(handle)
+            if result.done():
+                return
+            if isinstance(future, TracebackFuture) and \
+                    future.exc_info() is not None:
+                result.set_exc_info(future.exc_info())
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        handle = io_loop.add_timeout(self._timeout, on_timeout)
+        io_loop.add_future(future, on_done)
+        return result
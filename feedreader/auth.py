@@ -0,0 +1,132 @@
+"""Helpers for authenticating API requests."""
+
+from collections import OrderedDict
+from datetime import timedelta
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+
+class CredentialCache(object):
+    """Bounded cache of recently verified username/password pairs.
+
+    Verifying a password with PBKDF2 is deliberately slow, so doing it on every
+    API request is expensive. This remembers credentials that have already
+    been verified for a short time.
+
+    Entries are keyed on an HMAC of the credentials using a random per-process
+    key, so raw passwords are never stored. Each entry also remembers the
+    password hash it was verified against, so changing a user's password
+    invalidates any cached credentials for that user.
+    """
+
+    def __init__(self, max_size=1024, ttl=timedelta(minutes=5),
+                 clock=time.time):
+        self._max_size = max_size
+        self._ttl = ttl.total_seconds()
+        self._clock = clock
+        self._key = os.urandom(32)
+        # digest -> (username, password_hash, expiry), oldest first
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_verified(self, username, passwd, password_hash):
+        """Return True if the credentials were verified against password_hash.
+
+        Expired entries, and entries verified against a different password
+        hash, are removed and count as a miss.
+        """
+        digest = self._digest(username, passwd)
+        entry = self._entries.get(digest)
+        if entry is not None:
+            cached_username, cached_hash, expiry = entry
+            if expiry <= self._clock() or cached_hash != password_hash:
+                del self._entries[digest]
+            elif cached_username == username:
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def add(self, username, passwd, password_hash):
+        """Remember that the credentials match password_hash."""
+        digest = self._digest(username, passwd)
+        self._entries.pop(digest, None)
+        self._entries[digest] = (username, password_hash,
+                                 self._clock() + self._ttl)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, username):
+        """Forget all cached credentials for username.
+
+        This should be called when a user is deleted or changes password.
+        """
+        for digest, entry in self._entries.items():
+            if entry[0] == username:
+                del self._entries[digest]
+
+    def stats(self):
+        """Return a dict of cache counters."""
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _digest(self, username, passwd):
+        credentials = "{}:{}".format(username, passwd)
+        return hmac.new(self._key, credentials, hashlib.sha256).digest()
+
+
+class SessionTokens(object):
+    """Creates and verifies signed, expiring session tokens.
+
+    A token is the username and expiry time signed with HMAC-SHA256, so it
+    can be verified without touching the database. Any API instance sharing
+    the same secret can verify tokens created by any other.
+    """
+
+    def __init__(self, secret, lifetime=timedelta(days=30), clock=time.time):
+        self._secret = secret
+        self._lifetime = int(lifetime.total_seconds())
+        self._clock = clock
+
+    def create(self, username):
+        """Return a (token, expiry) tuple for username.
+
+        expiry is a unix timestamp.
+        """
+        expiry = int(self._clock()) + self._lifetime
+        payload = "{}:{}".format(expiry, username)
+        return "{}.{}".format(base64.urlsafe_b64encode(payload),
+                              self._sign(payload)), expiry
+
+    def verify(self, token):
+        """Return the username the token was created for.
+
+        Raises ValueError if the token is malformed, forged or expired.
+        """
+        try:
+            encoded_payload, signature = token.split(".", 1)
+            payload = base64.urlsafe_b64decode(encoded_payload)
+            expiry, username = payload.split(":", 1)
+            expiry = int(expiry)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid token")
+        if not hmac.compare_digest(self._sign(payload), signature):
+            raise ValueError("Invalid token")
+        if expiry <= self._clock():
+            raise ValueError("Token expired")
+        return username
+
+    def _sign(self, payload):
+        digest = hmac.new(self._secret, payload, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest)
@@ -0,0 +1,57 @@
+"""Compressed storage for large text columns."""
+
+import zlib
+
+from sqlalchemy.types import LargeBinary, TypeDecorator
+
+# compressed values start with a marker so rows written before compression,
+# which are plain UTF-8, can still be read
+COMPRESSED_MARKER = b'\x00z'
+# shorter values aren't worth compressing
+MIN_COMPRESS_SIZE = 128
+ZLIB_LEVEL = 6
+
+
+def compress_text(text):
+    """Return text encoded for storage, compressed if that makes it smaller.
+
+    Returns None for None.
+    """
+    if text is None:
+        return None
+    data = text.encode('utf-8')
+    if len(data) < MIN_COMPRESS_SIZE and \
+            not data.startswith(COMPRESSED_MARKER):
+        return data
+    compressed = COMPRESSED_MARKER + zlib.compress(data, ZLIB_LEVEL)
+    if len(compressed) < len(data) or data.startswith(COMPRESSED_MARKER):
+        return compressed
+    return data
+
+
+def decompress_text(data):
+    """Return the text stored by compress_text, or plain UTF-8 data."""
+    if data is None:
+        return None
+    if is_compressed(data):
+        data = zlib.decompress(data[len(COMPRESSED_MARKER):])
+    return data.decode('utf-8')
+
+
+def is_compressed(data):
+    return data.startswith(COMPRESSED_MARKER)
+
+
+class CompressedText(TypeDecorator):
+    """Unicode text stored zlib compressed in a binary column.
+
+    Values that were stored as plain UTF-8 are read as they are.
+    """
+
+    impl = LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
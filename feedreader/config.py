@@ -2,6 +2,10 @@ from argparse import ArgumentParser
 
 import yaml
 
+POOL_OPTIONS = ('size', 'max_overflow', 'timeout', 'recycle', 'pre_ping')
+RETENTION_OPTIONS = ('max_entries', 'max_age_days', 'keep_unread_days',
+                     'archive', 'batch_size', 'period_minutes')
+
 
 class ConnectionConfig(object):
 
@@ -10,11 +14,32 @@ class ConnectionConfig(object):
         raw_config = yaml.load(open(filepath).read())
 
         return cls(raw_config.get('amqp', ''),
-                   raw_config.get('database', 'sqlite://'))
+                   raw_config.get('database', 'sqlite://'),
+                   raw_config.get('secret', ''),
+                   raw_config.get('pool'),
+                   raw_config.get('replicas'),
+                   raw_config.get('retention'))
 
-    def __init__(self, amqp, database):
+    def __init__(self, amqp, database, secret='', pool=None, replicas=None,
+                 retention=None):
         self.amqp_uri = amqp
         self.database_uri = database
+        # read replicas of database, for handlers that don't write
+        self.replica_uris = replicas or []
+        # key used to sign session tokens, shared by all API instances
+        self.secret = secret
+        # connection pool options, see database.initialize_db
+        self.pool = pool or {}
+        unknown = set(self.pool) - set(POOL_OPTIONS)
+        if unknown:
+            raise ValueError("Unknown pool options: {}"
+                             .format(", ".join(sorted(unknown))))
+        # which old entries to remove, see retention.RetentionPolicy
+        self.retention = retention or {}
+        unknown = set(self.retention) - set(RETENTION_OPTIONS)
+        if unknown:
+            raise ValueError("Unknown retention options: {}"
+                             .format(", ".join(sorted(unknown))))
 
 
 class FeederConfig(object):
@@ -32,14 +57,63 @@ class FeederConfig(object):
                             help='enable periodic feed updates')
         parser.add_argument('--number', type=int, default=0,
                             help='instance number')
+        parser.add_argument('--hash-threads', type=int, default=2,
+                            help='threads used for password hashing')
+        parser.add_argument('--hash-queue', type=int, default=32,
+                            help='password hashes that may wait for a thread '
+                                 'before requests are refused')
+        parser.add_argument('--db-threads', type=int, default=4,
+                            help='threads used for database queries, at '
+                                 'most the database pool size')
+        parser.add_argument('--db-queue', type=int, default=64,
+                            help='database queries that may wait for a '
+                                 'thread before requests are refused')
+        parser.add_argument('--db-timeout', type=float, default=10,
+                            help='seconds a request waits for a database '
+                                 'query before failing')
+        parser.add_argument('--update-batch', type=int, default=100,
+                            help='stale feeds claimed for updating at a '
+                                 'time')
+        parser.add_argument('--update-fetches', type=int, default=50,
+                            help='feed fetches for updates that may be in '
+                                 'progress at once')
+        parser.add_argument('--refresh-min', type=float, default=15,
+                            help='fewest minutes between updates of a feed')
+        parser.add_argument('--refresh-max', type=float, default=24 * 60,
+                            help='most minutes between updates of a feed')
+        parser.add_argument('--credential-cache', type=int, default=10000,
+                            help='verified credentials remembered so '
+                                 'requests can skip hashing')
+        parser.add_argument('--credential-ttl', type=float, default=300,
+                            help='seconds verified credentials are '
+                                 'remembered')
 
         args = parser.parse_args()
         return cls(args.config, args.dummy, args.port, args.updates,
-                   args.number)
+                   args.number, args.hash_threads, args.hash_queue,
+                   args.db_threads, args.db_queue, args.db_timeout,
+                   args.update_batch, args.update_fetches,
+                   args.credential_cache, args.credential_ttl,
+                   args.refresh_min, args.refresh_max)
 
-    def __init__(self, conn_filepath, dummy,  port, updates, number):
+    def __init__(self, conn_filepath, dummy,  port, updates, number,
+                 hash_threads=2, hash_queue=32, db_threads=4, db_queue=64,
+                 db_timeout=10, update_batch=100, update_fetches=50,
+                 credential_cache=10000, credential_ttl=300,
+                 refresh_min=15, refresh_max=24 * 60):
         self.conn_filepath = conn_filepath
         self.dummy_data = dummy
         self.port = port
         self.periodic_updates = updates
         self.instance_number = number
+        self.hash_threads = hash_threads
+        self.hash_queue = hash_queue
+        self.db_threads = db_threads
+        self.db_queue = db_queue
+        self.db_timeout = db_timeout
+        self.update_batch = update_batch
+        self.update_fetches = update_fetches
+        self.credential_cache = credential_cache
+        self.credential_ttl = credential_ttl
+        self.refresh_min = refresh_min
+        self.refresh_max = refresh_max
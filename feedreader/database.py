@@ -1,10 +1,21 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import (create_engine, Column, ForeignKey, Integer, Table,
-                        Sequence, String, Text, UniqueConstraint)
+from sqlalchemy.orm import (joinedload, object_session, relationship,
+                            sessionmaker)
+from sqlalchemy import (and_, create_engine, exists, func, literal, or_,
+                        select, Column, ForeignKey, Index, Integer, Table,
+                        Sequence, String, UniqueConstraint)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+import hashlib
 import yaml
 import logging
 
+from feedreader import migrations
+from feedreader.compression import CompressedText
+from feedreader.fingerprint import fingerprint, Fingerprint
+from feedreader.pool import MeteredQueuePool, ping_on_checkout
+from feedreader.schedule import DEFAULT_INTERVAL
+
 logger = logging.getLogger(__name__)
 
 BASE = declarative_base()
@@ -13,30 +24,139 @@ SMALL_STR = 100
 MEDIUM_STR = 2048
 
 
-def initialize_db(database_uri='sqlite://'):
+def initialize_db(database_uri='sqlite://', pool=None):
     """Initialize the DB and return SQLAlchemy Session class.
 
+    pool is a dict of connection pool options, see create_db_engine.
+
     This should only be called once when the server starts.
     """
-    engine = create_engine(database_uri, echo=False)
+    engine = create_db_engine(database_uri, pool)
 
-    # create tables and prepare to make sessions
-    BASE.metadata.create_all(engine)
+    # create or upgrade tables and prepare to make sessions
+    migrations.upgrade(engine, BASE.metadata)
     return sessionmaker(bind=engine)
 
 
+def connect_db(database_uri, pool=None):
+    """Return SQLAlchemy Session class for a DB the server has initialized.
+
+    Nothing is created or upgraded, so this is for other processes, like
+    Celery workers.
+    """
+    return sessionmaker(bind=create_db_engine(database_uri, pool))
+
+
+def connect_replica(database_uri, pool=None):
+    """Return SQLAlchemy Session class for a read replica of the DB.
+
+    Replicas get their schema from the primary, so nothing is created or
+    upgraded.
+    """
+    return connect_db(database_uri, pool)
+
+
+def create_db_engine(database_uri, pool=None):
+    """Return an engine with the given connection pool options.
+
+    pool is a dict of connection pool options:
+    size: connections kept open (default 5)
+    max_overflow: extra connections opened under load (default 10)
+    timeout: seconds to wait for a connection before failing (default 30)
+    recycle: seconds after which connections are reopened (default never)
+    pre_ping: test connections when they are checked out (default False)
+
+    Databases that don't use a QueuePool, like SQLite, ignore size,
+    max_overflow and timeout. In-memory SQLite databases use one connection
+    for all threads.
+    """
+    pool = pool or {}
+    url = make_url(database_uri)
+    options = dict(pool_recycle=pool.get('recycle', -1))
+    if url.drivername.startswith('sqlite') and \
+            url.database in (None, '', ':memory:'):
+        # every connection to an in-memory database gets a new, empty one,
+        # so share a single connection between threads
+        options.update(poolclass=StaticPool,
+                       connect_args={'check_same_thread': False})
+    elif issubclass(url.get_dialect().get_pool_class(url), QueuePool):
+        options.update(poolclass=MeteredQueuePool,
+                       pool_size=pool.get('size', 5),
+                       max_overflow=pool.get('max_overflow', 10),
+                       pool_timeout=pool.get('timeout', 30))
+    engine = create_engine(url, echo=False, **options)
+    if pool.get('pre_ping', False):
+        ping_on_checkout(engine)
+    return engine
+
+
+# Schema changes to existing tables also need a migration in migrations.py
+
 subscriptions_table = Table('subscriptions', BASE.metadata,
                             Column('username', String(SMALL_STR),
                                    ForeignKey('users.username',
-                                              ondelete='CASCADE')),
+                                              ondelete='CASCADE'),
+                                   primary_key=True),
                             Column('feed_id', Integer,
                                    ForeignKey('feeds.id',
-                                              ondelete='CASCADE')))
+                                              ondelete='CASCADE'),
+                                   primary_key=True))
+Index('ix_subscriptions_feed_id', subscriptions_table.c.feed_id)
 read_table = Table('read', BASE.metadata,
                    Column('username', String(SMALL_STR),
-                          ForeignKey('users.username', ondelete='CASCADE')),
+                          ForeignKey('users.username', ondelete='CASCADE'),
+                          primary_key=True),
                    Column('entry_id', Integer,
-                          ForeignKey('entries.id', ondelete='CASCADE')))
+                          ForeignKey('entries.id', ondelete='CASCADE'),
+                          primary_key=True))
+Index('ix_read_entry_id', read_table.c.entry_id)
+# number of unread entries each user has in each subscribed feed, kept up to
+# date as entries are added and read so it never needs to be counted
+unread_counts_table = Table('unread_counts', BASE.metadata,
+                            Column('username', String(SMALL_STR),
+                                   ForeignKey('users.username',
+                                              ondelete='CASCADE'),
+                                   primary_key=True),
+                            Column('feed_id', Integer,
+                                   ForeignKey('feeds.id',
+                                              ondelete='CASCADE'),
+                                   primary_key=True),
+                            Column('unreads', Integer, nullable=False,
+                                   default=0))
+Index('ix_unread_counts_feed_id', unread_counts_table.c.feed_id)
+# entries removed by the retention policy, kept without read state if
+# archiving is enabled, see retention.py
+archived_entries_table = Table('archived_entries', BASE.metadata,
+                               Column('id', Integer, primary_key=True,
+                                      autoincrement=False, nullable=False),
+                               Column('feed_id', Integer,
+                                      ForeignKey('feeds.id',
+                                                 ondelete='CASCADE'),
+                                      nullable=False),
+                               Column('url', String(MEDIUM_STR)),
+                               Column('title', String(MEDIUM_STR)),
+                               Column('author', String(SMALL_STR)),
+                               Column('date', Integer, nullable=False),
+                               Column('guid', Fingerprint, nullable=False),
+                               Column('content', CompressedText),
+                               Column('archived_date', Integer,
+                                      nullable=False))
+Index('ix_archived_entries_feed_id_date', archived_entries_table.c.feed_id,
+      archived_entries_table.c.date)
+# guids of entries removed by the retention policy, so feed updates don't add
+# them again, see retention.py
+pruned_guids_table = Table('pruned_guids', BASE.metadata,
+                           Column('feed_id', Integer,
+                                  ForeignKey('feeds.id', ondelete='CASCADE'),
+                                  primary_key=True),
+                           Column('guid', Fingerprint, primary_key=True),
+                           Column('date', Integer, nullable=False))
+# image found for each site, or None if there wasn't one, see image_cache.py
+host_images_table = Table('host_images', BASE.metadata,
+                          Column('site', String(191), primary_key=True),
+                          Column('image_url', String(MEDIUM_STR),
+                                 nullable=True),
+                          Column('checked_date', Integer, nullable=False))
 
 
 class User(BASE):
@@ -61,15 +181,35 @@ class User(BASE):
 
     def has_subscription(self, feed):
         """Check if the user is subscribed to this feed."""
-        return feed in self.subscriptions
+        session = object_session(self)
+        query = session.query(subscriptions_table)\
+            .filter(subscriptions_table.c.username == self.username)\
+            .filter(subscriptions_table.c.feed_id == feed.id)
+        return session.query(query.exists()).scalar()
 
     def subscribe(self, feed):
         """Subscribe the user to a feed."""
         self.subscriptions.append(feed)
+        session = object_session(self)
+        session.flush()
+        unreads = select([func.count(Entry.id)])\
+            .where(Entry.feed_id == feed.id)\
+            .where(~_read_by(self.username))
+        session.execute(unread_counts_table.insert().values(
+            username=self.username, feed_id=feed.id,
+            unreads=unreads.as_scalar(),
+        ))
 
     def unsubscribe(self, feed):
         """Unsubscribe the user from a feed."""
         self.subscriptions.remove(feed)
+        object_session(self).execute(
+            unread_counts_table.delete()
+                               .where(unread_counts_table.c.username ==
+                                      self.username)
+                               .where(unread_counts_table.c.feed_id ==
+                                      feed.id)
+        )
 
     # Entry related stuff
 
@@ -79,26 +219,147 @@ class User(BASE):
 
     def read(self, entry):
         """Mark the entry as read."""
-        self.read_entries.append(entry)
+        object_session(self).flush()
+        self.read_all([entry.id])
 
     def unread(self, entry):
         """Mark the entry as unread."""
-        self.read_entries.remove(entry)
+        object_session(self).flush()
+        self.unread_all([entry.id])
+
+    def read_all(self, ids):
+        """Mark entries, by their ids, as read.
+
+        Entries that are already read are skipped. The read table is changed
+        with a single INSERT ... SELECT no matter how many ids are given.
+        """
+        self._read_where(Entry.id.in_(ids))
+
+    def unread_all(self, ids):
+        """Mark entries, by their ids, as unread.
+
+        The read table is changed with a single DELETE no matter how many ids
+        are given.
+        """
+        self._unread_where(Entry.id.in_(ids))
+
+    def read_feed(self, feed, until=None):
+        """Mark all entries in a feed as read with a single statement.
+
+        If until is given, only entries dated at or before that unix time are
+        marked as read.
+        """
+        self._read_where(self._feed_entries_until(feed, until))
+
+    def unread_feed(self, feed, until=None):
+        """Mark all entries in a feed as unread with a single statement.
+
+        If until is given, only entries dated at or before that unix time are
+        marked as unread.
+        """
+        self._unread_where(self._feed_entries_until(feed, until))
 
     def get_entries(self, ids):
         """Retrieve all entries, by their ids, from feeds that the user is
-           subscribed to."""
-        entries = []
-        for feed in self.subscriptions:
-            for entry in feed.entries.filter(Entry.id.in_(ids)).all():
-                entries.append(entry)
-        return entries
+           subscribed to. The entries are in the same order as ids.
+
+        Their content is loaded in the same query."""
+        query = object_session(self).query(Entry)\
+            .options(joinedload(Entry._content))
+        entries = self._subscribed_entries(query, ids).all()
+        positions = dict((entry_id, i) for i, entry_id in enumerate(ids))
+        return sorted(entries, key=lambda entry: positions[entry.id])
+
+    def get_entry_ids(self, ids):
+        """Return the set of ids, out of the given ids, of entries from feeds
+           that the user is subscribed to."""
+        query = object_session(self).query(Entry.id)
+        return set(entry_id for entry_id, in
+                   self._subscribed_entries(query, ids))
+
+    def get_read_entry_ids(self, ids):
+        """Return the set of ids, out of the given ids, that the user has
+           marked as read."""
+        rows = object_session(self).query(read_table.c.entry_id)\
+            .filter(read_table.c.username == self.username)\
+            .filter(read_table.c.entry_id.in_(ids))
+        return set(entry_id for entry_id, in rows)
+
+    def _subscribed_entries(self, query, ids):
+        """Restrict an Entry query to the given ids in subscribed feeds."""
+        return query.join(subscriptions_table,
+                          subscriptions_table.c.feed_id == Entry.feed_id)\
+            .filter(subscriptions_table.c.username == self.username)\
+            .filter(Entry.id.in_(ids))
+
+    def _read_where(self, criterion):
+        """Mark entries matching criterion as read, skipping read ones."""
+        session = object_session(self)
+        criterion = and_(criterion, ~_read_by(self.username))
+        changed = self._count_by_feed(criterion)
+        if not changed:
+            return
+
+        entries = select([literal(self.username), Entry.id]).where(criterion)
+        session.execute(
+            read_table.insert().from_select(['username', 'entry_id'], entries)
+        )
+        for feed_id, count in changed:
+            add_unreads(session, feed_id, -count, self.username)
+
+    def _unread_where(self, criterion):
+        """Mark entries matching criterion as unread, skipping unread ones."""
+        session = object_session(self)
+        criterion = and_(criterion, _read_by(self.username))
+        changed = self._count_by_feed(criterion)
+        if not changed:
+            return
+
+        entry_ids = select([Entry.id]).where(criterion)
+        session.execute(
+            read_table.delete()
+                      .where(read_table.c.username == self.username)
+                      .where(read_table.c.entry_id.in_(entry_ids))
+        )
+        for feed_id, count in changed:
+            add_unreads(session, feed_id, count, self.username)
 
-    def get_num_unread_entries(self, feed):
-        """Count the total number of entries the user has in a feed."""
-        total = feed.entries.count()
-        read = self.read_entries.filter_by(feed_id=feed.id).count()
-        return total - read
+    def _count_by_feed(self, criterion):
+        """Return (feed_id, count) of entries matching criterion."""
+        return object_session(self)\
+            .query(Entry.feed_id, func.count(Entry.id))\
+            .filter(criterion)\
+            .group_by(Entry.feed_id)\
+            .all()
+
+    @staticmethod
+    def _feed_entries_until(feed, until):
+        """Return criterion for a feed's entries dated at or before until."""
+        criterion = Entry.feed_id == feed.id
+        if until is not None:
+            criterion = and_(criterion, Entry.date <= until)
+        return criterion
+
+    def get_subscriptions_with_unreads(self, feed_id=None):
+        """Return (feed, unread count) pairs for the user's subscriptions.
+
+        Feeds are ordered by title. Unread counts come from the unread_counts
+        table, so this is one query no matter how many feeds the user is
+        subscribed to or how many entries they have. If feed_id is given,
+        only that feed is returned (if the user is subscribed to it).
+        """
+        unreads = func.coalesce(unread_counts_table.c.unreads, 0)
+        is_user_count = and_(unread_counts_table.c.feed_id == Feed.id,
+                             unread_counts_table.c.username == self.username)
+        query = object_session(self).query(Feed, unreads)\
+            .join(subscriptions_table,
+                  subscriptions_table.c.feed_id == Feed.id)\
+            .outerjoin(unread_counts_table, is_user_count)\
+            .filter(subscriptions_table.c.username == self.username)
+        if feed_id is not None:
+            query = query.filter(Feed.id == feed_id)
+        rows = query.order_by(Feed.title).all()
+        return [(feed, int(unread)) for feed, unread in rows]
 
 
 class Feed(BASE):
@@ -114,23 +375,54 @@ class Feed(BASE):
     # url of image associated with feed (None if no image)
     image_url = Column(String(MEDIUM_STR), nullable=True)
     # date of last attempted refresh
-    last_refresh_date = Column(Integer, nullable=True)
+    last_refresh_date = Column(Integer, nullable=True, index=True)
+    # seconds between refreshes, None until the updater has picked one
+    refresh_interval = Column(Integer, nullable=True)
+    # date the feed should be refreshed next
+    next_refresh_date = Column(Integer, nullable=True, index=True)
     # last-modifed date used for caching (string since we don't parse it)
     last_modified = Column(String(SMALL_STR), nullable=True)
     # etag used for caching
     etag = Column(String(MEDIUM_STR), nullable=True)
+    # SHA-1 of the last feed downloaded, for servers that don't send an
+    # etag or last-modified date
+    body_digest = Column(String(40), nullable=True)
 
     entries = relationship('Entry', backref='feed', lazy='dynamic',
                            order_by='desc(Entry.date)')
 
     @staticmethod
-    def find_last_updated_before(session, unix_date):
-        """Return all feeds with last_modified earlier than unix_date."""
-        return session.query(Feed).filter(Feed.last_refresh_date < unix_date)\
-                                  .all()
+    def claim_stale(session, now, limit):
+        """Return up to limit feeds due to be refreshed at now, most overdue
+           first, and mark them as refreshed.
+
+        The feeds are locked until the session commits, so other updaters
+        claim different feeds. The returned feeds are marked in one UPDATE,
+        so their attributes are the old ones until the session is
+        committed. Until the updater reschedules them, they are due again
+        after their current interval.
+        """
+        feeds = session.query(Feed)\
+            .filter(Feed.next_refresh_date <= now)\
+            .order_by(Feed.next_refresh_date, Feed.id)\
+            .limit(limit)\
+            .with_lockmode('update')\
+            .all()
+        if feeds:
+            interval = func.coalesce(Feed.refresh_interval,
+                                     int(DEFAULT_INTERVAL.total_seconds()))
+            session.execute(
+                Feed.__table__.update()
+                    .where(Feed.id.in_([feed.id for feed in feeds]))
+                    .values(last_refresh_date=now,
+                            next_refresh_date=now + interval)
+            )
+        return feeds
 
     def __init__(self, title, feed_url, site_url, last_modified=None,
-                 etag=None, last_refresh_date=None, image_url=None, id=None):
+                 etag=None, last_refresh_date=None, image_url=None, id=None,
+                 refresh_interval=None, next_refresh_date=None,
+                 body_digest=None):
         self.id = id
         self.title = column_size(title, MEDIUM_STR)
         self.feed_url = column_size(feed_url, 191)
@@ -138,7 +430,13 @@ class Feed(BASE):
         self.image_url = column_size(image_url, MEDIUM_STR)
         self.last_modified = column_size(last_modified, SMALL_STR)
         self.etag = column_size(etag, MEDIUM_STR)
+        self.body_digest = body_digest
         self.last_refresh_date = last_refresh_date
+        self.refresh_interval = refresh_interval
+        if next_refresh_date is None and last_refresh_date is not None:
+            next_refresh_date = last_refresh_date + \
+                int(DEFAULT_INTERVAL.total_seconds())
+        self.next_refresh_date = next_refresh_date
 
     def __repr__(self):
         return "<RSSFeed('{}')>".format(self.id)
@@ -147,38 +445,114 @@ class Feed(BASE):
 
     def add(self, entry):
         """Add an entry to the feed."""
-        self.entries.append(entry)
+        self.add_all([entry])
 
     def add_all(self, entries):
-        """Add all entries from an iterable to the feed."""
+        """Add all entries from an iterable to the feed.
+
+        The entries are counted as unread for all of the feed's subscribers.
+        """
+        entries = list(entries)
         for entry in entries:
-            self.add(entry)
+            entry.content_hash = entry.compute_hash()
+            self.entries.append(entry)
+        session = object_session(self)
+        # a feed that isn't in the database yet can't have any subscribers
+        if session is not None and self.id is not None:
+            session.flush()
+            add_unreads(session, self.id, len(entries))
 
     def get_entries(self, user, filter_=None):
         """Retrieve all entries for a user from the feed.
            The entries can optionally be filtered by read or unread."""
-        for entry in self.entries.all():
-            if filter_ == 'read' and not user.has_read(entry):
-                continue
-            elif filter_ == 'unread' and user.has_read(entry):
-                continue
-            yield entry
+        query = object_session(self).query(Entry)
+        return self._filter_entries(query, user, filter_).all()
+
+    def get_entry_ids(self, user, filter_=None):
+        """Retrieve the ids of all entries for a user from the feed.
+
+        This is the same as get_entries, but only the ids are loaded. Filtering
+        is done by the database in a single query.
+        """
+        query = object_session(self).query(Entry.id)
+        return [entry_id for entry_id, in
+                self._filter_entries(query, user, filter_)]
+
+    def get_entry_keys(self, user, filter_=None, limit=None, before=None,
+                       after=None):
+        """Return (date, id) keys of entries for a user from the feed, newest
+           first.
+
+        before and after are (date, id) keys. If before is given, only older
+        entries are returned, and if after is given, only newer entries.
+        With after and a limit, the entries just newer than after are
+        returned. Each page is a range scan of the (feed_id, date, id) index
+        no matter how many entries the feed has.
+        """
+        query = object_session(self).query(Entry.date, Entry.id)
+        query = self._filter_entries(query, user, filter_, newest_first=(
+            after is None
+        ))
+        if before is not None:
+            date, entry_id = before
+            query = query.filter(or_(
+                Entry.date < date,
+                and_(Entry.date == date, Entry.id < entry_id),
+            ))
+        if after is not None:
+            date, entry_id = after
+            query = query.filter(or_(
+                Entry.date > date,
+                and_(Entry.date == date, Entry.id > entry_id),
+            ))
+        if limit is not None:
+            query = query.limit(limit)
+        keys = [tuple(key) for key in query]
+        if after is not None:
+            keys.reverse()
+        return keys
+
+    def _filter_entries(self, query, user, filter_, newest_first=True):
+        """Restrict an Entry query to this feed, newest first, and filter it
+           by read or unread for the user. Entries are ordered newest first
+           unless newest_first is False."""
+        is_read = _read_by(user.username)
+        query = query.filter(Entry.feed_id == self.id)
+        if filter_ == 'read':
+            query = query.filter(is_read)
+        elif filter_ == 'unread':
+            query = query.filter(~is_read)
+        if newest_first:
+            return query.order_by(Entry.date.desc(), Entry.id.desc())
+        return query.order_by(Entry.date, Entry.id)
 
 
 class Entry(BASE):
     __tablename__ = 'entries'
-    __table_args__ = (UniqueConstraint('feed_id', 'guid', name='feed_guid'),)
+    __table_args__ = (UniqueConstraint('feed_id', 'guid', name='feed_guid'),
+                      Index('ix_entries_feed_id_date_id', 'feed_id', 'date',
+                            'id'))
 
     id = Column(Integer, Sequence('entry_id_seq'), primary_key=True,
                 nullable=False)
     feed_id = Column(Integer, ForeignKey('feeds.id', ondelete='CASCADE'),
                      nullable=False)
-    content = Column(Text, nullable=True)
     url = Column(String(MEDIUM_STR), nullable=True)
     title = Column(String(MEDIUM_STR), nullable=True)
     author = Column(String(SMALL_STR), nullable=True)
     date = Column(Integer, nullable=False)
-    guid = Column(String(SMALL_STR), nullable=False)
+    # only used to find duplicates, so it's kept as a fingerprint that makes
+    # the feed_guid index much smaller
+    guid = Column(Fingerprint, nullable=False)
+    # hash of everything but the guid, to tell whether an entry changed
+    content_hash = Column(String(40), nullable=True)
+
+    # content is the largest part of an entry by far, so it is kept in its
+    # own table and only loaded when it is used
+    _content = relationship('EntryContent', uselist=False,
+                            cascade='all, delete-orphan')
+    # not in __dict__, but needed to dump and load entries with yaml
+    yaml_properties = ('content',)
 
     def __init__(self, content, url, title, author, date, guid):
         self.content = content
@@ -186,11 +560,154 @@ class Entry(BASE):
         self.title = column_size(title, MEDIUM_STR)
         self.author = column_size(author, SMALL_STR)
         self.date = date
-        self.guid = column_size(guid, SMALL_STR)
+        self.guid = fingerprint(guid)
 
     def __repr__(self):
         return '<Entry({!r})>'.format(self.id)
 
+    def compute_hash(self):
+        """Return a hex digest of the entry's content, url, title, author
+           and date."""
+        fields = (self.content, self.url, self.title, self.author,
+                  self.date)
+        digest = hashlib.sha1()
+        for field in fields:
+            if field is not None:
+                if not isinstance(field, basestring):
+                    field = unicode(field)
+                if isinstance(field, unicode):
+                    field = field.encode('utf-8')
+                digest.update(field)
+            # separate fields so moving text between them changes the hash
+            digest.update(b'\x00' if field is not None else b'\x01')
+        return digest.hexdigest()
+
+    @property
+    def content(self):
+        return None if self._content is None else self._content.content
+
+    @content.setter
+    def content(self, content):
+        if self._content is None:
+            self._content = EntryContent(content)
+        else:
+            self._content.content = content
+
+
+class EntryContent(BASE):
+    __tablename__ = 'entry_contents'
+
+    entry_id = Column(Integer, ForeignKey('entries.id', ondelete='CASCADE'),
+                      primary_key=True, nullable=False)
+    # HTML compresses well, so this is stored compressed
+    content = Column(CompressedText, nullable=True)
+
+    def __init__(self, content, entry_id=None):
+        self.content = content
+        self.entry_id = entry_id
+
+
+def _read_by(username):
+    """Return criterion for entries that username has read."""
+    return exists().where(and_(read_table.c.entry_id == Entry.id,
+                               read_table.c.username == username))
+
+
+def add_unreads(session, feed_id, count, username=None):
+    """Add count to the unread counts of a feed's subscribers.
+
+    If username is given, only that user's count is changed.
+    """
+    query = unread_counts_table.update()\
+        .where(unread_counts_table.c.feed_id == feed_id)
+    if username is not None:
+        query = query.where(unread_counts_table.c.username == username)
+    session.execute(query.values(
+        unreads=unread_counts_table.c.unreads + count
+    ))
+
+
+def delete_entries(session, feed_id, entry_ids, archive_date=None):
+    """Delete entries of a feed along with their content and read state.
+
+    Unread counts are lowered for subscribers who hadn't read them. If
+    archive_date is given, the entries are first copied to archived_entries
+    as archived at that date. Their guids are added to pruned_guids, so they
+    aren't saved again while they are still in the feed.
+    """
+    if not entry_ids:
+        return
+    entries = Entry.__table__
+    contents = EntryContent.__table__
+
+    unreads = session.query(subscriptions_table.c.username,
+                            func.count(Entry.id))\
+        .filter(subscriptions_table.c.feed_id == feed_id)\
+        .filter(Entry.id.in_(entry_ids))\
+        .filter(~_read_by(subscriptions_table.c.username))\
+        .group_by(subscriptions_table.c.username)
+    for username, count in unreads.all():
+        add_unreads(session, feed_id, -count, username)
+
+    if archive_date is not None:
+        columns = ['id', 'feed_id', 'url', 'title', 'author', 'date', 'guid']
+        # content is copied as it is stored, without decompressing it
+        session.execute(archived_entries_table.insert().from_select(
+            columns + ['content', 'archived_date'],
+            select([entries.c[name] for name in columns] +
+                   [contents.c.content, literal(archive_date)])
+            .select_from(entries.outerjoin(
+                contents, contents.c.entry_id == entries.c.id
+            ))
+            .where(entries.c.id.in_(entry_ids))
+        ))
+
+    pruned = pruned_guids_table
+    session.execute(pruned.insert().from_select(
+        ['feed_id', 'guid', 'date'],
+        select([entries.c.feed_id, entries.c.guid, entries.c.date])
+        .where(entries.c.id.in_(entry_ids))
+        # entries saved again before guids were remembered
+        .where(~exists().where(and_(pruned.c.feed_id == entries.c.feed_id,
+                                    pruned.c.guid == entries.c.guid)))
+    ))
+
+    # SQLite doesn't enforce foreign keys, so don't rely on cascades
+    session.execute(read_table.delete()
+                    .where(read_table.c.entry_id.in_(entry_ids)))
+    session.execute(contents.delete()
+                    .where(contents.c.entry_id.in_(entry_ids)))
+    session.execute(entries.delete().where(entries.c.id.in_(entry_ids)))
+
+
+def rebuild_unread_counts(session):
+    """Recount unread entries for every subscription.
+
+    Returns the number of counts that were missing or wrong.
+    """
+    unreads = select([func.count(Entry.id)])\
+        .where(Entry.feed_id == subscriptions_table.c.feed_id)\
+        .where(~_read_by(subscriptions_table.c.username))\
+        .as_scalar()
+    actual = select([subscriptions_table.c.username,
+                     subscriptions_table.c.feed_id,
+                     unreads.label('unreads')]).alias()
+
+    # find out how far the counts drifted before replacing them
+    stored = unread_counts_table
+    drifted = session.query(actual)\
+        .outerjoin(stored, and_(stored.c.username == actual.c.username,
+                                stored.c.feed_id == actual.c.feed_id))\
+        .filter(or_(stored.c.unreads == None,
+                    stored.c.unreads != actual.c.unreads))\
+        .count()
+
+    session.execute(unread_counts_table.delete())
+    session.execute(unread_counts_table.insert().from_select(
+        ['username', 'feed_id', 'unreads'], actual.select()
+    ))
+    return drifted
+
 
 def column_size(string, size):
     if string is None:
@@ -216,9 +733,11 @@ def make_yaml_bindings():
 
         tag = '!{}'.format(name.lower())
 
-        def representer(dumper, obj, tag=tag):
+        def representer(dumper, obj, tag=tag, cls=cls):
             cols = dict((item[0], item[1]) for item in obj.__dict__.iteritems()
-                        if not item[0].startswith(u'_sa_'))
+                        if not item[0].startswith(u'_'))
+            for name in getattr(cls, 'yaml_properties', ()):
+                cols[name] = getattr(obj, name)
             return dumper.represent_mapping(tag, cols)
 
         def constructor(loader, node, cls=cls):
@@ -0,0 +1,58 @@
+"""Thread pool that refuses work instead of queueing it without bound."""
+
+from concurrent import futures
+import threading
+
+
+class ExecutorSaturatedError(Exception):
+    """Too many calls are already waiting for the executor."""
+    pass
+
+
+class BoundedExecutor(object):
+    """ThreadPoolExecutor with a limit on the number of queued calls.
+
+    Returned futures can be yielded from Tornado coroutines. Once max_workers
+    calls are running and max_queue more are waiting, submit raises
+    ExecutorSaturatedError so callers can shed load rather than pile up.
+    """
+
+    def __init__(self, max_workers, max_queue):
+        self._executor = futures.ThreadPoolExecutor(max_workers)
+        self._max_pending = max_workers + max_queue
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        self.submitted = 0
+        self.rejected = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) and return a Future for its result.
+
+        Raises ExecutorSaturatedError if the queue is full.
+        """
+        with self._lock:
+            if self._pending >= self._max_pending:
+                self.rejected += 1
+                raise ExecutorSaturatedError
+            self._pending += 1
+            self.submitted += 1
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._call_done)
+        return future
+
+    def stats(self):
+        """Return a dict of executor counters."""
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+    def _call_done(self, future):
+        with self._lock:
+            self._pending -= 1
@@ -0,0 +1,33 @@
+"""Compact fixed-width keys for long strings that are only compared."""
+
+import hashlib
+import struct
+
+from sqlalchemy.types import BigInteger, TypeDecorator
+
+
+def fingerprint(value):
+    """Return the first 64 bits of value's SHA-1 as a signed integer.
+
+    Integers are assumed to be fingerprints already and are returned as
+    they are, as is None.
+    """
+    if value is None or isinstance(value, (int, long)):
+        return value
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.unpack('>q', hashlib.sha1(value).digest()[:8])[0]
+
+
+class Fingerprint(TypeDecorator):
+    """Strings stored as a 64-bit fingerprint in a BIGINT column.
+
+    The string can't be read back, only compared, so values read from the
+    database are the fingerprints. Queries can compare the column to
+    strings or fingerprints.
+    """
+
+    impl = BigInteger
+
+    def process_bind_param(self, value, dialect):
+        return fingerprint(value)
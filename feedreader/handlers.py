@@ -3,7 +3,6 @@
 from bs4 import BeautifulSoup
 from tornado.web import HTTPError, asynchronous
 from tornado import gen
-import pbkdf2
 import logging
 import yaml
 
@@ -13,27 +12,45 @@ from feedreader.database import Feed, User
 logger = logging.getLogger(__name__)
 
 
+def _get_user(session, username):
+    """Return the authenticated user, raising HTTPError 401 if they no
+       longer exist."""
+    # session tokens are verified without the database, so they outlive
+    # deleted users
+    user = session.query(User).get(username)
+    if user is None:
+        raise HTTPError(401, reason="User does not exist")
+    return user
+
+
 class MainHandler(APIRequestHandler):
 
+    @asynchronous
+    @gen.coroutine
     def get(self):
         """Return a hello world message."""
-        with self.get_db_session() as session:
-            username = self.require_auth(session)
-            self.write({"message": "Hello, {}.".format(username)})
+        username = yield self.authenticate()
+        self.write({"message": "Hello, {}.".format(username)})
 
 
 class UsersHandler(APIRequestHandler):
 
+    @asynchronous
+    @gen.coroutine
     def get(self):
         """Return information about the current user."""
-        with self.get_db_session() as session:
-            user = session.query(User).get(self.require_auth(session))
-            username = user.username
+        username = yield self.authenticate()
+
+        def get_username(session):
+            return _get_user(session, username).username
+        username = yield self.read_db(get_username)
         logger.info("Returning information about user '{}'"
                     .format(username.encode('utf-8')))
         self.write({'username': username})
         self.set_status(200)
 
+    @asynchronous
+    @gen.coroutine
     def post(self):
         """Create a new user."""
         body = self.require_body_schema({
@@ -53,75 +70,124 @@ class UsersHandler(APIRequestHandler):
             "required": ["username", "password"],
         })
 
-        with self.get_db_session() as session:
-            # check if username already exists
+        def check_username(session):
             if session.query(User).get(body["username"]) is not None:
                 raise HTTPError(400, reason="Username already registered")
-            # save new user
-            password_hash = pbkdf2.crypt(body["password"])
-            new_user = User(body["username"], password_hash)
-            session.add(new_user)
-            session.commit()
-            logger.info("Registered new user '{}'"
-                        .format(body["username"].encode('utf-8')))
+
+        def add_user(session, password_hash):
+            # check again in case it was registered while hashing
+            check_username(session)
+            session.add(User(body["username"], password_hash))
+
+        yield self.run_db(check_username)
+        password_hash = yield self.crypt_password(body["password"])
+        yield self.run_db(add_user, password_hash)
+        # let the new user read their account from the primary
+        self.db.wrote(body["username"])
+        logger.info("Registered new user '{}'"
+                    .format(body["username"].encode('utf-8')))
         self.set_status(201)
 
 
+class SessionsHandler(APIRequestHandler):
+
+    @asynchronous
+    @gen.coroutine
+    def post(self):
+        """Exchange the user's credentials for a session token."""
+        username = yield self.authenticate(allow_token=False)
+        token, expires = self.session_tokens.create(username)
+        logger.info("Created session for user '{}'".format(username))
+        self.write({'token': token, 'expires': expires})
+        self.set_status(201)
+
+
+def _feed_json(feed, unreads):
+    return {
+        'id': feed.id,
+        'name': feed.title,
+        'url': feed.site_url,
+        'image_url': feed.image_url,
+        'unreads': unreads,
+    }
+
+
+def _get_subscribed_feed(session, username, feed_id):
+    """Return (user, feed), raising HTTPError 404 if the feed doesn't exist or
+       the user isn't subscribed to it."""
+    user = _get_user(session, username)
+    feed = session.query(Feed).get(feed_id)
+    if feed is None or not user.has_subscription(feed):
+        raise HTTPError(404, reason='This feed does not exist')
+    return user, feed
+
+
 class FeedsHandler(APIRequestHandler):
 
+    @asynchronous
+    @gen.coroutine
     def get(self):
         """Return a list of the user's subscribed feeds."""
-        feeds = []
-        with self.get_db_session() as session:
-            user = session.query(User).get(self.require_auth(session))
-            for feed in user.subscriptions:
-                feeds.append({
-                    'id': feed.id,
-                    'name': feed.title,
-                    'url': feed.site_url,
-                    'image_url': feed.image_url,
-                    'unreads': user.get_num_unread_entries(feed),
-                })
+        username = yield self.authenticate()
+
+        def get_feeds(session):
+            user = _get_user(session, username)
+            return [_feed_json(feed, unreads) for feed, unreads
+                    in user.get_subscriptions_with_unreads()]
+        feeds = yield self.read_db(get_feeds)
         self.write({'feeds': feeds})
         self.set_status(200)
 
     @classmethod
     @gen.coroutine
-    def subscribe_feed(cls, session, user, celery_poller, tasks, url):
+    def subscribe_feed(cls, run_db, username, celery_poller, tasks, url):
         """Subscribe the user to a feed and return the feed ID.
 
-        Raises HTTPError if the feed at the given url can't be subscribed to.
+        run_db is APIRequestHandler.run_db, or AsyncDatabase.run outside of
+        a request. Raises HTTPError if the feed at the given url can't be
+        subscribed to.
         """
+        def find_feed(session, url):
+            feed = session.query(Feed).filter(Feed.feed_url == url).first()
+            return None if feed is None else feed.id
+
+        def add_feed(session, feed, entries):
+            # the feed may have been added since it was looked up
+            feed_id = find_feed(session, feed.feed_url)
+            if feed_id is not None:
+                return feed_id
+            # only add the first entry with a given guid
+            # this assumes the first one is the newest
+            entries_by_guid = {}
+            for entry in entries:
+                if entry.guid not in entries_by_guid:
+                    entries_by_guid[entry.guid] = entry
+            feed.add_all(entries_by_guid.values())
+            session.add(feed)
+            session.flush()
+            return feed.id
+
+        def subscribe(session, feed_id):
+            user = _get_user(session, username)
+            feed = session.query(Feed).get(feed_id)
+            if user.has_subscription(feed):
+                raise HTTPError(400, reason="Already subscribed to feed")
+            user.subscribe(feed)
+
         # add a new feed if it doesn't exist already
-        feed = session.query(Feed).filter(Feed.feed_url == url).first()
-        if feed is None:
+        feed_id = yield run_db(find_feed, url)
+        if feed_id is None:
             res = yield celery_poller.run_task(tasks.fetch_feed, url)
             res = yaml.safe_load(res)
             if "error" in res:
                 logger.warning("Failed to fetch new feed: '{}'"
                                .format(res['error']))
                 raise HTTPError(400, reason=res['error'])
-            feed = res['feed']
-            existing_feed = session.query(Feed)\
-                    .filter(Feed.feed_url == feed.feed_url).all()
-            if len(existing_feed) > 0:
-                feed = existing_feed[0]
-            else:
-                # only add the first entry with a given guid
-                # this assumes the first one is the newest
-                entries_by_guid = {}
-                for entry in res['entries']:
-                    if entry.guid not in entries_by_guid:
-                        entries_by_guid[entry.guid] = entry
-                feed.add_all(entries_by_guid.values())
-                session.commit()
-        if user.has_subscription(feed):
-            raise HTTPError(400, reason="Already subscribed to feed")
+            feed_id = yield run_db(add_feed, res['feed'], res['entries'])
 
         # subscribe the user to the feed
-        user.subscribe(feed)
-        session.commit()
-        raise gen.Return(feed.id)
+        yield run_db(subscribe, feed_id)
+        raise gen.Return(feed_id)
 
     @asynchronous
     @gen.coroutine
@@ -134,84 +200,138 @@ class FeedsHandler(APIRequestHandler):
             },
             'required': ['url'],
         })
-        with self.get_db_session() as session:
-            user = session.query(User).get(self.require_auth(session))
-            feed_id = yield self.subscribe_feed(session, user,
-                                                self.celery_poller, self.tasks,
-                                                body['url'])
-            # TODO: technically this is supposed to be an absolute URL
-            self.set_header("Location", "/feeds/{}".format(feed_id))
+        username = yield self.authenticate()
+        feed_id = yield self.subscribe_feed(self.run_db, username,
+                                            self.celery_poller, self.tasks,
+                                            body['url'])
+        # TODO: technically this is supposed to be an absolute URL
+        self.set_header("Location", "/feeds/{}".format(feed_id))
         self.set_status(201)
 
 
 class FeedHandler(APIRequestHandler):
 
+    @asynchronous
+    @gen.coroutine
     def get(self, feed_id):
         """Return metadata for a subscribed feed."""
-        with self.get_db_session() as session:
-            user = session.query(User).get(self.require_auth(session))
-            feed = session.query(Feed).get(int(feed_id))
+        username = yield self.authenticate()
 
-            # Make sure the feed exists
-            if feed is None:
-                raise HTTPError(404, reason='This feed does not exist')
+        def get_feed(session):
+            user = _get_user(session, username)
+            feeds = user.get_subscriptions_with_unreads(int(feed_id))
 
-            # Make sure the user is subscribed to this feed
-            if not user.has_subscription(feed):
+            # Make sure the feed exists and the user is subscribed to it
+            if len(feeds) == 0:
                 raise HTTPError(404, reason='This feed does not exist')
-
-            self.write({
-                'id': feed.id,
-                'name': feed.title,
-                'url': feed.site_url,
-                'image_url': feed.image_url,
-                'unreads': user.get_num_unread_entries(feed),
-            })
+            return _feed_json(*feeds[0])
+        feed = yield self.read_db(get_feed)
+        self.write(feed)
         self.set_status(200)
 
+    @asynchronous
+    @gen.coroutine
     def delete(self, feed_id):
-        with self.get_db_session() as session:
-            user = session.query(User).get(self.require_auth(session))
-            feed = session.query(Feed).get(int(feed_id))
-
-            # Make sure the feed exists
-            if feed is None:
-                raise HTTPError(404, reason='This feed does not exist')
-
-            # Make sure the user is subscribed to this feed
-            if not user.has_subscription(feed):
-                raise HTTPError(404, reason='This feed does not exist')
+        username = yield self.authenticate()
 
+        def unsubscribe(session):
+            user, feed = _get_subscribed_feed(session, username, int(feed_id))
             user.unsubscribe(feed)
+        yield self.run_db(unsubscribe)
         self.set_status(204)
 
 
 class FeedEntriesHandler(APIRequestHandler):
 
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    @asynchronous
+    @gen.coroutine
     def get(self, feed_id):
-        """Return a list of entry IDs for a feed."""
+        """Return a page of entry IDs for a feed, newest first."""
         entry_filter = self.get_argument('filter', None)
-
-        with self.get_db_session() as session:
-            user = session.query(User).get(self.require_auth(session))
-            feed = session.query(Feed).get(int(feed_id))
-
-            # Make sure the feed exists
-            if feed is None:
-                raise HTTPError(404, reason='This feed does not exist')
-
-            # Make sure the user is subscribed to this feed
-            if not user.has_subscription(feed):
-                raise HTTPError(404, reason='This feed does not exist')
+        try:
+            limit = int(self.get_argument('limit', self.DEFAULT_LIMIT))
+            before = self.parse_cursor(self.get_argument('before', None))
+            after = self.parse_cursor(self.get_argument('after', None))
+        except ValueError:
+            raise HTTPError(400, reason="Invalid limit or cursor")
+        if not 1 <= limit <= self.MAX_LIMIT:
+            raise HTTPError(400, reason="Limit must be between 1 and {}"
+                                        .format(self.MAX_LIMIT))
+        if before is not None and after is not None:
+            raise HTTPError(400, reason="Only one of before and after can "
+                                        "be given")
+        username = yield self.authenticate()
+
+        def get_entry_keys(session):
+            user, feed = _get_subscribed_feed(session, username, int(feed_id))
 
             # Make sure the filter keyword is valid
             if entry_filter not in ['read', 'unread', None]:
                 raise HTTPError(400, reason='Filter keyboard is not valid')
 
-            # Get feed entries
-            entries = feed.get_entries(user, entry_filter)
-            self.write({'entries': [entry.id for entry in entries]})
-            self.set_status(200)
+            # get one more than the limit to find out if there are more
+            return feed.get_entry_keys(user, entry_filter, limit + 1,
+                                       before, after)
+        keys = yield self.read_db(get_entry_keys)
+
+        more = len(keys) > limit
+        if after is None:
+            keys = keys[:limit]
+            # newer entries exist if this page is older than a cursor
+            newer, older = before is not None, more
+        else:
+            keys = keys[-limit:]
+            newer, older = more, True
+        response = {'entries': [entry_id for date, entry_id in keys]}
+        if keys and older:
+            response['next'] = self.format_cursor(keys[-1])
+        if keys and newer:
+            response['previous'] = self.format_cursor(keys[0])
+        self.write(response)
+        self.set_status(200)
+
+    @staticmethod
+    def format_cursor(key):
+        """Return a cursor for a (date, id) entry key."""
+        return "{}:{}".format(*key)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """Return the (date, id) entry key of a cursor, or None for None.
+
+        Raises ValueError if the cursor is invalid.
+        """
+        if cursor is None:
+            return None
+        date, entry_id = cursor.split(":")
+        return int(date), int(entry_id)
+
+    @asynchronous
+    @gen.coroutine
+    def patch(self, feed_id):
+        """Mark all entries in a feed, up to an optional date, as read or
+           unread."""
+        body = self.require_body_schema({
+            "type": "object",
+            "properties": {
+                "read": {"type": "boolean"},
+                "until": {"type": "integer"},
+            },
+            "required": ["read"],
+        })
+        username = yield self.authenticate()
+
+        def update_read_state(session):
+            user, feed = _get_subscribed_feed(session, username, int(feed_id))
+            if body["read"]:
+                user.read_feed(feed, body.get("until"))
+            else:
+                user.unread_feed(feed, body.get("until"))
+        yield self.run_db(update_read_state)
+        self.set_status(200)
 
 
 class EntriesHandler(APIRequestHandler):
@@ -231,35 +351,38 @@ class EntriesHandler(APIRequestHandler):
         except ValueError:
             raise HTTPError(400, reason="Invalid truncation size.")
 
-        with self.get_db_session() as session:
-            user = session.query(User).get(self.require_auth(session))
+        username = yield self.authenticate()
+
+        def get_entries(session):
+            user = _get_user(session, username)
             entries = user.get_entries(entry_ids)
 
             if len(entries) != len(entry_ids):
                 raise HTTPError(404, "Entry does not exist.")
 
-            entries_json = []
-            for entry in entries:
-                entry_json = {
-                    "id": entry.id,
-                    "title": entry.title,
-                    "pub-date": entry.date,
-                    "read": user.has_read(entry),
-                    "author": entry.author,
-                    "feed_id": entry.feed_id,
-                    "url": entry.url,
-                }
-
-                if length:
-                    entry_json['content'] = yield self.truncate(entry.content,
-                                                                length)
-                else:
-                    entry_json['content'] = entry.content
-                entries_json.append(entry_json)
-
-            self.write({'entries': entries_json})
+            read_ids = user.get_read_entry_ids(entry_ids)
+            return [{
+                "id": entry.id,
+                "title": entry.title,
+                "pub-date": entry.date,
+                "read": entry.id in read_ids,
+                "author": entry.author,
+                "feed_id": entry.feed_id,
+                "url": entry.url,
+                "content": entry.content,
+            } for entry in entries]
+        entries_json = yield self.read_db(get_entries)
+
+        if length:
+            for entry_json in entries_json:
+                entry_json['content'] = yield self.truncate(
+                    entry_json['content'], length)
+
+        self.write({'entries': entries_json})
         self.set_status(200)
 
+    @asynchronous
+    @gen.coroutine
     def patch(self, entry_ids):
         entry_ids = [int(entry_id) for entry_id in entry_ids.split(",")]
         body = self.require_body_schema({
@@ -270,19 +393,17 @@ class EntriesHandler(APIRequestHandler):
             "required": ["read"],
         })
 
-        with self.get_db_session() as session:
-            user = session.query(User).get(self.require_auth(session))
-            entries = user.get_entries(entry_ids)
+        username = yield self.authenticate()
 
-            if len(entries) != len(entry_ids):
+        def update_read_state(session):
+            user = _get_user(session, username)
+
+            if len(user.get_entry_ids(entry_ids)) != len(set(entry_ids)):
                 raise HTTPError(404, "Entry does not exist.")
 
             if body["read"]:
-                for entry in entries:
-                    if not user.has_read(entry):
-                        user.read(entry)
+                user.read_all(entry_ids)
             else:
-                for entry in entries:
-                    if user.has_read(entry):
-                        user.unread(entry)
+                user.unread_all(entry_ids)
+        yield self.run_db(update_read_state)
         self.set_status(200)
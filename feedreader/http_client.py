@@ -0,0 +1,295 @@
+"""Shared HTTP client for fetching feeds and images."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+import socket
+import threading
+import time
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def create_session(max_hosts=100, max_per_host=20):
+    """Return a requests.Session that keeps connections open for reuse.
+
+    Connections are kept for up to max_hosts hosts, up to max_per_host for
+    each. More connections are opened under load, but they are closed after
+    use instead of being kept.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_hosts,
+                          pool_maxsize=max_per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def pool_stats(session):
+    """Return a dict of connection pool counters for a session.
+
+    requests is the number of requests made and connections the number of
+    connections opened for the hosts currently in the pool.
+    """
+    stats = {"hosts": 0, "connections": 0, "requests": 0}
+    adapters = set(session.adapters.values())
+    for adapter in adapters:
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            stats["hosts"] += 1
+            stats["connections"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+    return stats
+
+
+class DnsCache(object):
+    """Bounded cache of host name lookups.
+
+    Pooled connections only skip the lookup while they stay open, so this
+    also saves it when connecting to a host again. Failed lookups aren't
+    cached.
+
+    install() makes every connection in the process use the cache, so it
+    should only be used in processes that mostly fetch feeds.
+    """
+
+    def __init__(self, max_size=10000, ttl=timedelta(minutes=5),
+                 clock=time.time, resolve=socket.getaddrinfo):
+        self._max_size = max_size
+        self._ttl = ttl.total_seconds()
+        self._clock = clock
+        self._resolve = resolve
+        self._lock = threading.Lock()
+        # getaddrinfo arguments -> (addresses, expiry), oldest first
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def getaddrinfo(self, *args, **kwargs):
+        """Like socket.getaddrinfo, but cached."""
+        key = (args, tuple(sorted(kwargs.items())))
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # look up outside the lock, other threads shouldn't wait on it
+        addresses = self._resolve(*args, **kwargs)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (addresses, now + self._ttl)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return addresses
+
+    def install(self):
+        """Use the cache for all lookups made through the socket module."""
+        socket.getaddrinfo = self.getaddrinfo
+
+    def stats(self):
+        """Return a dict of cache counters."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class HostBlockedError(Exception):
+    """A host asked not to be sent requests for retry_after more seconds."""
+
+    def __init__(self, host, retry_after):
+        super(HostBlockedError, self).__init__(
+            "{} asked to retry after {:.0f}s".format(host, retry_after)
+        )
+        self.host = host
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """A request to host couldn't start before its deadline."""
+
+    def __init__(self, host):
+        super(DeadlineExceededError, self).__init__(
+            "request to {} not started before the deadline".format(host)
+        )
+        self.host = host
+
+
+class _HostState(object):
+
+    def __init__(self, tokens, now):
+        self.active = 0
+        self.waiting = 0
+        # requests that can be started now, refilled at the limiter's rate
+        self.tokens = tokens
+        self.updated = now
+        self.blocked_until = 0
+
+
+class HostLimiter(object):
+    """Limits the requests sent to each host by the threads of a process.
+
+    At most max_per_host requests to a host are made at once, and they are
+    started at most per_second a second on average. As many requests as can
+    be made at once may be started together after a host has been idle, so
+    following a redirect or discovering a feed isn't slowed down. Threads
+    wait for their turn, so requests to a busy host should be mixed with
+    requests to others to keep the threads busy.
+
+    Hosts that respond with Retry-After can be blocked, requests to them
+    fail with HostBlockedError until then instead of waiting.
+
+    Requests can be given a deadline, from deadline() it is max_wait
+    seconds away. Requests that haven't started by then fail with
+    DeadlineExceededError, so a batch of requests takes a bounded time. The
+    deadline may have passed before a request reaches the limiter, so the
+    error doesn't mean the host was busy.
+    """
+
+    # idle hosts are forgotten once there are more than this
+    MAX_IDLE_HOSTS = 1000
+
+    def __init__(self, max_per_host=2, per_second=1.0, max_wait=60,
+                 clock=time.time):
+        self._max_per_host = max_per_host
+        self._per_second = per_second
+        self.max_wait = max_wait
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._hosts = {}
+
+        self.waits = 0
+        self.blocked = 0
+        self.late = 0
+
+    def deadline(self):
+        """Return the default deadline for requests made from now."""
+        return self._clock() + self.max_wait
+
+    @contextmanager
+    def request(self, url, deadline=None):
+        """Wait until a request can be made to url's host, then hold one of
+           its slots until the with statement ends.
+
+        Raises HostBlockedError if the host is blocked, or
+        DeadlineExceededError if the request can't start before deadline.
+        """
+        host = urlparse.urlparse(url).netloc
+        with self._condition:
+            state = self._host(host)
+            state.waiting += 1
+            try:
+                while True:
+                    now = self._refill(state)
+                    if state.blocked_until > now:
+                        self.blocked += 1
+                        raise HostBlockedError(host,
+                                               state.blocked_until - now)
+                    if deadline is not None and now >= deadline:
+                        self.late += 1
+                        raise DeadlineExceededError(host)
+                    if state.active < self._max_per_host and \
+                            state.tokens >= 1:
+                        break
+                    self.waits += 1
+                    # released slots notify, but the rate has to be timed
+                    timeout = None
+                    if state.active < self._max_per_host:
+                        timeout = (1 - state.tokens) / self._per_second
+                    if deadline is not None and \
+                            (timeout is None or deadline - now < timeout):
+                        timeout = deadline - now
+                    self._condition.wait(timeout)
+            finally:
+                state.waiting -= 1
+            state.active += 1
+            state.tokens -= 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                state.active -= 1
+                self._condition.notify_all()
+
+    def block(self, url, retry_after):
+        """Refuse requests to url's host for retry_after seconds."""
+        host = urlparse.urlparse(url).netloc
+        with self._condition:
+            state = self._host(host)
+            state.blocked_until = max(state.blocked_until,
+                                      self._clock() + retry_after)
+            # waiting threads fail instead of waiting for their turn
+            self._condition.notify_all()
+
+    def stats(self):
+        """Return a dict of limiter counters and the number of requests
+           waiting for each host that has any."""
+        now = self._clock()
+        with self._condition:
+            return {
+                "hosts": len(self._hosts),
+                "waits": self.waits,
+                "blocked": self.blocked,
+                "late": self.late,
+                "blocked_hosts": sum(1 for state in self._hosts.values()
+                                     if state.blocked_until > now),
+                "queues": dict((host, state.waiting) for host, state
+                               in self._hosts.iteritems() if state.waiting),
+            }
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            if len(self._hosts) >= self.MAX_IDLE_HOSTS:
+                self._forget_idle_hosts()
+            state = self._hosts[host] = _HostState(self._max_per_host,
+                                                   self._clock())
+        return state
+
+    def _refill(self, state):
+        """Add the tokens earned since state was last updated and return
+           the time."""
+        now = self._clock()
+        state.tokens = min(state.tokens +
+                           (now - state.updated) * self._per_second,
+                           self._max_per_host)
+        state.updated = now
+        return now
+
+    def _forget_idle_hosts(self):
+        for host, state in self._hosts.items():
+            now = self._refill(state)
+            if not state.active and not state.waiting and \
+                    state.tokens >= self._max_per_host and \
+                    state.blocked_until <= now:
+                del self._hosts[host]
+
+
+def interleave_by_host(urls):
+    """Return the indexes of urls ordered so consecutive urls are on
+       different hosts where possible.
+
+    Each host's urls keep their order, and hosts take turns in the order
+    they first appear.
+    """
+    by_host = OrderedDict()
+    for index, url in enumerate(urls):
+        host = urlparse.urlparse(url).netloc
+        by_host.setdefault(host, []).append(index)
+    order = []
+    queues = [list(reversed(indexes)) for indexes in by_host.values()]
+    while queues:
+        for queue in queues:
+            order.append(queue.pop())
+        queues = [queue for queue in queues if queue]
+    return order
@@ -0,0 +1,89 @@
+"""Cache of image discovery results for each site."""
+
+from datetime import timedelta
+import logging
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from feedreader import database
+
+logger = logging.getLogger(__name__)
+
+
+class HostImageCache(object):
+    """Remembers the image found for each site, or that there wasn't one.
+
+    Many feeds are on the same site, so this saves looking for the same
+    image again. Results are stored in the host_images table so they are
+    shared by every worker. Images that were found are trusted for
+    found_ttl, and sites without one are checked again after missing_ttl.
+
+    The cache is only an optimization, so database errors are logged and
+    treated as misses.
+    """
+
+    def __init__(self, create_session, found_ttl=timedelta(days=7),
+                 missing_ttl=timedelta(days=1), clock=time.time):
+        self._create_session = create_session
+        self._found_ttl = found_ttl.total_seconds()
+        self._missing_ttl = missing_ttl.total_seconds()
+        self._clock = clock
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, site):
+        """Return (known, image_url) for site, like "http://example.com".
+
+        known is False if the site hasn't been checked recently.
+        """
+        host_images = database.host_images_table
+        session = self._create_session()
+        try:
+            row = session.query(host_images.c.image_url,
+                                host_images.c.checked_date)\
+                .filter(host_images.c.site == site)\
+                .first()
+        except SQLAlchemyError as e:
+            logger.warning("Failed to look up image for '{}': {}"
+                           .format(site, e))
+            row = None
+        finally:
+            session.close()
+
+        if row is not None:
+            image_url, checked_date = row
+            ttl = self._missing_ttl if image_url is None else self._found_ttl
+            if checked_date + ttl > self._clock():
+                self.hits += 1
+                return True, image_url
+        self.misses += 1
+        return False, None
+
+    def add(self, site, image_url):
+        """Remember the image found for site, None if there wasn't one."""
+        host_images = database.host_images_table
+        session = self._create_session()
+        try:
+            session.execute(host_images.delete()
+                            .where(host_images.c.site == site))
+            session.execute(host_images.insert().values(
+                site=site, image_url=image_url,
+                checked_date=int(self._clock())
+            ))
+            session.commit()
+        except SQLAlchemyError as e:
+            # another worker may have just added it
+            session.rollback()
+            logger.warning("Failed to remember image for '{}': {}"
+                           .format(site, e))
+        finally:
+            session.close()
+
+    def stats(self):
+        """Return a dict of cache counters."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+        }
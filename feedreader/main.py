@@ -2,6 +2,7 @@
 
 from datetime import timedelta
 import logging
+import os
 
 from tornado import gen
 import pbkdf2
@@ -9,18 +10,31 @@ import tornado.ioloop
 import tornado.web
 
 from feedreader import database, handlers
+from feedreader.async_database import AsyncDatabase
+from feedreader.auth import CredentialCache, SessionTokens
 from feedreader.celery_poller import CeleryPoller
 from feedreader.config import ConnectionConfig, FeederConfig
+from feedreader.executor import BoundedExecutor
+from feedreader.replicas import ReplicaRouter
+from feedreader.retention import Pruner, RetentionPolicy
+from feedreader.schedule import RefreshSchedule
 from feedreader.tasks.core import Tasks
 from feedreader.updater import Updater
 
 logger = logging.getLogger(__name__)
 
 
-def get_application(feeder_config, conn_config, db_setup_f=None):
-    """Return Tornado application instance."""
+def get_application(feeder_config, conn_config, db_setup_f=None,
+                    hash_executor=None, db_executor=None):
+    """Return Tornado application instance.
+
+    Password hashing and database queries run in hash_executor and
+    db_executor. They are created from feeder_config if not given, callers
+    that pass them in are responsible for shutting them down.
+    """
     # initialize the DB so sessions can be created
-    create_session = database.initialize_db(conn_config.database_uri)
+    create_session = database.initialize_db(conn_config.database_uri,
+                                            conn_config.pool)
 
     if db_setup_f is not None:
         db_setup_f(create_session)
@@ -34,11 +48,27 @@ def get_application(feeder_config, conn_config, db_setup_f=None):
         session.commit()
 
     # TODO: make this configurable
-    tasks = Tasks(conn_config.amqp_uri)
+    # tasks run in this process when there's no broker, so they can use the
+    # database directly
+    tasks = Tasks(conn_config.amqp_uri, create_session=create_session)
 
     # higher poll frequency -> less blocking but more delay adding feeds
     celery_poller = CeleryPoller(timedelta(seconds=1))
 
+    # run queries in other threads so a slow query doesn't block the IOLoop
+    if db_executor is None:
+        db_executor = BoundedExecutor(feeder_config.db_threads,
+                                      feeder_config.db_queue)
+    # send reads that don't need the latest data to replicas, if any
+    router = None
+    if conn_config.replica_uris:
+        router = ReplicaRouter([
+            database.connect_replica(uri, conn_config.pool)
+            for uri in conn_config.replica_uris
+        ])
+    db = AsyncDatabase(create_session, db_executor,
+                       timedelta(seconds=feeder_config.db_timeout), router)
+
     if feeder_config.dummy_data:
         # add some test feeds
         # don't any anything that we aren't ok with hammering with requests
@@ -73,7 +103,7 @@ def get_application(feeder_config, conn_config, db_setup_f=None):
                 # This fails for MySQL once the test data has been added before
                 try:
                     yield handlers.FeedsHandler.subscribe_feed(
-                        session, user, celery_poller, tasks, url
+                        db.run, user.username, celery_poller, tasks, url
                     )
                 # Ignore exceptions for now
                 except:
@@ -84,16 +114,73 @@ def get_application(feeder_config, conn_config, db_setup_f=None):
     session.close()
 
     CHECK_UPDATE_PERIOD = timedelta(minutes=1)
-    UPDATE_PERIOD = timedelta(hours=1)
+    STATS_PERIOD = timedelta(minutes=5)
+
+    # remove old entries, only from one instance so runs don't overlap
+    pruner = None
+    retention = RetentionPolicy.from_config(conn_config.retention)
+    if retention.enabled and feeder_config.instance_number == 0:
+        pruner = Pruner(db, retention,
+                        conn_config.retention.get('batch_size', 500))
+        retention_period = timedelta(
+            minutes=conn_config.retention.get('period_minutes', 60)
+        )
+        retention_callback = tornado.ioloop.PeriodicCallback(
+            pruner.run, retention_period.total_seconds() * 1000
+        )
+        retention_callback.start()
 
+    updater = None
     if feeder_config.periodic_updates:
         # create updater and attach to IOLoop
-        updater = Updater(UPDATE_PERIOD, create_session, tasks, celery_poller)
+        schedule = RefreshSchedule(
+            min_interval=timedelta(minutes=feeder_config.refresh_min),
+            max_interval=timedelta(minutes=feeder_config.refresh_max)
+        )
+        updater = Updater(schedule, create_session, tasks, celery_poller,
+                          batch_size=feeder_config.update_batch,
+                          max_in_flight=feeder_config.update_fetches,
+                          retention=retention)
         periodic_callback = tornado.ioloop.PeriodicCallback(
             updater.do_updates, CHECK_UPDATE_PERIOD.total_seconds() * 1000
         )
         periodic_callback.start()
 
+    # log database usage so pool and executor sizes can be tuned to the load
+    engine = create_session.kw['bind']
+
+    def log_stats():
+        if hasattr(engine.pool, 'stats'):
+            logger.info("Database pool: {}".format(engine.pool.stats()))
+        logger.info("Database executor: {}".format(db.stats()))
+        if updater is not None:
+            logger.info("Feed updates: {}".format(updater.stats()))
+        if pruner is not None:
+            logger.info("Retention: {}".format(pruner.stats()))
+    stats_callback = tornado.ioloop.PeriodicCallback(
+        log_stats, STATS_PERIOD.total_seconds() * 1000
+    )
+    stats_callback.start()
+
+    # remember verified credentials so most requests can skip PBKDF2
+    credential_cache = CredentialCache(
+        max_size=feeder_config.credential_cache,
+        ttl=timedelta(seconds=feeder_config.credential_ttl)
+    )
+
+    # session tokens need a secret shared by all API instances
+    secret = conn_config.secret
+    if not secret:
+        logger.warning("No secret configured, session tokens will only be "
+                       "valid for this instance until it restarts")
+        secret = os.urandom(32)
+    session_tokens = SessionTokens(secret, lifetime=timedelta(days=30))
+
+    # hash passwords in other threads so PBKDF2 doesn't block the IOLoop
+    if hash_executor is None:
+        hash_executor = BoundedExecutor(feeder_config.hash_threads,
+                                        feeder_config.hash_queue)
+
     # log if the IOLoop gets blocked
     # for debugging only - breaks celery
     #tornado.ioloop.IOLoop.instance().set_blocking_log_threshold(0.1)
@@ -104,10 +191,15 @@ def get_application(feeder_config, conn_config, db_setup_f=None):
         enable_dummy_data=feeder_config.dummy_data,
         tasks=tasks,
         celery_poller=celery_poller,
+        credential_cache=credential_cache,
+        session_tokens=session_tokens,
+        hash_executor=hash_executor,
+        db=db,
     )
     return tornado.web.Application([
         (r"^/?$", handlers.MainHandler, default_injections),
         (r"^/users/?$", handlers.UsersHandler, default_injections),
+        (r"^/sessions/?$", handlers.SessionsHandler, default_injections),
         (r'^/feeds/?$', handlers.FeedsHandler, default_injections),
         (r'^/feeds/(?P<feed_id>[0-9]+)$', handlers.FeedHandler,
          default_injections),
@@ -0,0 +1,132 @@
+"""Database maintenance commands.
+
+Run with `python -m feedreader.maintenance --config deploy/dev.yaml COMMAND`.
+"""
+
+from argparse import ArgumentParser
+import logging
+import time
+
+from sqlalchemy import select, type_coerce, LargeBinary
+
+from feedreader import database
+from feedreader.compression import (compress_text, decompress_text,
+                                    is_compressed, MIN_COMPRESS_SIZE)
+from feedreader.config import ConnectionConfig
+
+logger = logging.getLogger(__name__)
+
+
+def rebuild_unread_counts(session):
+    """Recount every user's unread entries and fix any counts that drifted."""
+    drifted = database.rebuild_unread_counts(session)
+    session.commit()
+    logger.info("Rebuilt unread counts, {} were wrong".format(drifted))
+    return drifted
+
+
+def compress_entry_contents(session, batch_size=500):
+    """Compress entry content that was stored before compression was added.
+
+    Content is read and rewritten in batches, each in its own transaction.
+    Returns the number of entries that were rewritten.
+    """
+    contents = database.EntryContent.__table__
+    # read what is stored, without decompressing it
+    stored = type_coerce(contents.c.content, LargeBinary)
+    last_id = 0
+    rewritten = 0
+    while True:
+        rows = session.execute(
+            select([contents.c.entry_id, stored])
+            .where(contents.c.entry_id > last_id)
+            .order_by(contents.c.entry_id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        for entry_id, data in rows:
+            if data is None or is_compressed(data) or \
+                    len(data) < MIN_COMPRESS_SIZE:
+                continue
+            session.execute(
+                contents.update()
+                        .where(contents.c.entry_id == entry_id)
+                        .values(content=decompress_text(data))
+            )
+            rewritten += 1
+        session.commit()
+        last_id = rows[-1][0]
+        logger.info("Compressed entry content up to entry {}, {} so far"
+                    .format(last_id, rewritten))
+    return rewritten
+
+
+def benchmark_compression(session, sample_size=1000):
+    """Report size savings and costs of compressing recent entry content.
+
+    Returns a dict of results. Times are in milliseconds per entry.
+    """
+    rows = session.query(database.EntryContent.content)\
+        .filter(database.EntryContent.content != None)\
+        .order_by(database.EntryContent.entry_id.desc())\
+        .limit(sample_size)
+    texts = [content for content, in rows]
+    if not texts:
+        logger.info("No entry content to benchmark")
+        return None
+
+    start = time.time()
+    encoded = [compress_text(text) for text in texts]
+    encode_time = time.time() - start
+    start = time.time()
+    for data in encoded:
+        decompress_text(data)
+    decode_time = time.time() - start
+
+    raw_bytes = sum(len(text.encode('utf-8')) for text in texts)
+    stored_bytes = sum(len(data) for data in encoded)
+    results = {
+        "entries": len(texts),
+        "raw_bytes": raw_bytes,
+        "stored_bytes": stored_bytes,
+        "saved": 1 - float(stored_bytes) / raw_bytes if raw_bytes else 0,
+        "encode_ms": encode_time * 1000 / len(texts),
+        "decode_ms": decode_time * 1000 / len(texts),
+    }
+    logger.info("Compressed {entries} entries from {raw_bytes} to "
+                "{stored_bytes} bytes ({saved:.0%} saved), "
+                "{encode_ms:.3f} ms to encode and {decode_ms:.3f} ms to "
+                "decode each".format(**results))
+    return results
+
+
+COMMANDS = {
+    'rebuild-unread-counts': rebuild_unread_counts,
+    'compress-entry-contents': compress_entry_contents,
+    'benchmark-compression': benchmark_compression,
+}
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='deploy/dev.yaml',
+                        help='path to connection settings yaml')
+    parser.add_argument('command', choices=sorted(COMMANDS),
+                        help='maintenance task to run')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='[%(levelname)s][%(name)s]: %(message)s')
+    logging.getLogger().setLevel(logging.INFO)
+
+    conn_config = ConnectionConfig.from_file(args.config)
+    session = database.initialize_db(conn_config.database_uri,
+                                     conn_config.pool)()
+    try:
+        COMMANDS[args.command](session)
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
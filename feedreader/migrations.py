@@ -0,0 +1,441 @@
+"""Versioned schema migrations.
+
+create_all only creates missing tables, so it can't change tables that
+already exist. Each migration here upgrades an existing database by one
+version and the current version is stored in the schema_version table.
+
+Migrations describe the schema as it was at their version, using tables
+reflected from the database, rather than importing the current models.
+"""
+
+import logging
+
+from sqlalchemy import (and_, bindparam, exists, func, inspect, select,
+                        BigInteger, Column, ForeignKey, Index, Integer,
+                        LargeBinary, MetaData, String, Table, Text,
+                        UniqueConstraint)
+
+from feedreader.fingerprint import fingerprint
+
+logger = logging.getLogger(__name__)
+
+SMALL_STR = 100
+MEDIUM_STR = 2048
+
+_version_metadata = MetaData()
+schema_version_table = Table('schema_version', _version_metadata,
+                             Column('version', Integer, nullable=False))
+
+MIGRATIONS = []
+
+
+def migration(f):
+    """Register a function as the migration to the next version."""
+    MIGRATIONS.append(f)
+    return f
+
+
+def latest_version():
+    return len(MIGRATIONS)
+
+
+def upgrade(engine, metadata):
+    """Bring the database up to the latest version of the given metadata.
+
+    New databases are created with create_all and marked as the latest
+    version. Databases created before versioning are treated as version 0.
+    """
+    with engine.begin() as conn:
+        version = get_version(conn)
+        if version is None:
+            logger.info("Creating database at version {}"
+                        .format(latest_version()))
+            metadata.create_all(conn)
+            _set_version(conn, latest_version())
+            return
+
+        for number, migrate in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info("Migrating database to version {}: {}"
+                        .format(number, migrate.__doc__))
+            migrate(conn)
+            _set_version(conn, number)
+
+        # create any tables that don't need data migrated
+        metadata.create_all(conn)
+
+
+def get_version(conn):
+    """Return the schema version, or None if the database is empty."""
+    table_names = inspect(conn).get_table_names()
+    if schema_version_table.name in table_names:
+        return conn.execute(schema_version_table.select()).scalar()
+    elif 'users' in table_names:
+        return 0
+    else:
+        return None
+
+
+def _set_version(conn, version):
+    schema_version_table.create(conn, checkfirst=True)
+    conn.execute(schema_version_table.delete())
+    conn.execute(schema_version_table.insert().values(version=version))
+
+
+def _reflect(conn, *table_names):
+    """Return MetaData holding the named tables as they are now."""
+    metadata = MetaData()
+    metadata.reflect(conn, only=table_names)
+    return metadata
+
+
+def _replace_table(conn, old_table, new_table, select):
+    """Copy rows from select into new_table, then put it in old_table's place.
+
+    new_table must have a temporary name. It is renamed to old_table's name
+    after old_table is dropped, which keeps the names of its indexes.
+    """
+    new_table.create(conn)
+    conn.execute(new_table.insert().from_select(
+        [column.name for column in new_table.columns], select
+    ))
+    old_table.drop(conn)
+    quote = conn.dialect.identifier_preparer.quote_identifier
+    conn.execute("ALTER TABLE {} RENAME TO {}"
+                 .format(quote(new_table.name), quote(old_table.name)))
+
+
+###############################################################################
+# Migrations
+###############################################################################
+
+
+@migration
+def add_keys_and_indexes(conn):
+    """primary keys on subscriptions and read, indexes for common queries"""
+    metadata = _reflect(conn, 'users', 'feeds', 'entries', 'subscriptions',
+                        'read')
+    feeds = metadata.tables['feeds']
+    entries = metadata.tables['entries']
+    subscriptions = metadata.tables['subscriptions']
+    read = metadata.tables['read']
+
+    # rebuild join tables with composite primary keys, dropping duplicates
+    new_subscriptions = Table(
+        'subscriptions_new', metadata,
+        Column('username', String(SMALL_STR),
+               ForeignKey('users.username', ondelete='CASCADE'),
+               primary_key=True),
+        Column('feed_id', Integer,
+               ForeignKey('feeds.id', ondelete='CASCADE'),
+               primary_key=True),
+    )
+    Index('ix_subscriptions_feed_id', new_subscriptions.c.feed_id)
+    _replace_table(conn, subscriptions, new_subscriptions,
+                   subscriptions.select()
+                   .with_only_columns([subscriptions.c.username,
+                                       subscriptions.c.feed_id])
+                   .where(subscriptions.c.username != None)
+                   .where(subscriptions.c.feed_id != None)
+                   .distinct())
+
+    new_read = Table(
+        'read_new', metadata,
+        Column('username', String(SMALL_STR),
+               ForeignKey('users.username', ondelete='CASCADE'),
+               primary_key=True),
+        Column('entry_id', Integer,
+               ForeignKey('entries.id', ondelete='CASCADE'),
+               primary_key=True),
+    )
+    Index('ix_read_entry_id', new_read.c.entry_id)
+    _replace_table(conn, read, new_read,
+                   read.select()
+                   .with_only_columns([read.c.username, read.c.entry_id])
+                   .where(read.c.username != None)
+                   .where(read.c.entry_id != None)
+                   .distinct())
+
+    Index('ix_entries_feed_id_date', entries.c.feed_id,
+          entries.c.date).create(conn)
+    Index('ix_feeds_last_refresh_date',
+          feeds.c.last_refresh_date).create(conn)
+
+
+@migration
+def add_unread_counts(conn):
+    """unread_counts table, filled in from subscriptions and read"""
+    metadata = _reflect(conn, 'users', 'feeds', 'entries', 'subscriptions',
+                        'read')
+    entries = metadata.tables['entries']
+    subscriptions = metadata.tables['subscriptions']
+    read = metadata.tables['read']
+
+    unread_counts = Table(
+        'unread_counts', metadata,
+        Column('username', String(SMALL_STR),
+               ForeignKey('users.username', ondelete='CASCADE'),
+               primary_key=True),
+        Column('feed_id', Integer,
+               ForeignKey('feeds.id', ondelete='CASCADE'),
+               primary_key=True),
+        Column('unreads', Integer, nullable=False, default=0),
+    )
+    Index('ix_unread_counts_feed_id', unread_counts.c.feed_id)
+    unread_counts.create(conn)
+
+    is_read = exists().where(and_(
+        read.c.entry_id == entries.c.id,
+        read.c.username == subscriptions.c.username,
+    ))
+    unreads = select([func.count(entries.c.id)])\
+        .where(entries.c.feed_id == subscriptions.c.feed_id)\
+        .where(~is_read)\
+        .as_scalar()
+    conn.execute(unread_counts.insert().from_select(
+        ['username', 'feed_id', 'unreads'],
+        select([subscriptions.c.username, subscriptions.c.feed_id, unreads])
+    ))
+
+
+@migration
+def split_entry_contents(conn):
+    """entry content moved from entries to entry_contents"""
+    metadata = _reflect(conn, 'feeds', 'entries')
+    entries = metadata.tables['entries']
+
+    entry_contents = Table(
+        'entry_contents', metadata,
+        Column('entry_id', Integer,
+               ForeignKey('entries.id', ondelete='CASCADE'),
+               primary_key=True, nullable=False),
+        Column('content', Text, nullable=True),
+    )
+    entry_contents.create(conn)
+    conn.execute(entry_contents.insert().from_select(
+        ['entry_id', 'content'], select([entries.c.id, entries.c.content])
+    ))
+
+    if conn.dialect.name != 'sqlite':
+        conn.execute("ALTER TABLE entries DROP COLUMN content")
+        return
+
+    # SQLite can't drop columns, so copy everything else to a new table
+    new_entries = Table(
+        'entries_new', metadata,
+        Column('id', Integer, primary_key=True, nullable=False),
+        Column('feed_id', Integer,
+               ForeignKey('feeds.id', ondelete='CASCADE'), nullable=False),
+        Column('url', String(MEDIUM_STR), nullable=True),
+        Column('title', String(MEDIUM_STR), nullable=True),
+        Column('author', String(SMALL_STR), nullable=True),
+        Column('date', Integer, nullable=False),
+        Column('guid', String(SMALL_STR), nullable=False),
+        UniqueConstraint('feed_id', 'guid', name='feed_guid'),
+    )
+    Index('ix_entries_feed_id_date', new_entries.c.feed_id,
+          new_entries.c.date)
+    # index names are global in SQLite, so the old ones must go first
+    for index in entries.indexes:
+        index.drop(conn)
+    columns = [entries.c[column.name] for column in new_entries.columns]
+    _replace_table(conn, entries, new_entries, select(columns))
+
+
+@migration
+def binary_entry_contents(conn):
+    """entry_contents.content stored as binary so it can be compressed"""
+    if conn.dialect.name == 'sqlite':
+        # SQLite columns can hold any type, but the text values must become
+        # blobs to be read as binary
+        conn.execute("UPDATE entry_contents "
+                     "SET content = CAST(content AS BLOB)")
+    else:
+        # production uses MySQL
+        conn.execute("ALTER TABLE entry_contents MODIFY content BLOB")
+
+
+@migration
+def add_entry_keyset_index(conn):
+    """(feed_id, date, id) index on entries for paging through a feed"""
+    metadata = _reflect(conn, 'entries')
+    entries = metadata.tables['entries']
+    # create the new index first, MySQL needs one on feed_id for its
+    # foreign key
+    Index('ix_entries_feed_id_date_id', entries.c.feed_id, entries.c.date,
+          entries.c.id).create(conn)
+    for index in entries.indexes:
+        if index.name == 'ix_entries_feed_id_date':
+            index.drop(conn)
+
+
+@migration
+def add_entry_content_hash(conn):
+    """entries.content_hash for skipping unchanged entries on update"""
+    # existing entries are left without a hash and rewritten the next time
+    # their feed updates
+    conn.execute("ALTER TABLE entries ADD COLUMN content_hash VARCHAR(40)")
+
+
+@migration
+def add_archived_entries(conn):
+    """archived_entries table for entries removed by the retention policy"""
+    metadata = _reflect(conn, 'feeds')
+    archived_entries = Table(
+        'archived_entries', metadata,
+        Column('id', Integer, primary_key=True, autoincrement=False,
+               nullable=False),
+        Column('feed_id', Integer,
+               ForeignKey('feeds.id', ondelete='CASCADE'), nullable=False),
+        Column('url', String(MEDIUM_STR)),
+        Column('title', String(MEDIUM_STR)),
+        Column('author', String(SMALL_STR)),
+        Column('date', Integer, nullable=False),
+        Column('guid', String(SMALL_STR), nullable=False),
+        Column('content', LargeBinary),
+        Column('archived_date', Integer, nullable=False),
+    )
+    Index('ix_archived_entries_feed_id_date', archived_entries.c.feed_id,
+          archived_entries.c.date)
+    archived_entries.create(conn)
+
+
+@migration
+def fingerprint_guids(conn):
+    """entries.guid and archived_entries.guid stored as 64-bit fingerprints"""
+    for table_name in ('entries', 'archived_entries'):
+        conn.execute("ALTER TABLE {} ADD COLUMN guid_key BIGINT"
+                     .format(table_name))
+        _fill_guid_keys(conn, table_name)
+
+    if conn.dialect.name != 'sqlite':
+        conn.execute("ALTER TABLE entries DROP INDEX feed_guid, "
+                     "DROP COLUMN guid, "
+                     "CHANGE guid_key guid BIGINT NOT NULL, "
+                     "ADD CONSTRAINT feed_guid UNIQUE (feed_id, guid)")
+        conn.execute("ALTER TABLE archived_entries DROP COLUMN guid, "
+                     "CHANGE guid_key guid BIGINT NOT NULL")
+        return
+
+    # SQLite can't change columns, so copy to new tables with guid_key as
+    # the guid
+    metadata = _reflect(conn, 'feeds', 'entries', 'archived_entries')
+    entries = metadata.tables['entries']
+    archived_entries = metadata.tables['archived_entries']
+
+    new_entries = Table(
+        'entries_new', metadata,
+        Column('id', Integer, primary_key=True, nullable=False),
+        Column('feed_id', Integer,
+               ForeignKey('feeds.id', ondelete='CASCADE'), nullable=False),
+        Column('url', String(MEDIUM_STR), nullable=True),
+        Column('title', String(MEDIUM_STR), nullable=True),
+        Column('author', String(SMALL_STR), nullable=True),
+        Column('date', Integer, nullable=False),
+        Column('guid', BigInteger, nullable=False),
+        Column('content_hash', String(40), nullable=True),
+        UniqueConstraint('feed_id', 'guid', name='feed_guid'),
+    )
+    Index('ix_entries_feed_id_date_id', new_entries.c.feed_id,
+          new_entries.c.date, new_entries.c.id)
+
+    new_archived_entries = Table(
+        'archived_entries_new', metadata,
+        Column('id', Integer, primary_key=True, autoincrement=False,
+               nullable=False),
+        Column('feed_id', Integer,
+               ForeignKey('feeds.id', ondelete='CASCADE'), nullable=False),
+        Column('url', String(MEDIUM_STR)),
+        Column('title', String(MEDIUM_STR)),
+        Column('author', String(SMALL_STR)),
+        Column('date', Integer, nullable=False),
+        Column('guid', BigInteger, nullable=False),
+        Column('content', LargeBinary),
+        Column('archived_date', Integer, nullable=False),
+    )
+    Index('ix_archived_entries_feed_id_date', new_archived_entries.c.feed_id,
+          new_archived_entries.c.date)
+
+    for table, new_table in ((entries, new_entries),
+                             (archived_entries, new_archived_entries)):
+        # index names are global in SQLite, so the old ones must go first
+        for index in table.indexes:
+            index.drop(conn)
+        columns = [table.c.guid_key if column.name == 'guid'
+                   else table.c[column.name] for column in new_table.columns]
+        _replace_table(conn, table, new_table, select(columns))
+
+
+def _fill_guid_keys(conn, table_name, batch_size=1000):
+    """Set guid_key to the fingerprint of guid, a batch of rows at a time."""
+    table = _reflect(conn, table_name).tables[table_name]
+    update = table.update()\
+        .where(table.c.id == bindparam('row_id'))\
+        .values(guid_key=bindparam('key'))
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select([table.c.id, table.c.guid])
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [{"row_id": id_, "key": fingerprint(guid)}
+                              for id_, guid in rows])
+        last_id = rows[-1][0]
+
+
+@migration
+def add_host_images(conn):
+    """host_images table caching image discovery for each site"""
+    metadata = MetaData()
+    host_images = Table(
+        'host_images', metadata,
+        Column('site', String(191), primary_key=True),
+        Column('image_url', String(MEDIUM_STR), nullable=True),
+        Column('checked_date', Integer, nullable=False),
+    )
+    host_images.create(conn)
+
+
+@migration
+def add_refresh_schedule(conn):
+    """refresh_interval and next_refresh_date columns on feeds"""
+    conn.execute("ALTER TABLE feeds ADD COLUMN refresh_interval INTEGER")
+    conn.execute("ALTER TABLE feeds ADD COLUMN next_refresh_date INTEGER")
+    feeds = _reflect(conn, 'feeds').tables['feeds']
+    # feeds were refreshed every hour before
+    conn.execute(feeds.update().values(
+        next_refresh_date=feeds.c.last_refresh_date + 60 * 60
+    ))
+    Index('ix_feeds_next_refresh_date',
+          feeds.c.next_refresh_date).create(conn)
+
+
+@migration
+def add_feed_body_digest(conn):
+    """body_digest column on feeds"""
+    conn.execute("ALTER TABLE feeds ADD COLUMN body_digest VARCHAR(40)")
+
+
+@migration
+def add_pruned_guids(conn):
+    """pruned_guids table, filled in from archived_entries"""
+    metadata = _reflect(conn, 'feeds', 'archived_entries')
+    archived_entries = metadata.tables['archived_entries']
+    pruned_guids = Table(
+        'pruned_guids', metadata,
+        Column('feed_id', Integer,
+               ForeignKey('feeds.id', ondelete='CASCADE'), primary_key=True),
+        Column('guid', BigInteger, primary_key=True),
+        Column('date', Integer, nullable=False),
+    )
+    pruned_guids.create(conn)
+    # an entry may have been archived more than once
+    conn.execute(pruned_guids.insert().from_select(
+        ['feed_id', 'guid', 'date'],
+        select([archived_entries.c.feed_id, archived_entries.c.guid,
+                func.max(archived_entries.c.date)])
+        .group_by(archived_entries.c.feed_id, archived_entries.c.guid)
+    ))
@@ -6,13 +6,19 @@ have sensible values: None indicates they are not present in the feed.
 
 import calendar
 import cgi
+from email.utils import mktime_tz, parsedate_tz
 import feedparser
 import hashlib
+import io
 import logging
+import re
 import requests
 import time
 import urlparse
 
+from feedreader.http_client import HostBlockedError, HostLimiter
+from feedreader.schedule import parse_hint
+
 
 LOG = logging.getLogger(__name__)
 # link type attribute values that indicate a feed
@@ -27,6 +33,16 @@ HTML_MIME_TYPES = [
 ]
 # valid schemes for feed URLs
 VALID_SCHEMES = ['http', 'https']
+# seconds to wait for a server to accept a connection or send data
+FETCH_TIMEOUT = 10
+# requests decodes the body, so feedparser must not see these
+DECODED_HEADERS = ['content-encoding', 'content-length']
+# max-age directive of a Cache-Control header
+MAX_AGE_RE = re.compile(r'max-age\s*=\s*"?(\d+)')
+# statuses servers use to ask for fewer requests
+RATE_LIMITED_STATUSES = [429, 503]
+# seconds to leave a host alone when it doesn't say how long to
+DEFAULT_RETRY_AFTER = 60
 
 
 class FeedParseError(Exception):
@@ -34,8 +50,32 @@ class FeedParseError(Exception):
     pass
 
 
+class FeedRateLimitedError(FeedParseError):
+    """The feed's host asked for fewer requests.
+
+    retry_after is the number of seconds it asked to wait.
+    """
+
+    def __init__(self, retry_after):
+        super(FeedRateLimitedError, self).__init__(
+            "Rate limited, retry after {:.0f}s".format(retry_after)
+        )
+        self.retry_after = retry_after
+
+
 class FeedNotModifiedError(Exception):
-    """Requested feed but it was not modified."""
+    """Requested feed but it was not modified.
+
+    refresh_hint is the Cache-Control max-age of the response, if any.
+    """
+
+    def __init__(self, refresh_hint=None):
+        super(FeedNotModifiedError, self).__init__()
+        self.refresh_hint = refresh_hint
+
+
+class FeedBodyUnchangedError(FeedNotModifiedError):
+    """Downloaded feed, but it was the same as last time."""
     pass
 
 
@@ -43,12 +83,14 @@ class ParsedFeed(object):
     """Parsed feed."""
 
     def __init__(self):
+        self.body_digest = None
         self.entries = []
         self.etag = ""
         self.image_url = ""
         self.last_modified = ""
         self.last_refresh_date = ""
         self.link = ""
+        self.refresh_hint = None
         self.title = ""
         self.url = ""
 
@@ -66,15 +108,41 @@ class ParsedEntry(object):
 
 
 def get_parsed_feed(url, find_image_url=False, use_discovery=True,
-                    last_modified=None, etag=None):
+                    last_modified=None, etag=None, http=None,
+                    timeout=FETCH_TIMEOUT, image_cache=None, limiter=None,
+                    body_digest=None, deadline=None):
     """Parse feed from given URL.
 
-    Raises FeedParseError if feed cannot be parsed.
+    http is the requests.Session used to download the feed. Sessions can be
+    shared between threads, so many feeds can be fetched at once with one.
+
+    image_cache is passed to discover_image.
+
+    limiter is the http_client.HostLimiter that feed downloads wait for.
+    Hosts that respond with Retry-After are blocked in it. If the download
+    can't start before deadline, http_client.DeadlineExceededError is
+    raised.
+
+    body_digest is the ParsedFeed.body_digest from the last time the feed
+    was parsed. For servers that don't send an ETag or Last-Modified, it
+    tells if the feed changed.
+
+    Raises FeedParseError if feed cannot be parsed, or FeedRateLimitedError
+    if the host asked for fewer requests. Raises FeedNotModifiedError if the
+    server said the feed wasn't modified, or FeedBodyUnchangedError if it
+    sent the same feed as last time.
     """
-    return _parse_result(*_get_result(
-        url, etag=etag, last_modified=last_modified,
-        use_discovery=use_discovery,
-    ), find_image_url=find_image_url)
+    http = http or requests.Session()
+    limiter = limiter or HostLimiter()
+    url, result, digest = _get_result(
+        url, http, limiter, etag=etag, last_modified=last_modified,
+        use_discovery=use_discovery, timeout=timeout,
+        body_digest=body_digest, deadline=deadline
+    )
+    feed = _parse_result(url, result, find_image_url=find_image_url,
+                         http=http, timeout=timeout, image_cache=image_cache)
+    feed.body_digest = digest
+    return feed
 
 
 ###############################################################################
@@ -82,32 +150,94 @@ def get_parsed_feed(url, find_image_url=False, use_discovery=True,
 ###############################################################################
 
 
-def _get_result(url, etag=None, last_modified=None, use_discovery=False):
-    """Return feedparser result for url, optionally with discovery.
+def _get_result(url, http, limiter, etag=None, last_modified=None,
+                use_discovery=False, timeout=FETCH_TIMEOUT, body_digest=None,
+                deadline=None):
+    """Return url, feedparser result and body digest for url, optionally
+       with discovery.
 
-    Raises FeedParseError.
+    Raises FeedParseError, or FeedBodyUnchangedError without parsing if the
+    body's digest is body_digest.
     """
     _validate_url(url)
 
-    result = feedparser.parse(url, etag=etag, modified=last_modified)
-    # update URL for any redirects that feedparser followed
-    url = result.get('href', url)
-
-    if _is_not_modified_result(result):
-        raise FeedNotModifiedError
-    elif not _is_valid_result(result):
+    headers = {
+        'User-Agent': feedparser.USER_AGENT,
+        'Accept': feedparser.ACCEPT_HEADER,
+    }
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    try:
+        with limiter.request(url, deadline):
+            response = http.get(url, headers=headers, timeout=timeout)
+    except HostBlockedError as e:
+        LOG.debug("Not downloading feed '{}': {}".format(url, e))
+        raise FeedRateLimitedError(e.retry_after)
+    except requests.exceptions.RequestException as e:
+        LOG.debug("Failed to download feed '{}': {}".format(url, e))
+        _fail(url, "Failed to download or parse feed")
+
+    if response.status_code in RATE_LIMITED_STATUSES:
+        retry_after = _retry_after(response.headers)
+        if response.status_code == 429 or retry_after is not None:
+            retry_after = retry_after or DEFAULT_RETRY_AFTER
+            LOG.debug("Feed '{}' rate limited for {}s"
+                      .format(url, retry_after))
+            limiter.block(url, retry_after)
+            raise FeedRateLimitedError(retry_after)
+
+    if response.status_code == 304:
+        raise FeedNotModifiedError(
+            parse_hint(max_age=_max_age(response.headers))
+        )
+
+    digest = hashlib.sha1(response.content).hexdigest()
+    if digest == body_digest:
+        raise FeedBodyUnchangedError(
+            parse_hint(max_age=_max_age(response.headers))
+        )
+
+    # update URL for any redirects that were followed
+    url = response.url
+    response_headers = dict(
+        (name.lower(), value) for name, value in response.headers.iteritems()
+        if name.lower() not in DECODED_HEADERS
+    )
+    # feedparser resolves relative links against this
+    response_headers.setdefault('content-location', url)
+    # pass a stream, feedparser would treat a string like a path or URL
+    result = feedparser.parse(io.BytesIO(response.content),
+                              response_headers=response_headers)
+
+    if not _is_valid_result(result):
         if use_discovery:
             url = _discover_url(result)
-            return _get_result(url)
+            return _get_result(url, http, limiter, timeout=timeout,
+                               deadline=deadline)
         else:
             _fail(url, "Failed to download or parse feed")
     else:
-        return url, result
+        return url, result, digest
 
 
-def _is_not_modified_result(result):
-    """Return True if feedparser result indicates feed was not modified."""
-    return result.get('status', None) == 304
+def _max_age(headers):
+    """Return the Cache-Control max-age from response headers, or None."""
+    match = MAX_AGE_RE.search(headers.get('cache-control', ''))
+    return int(match.group(1)) if match else None
+
+
+def _retry_after(headers):
+    """Return the seconds to wait from a Retry-After header, or None."""
+    value = headers.get('retry-after', '').strip()
+    if value.isdigit():
+        return int(value)
+    # otherwise it is an HTTP date
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(mktime_tz(date) - int(time.time()), 0)
 
 
 def _is_valid_result(result):
@@ -156,7 +286,8 @@ def _validate_url(url):
         _fail(url, "Invalid URL")
 
 
-def _parse_result(url, result, find_image_url=False):
+def _parse_result(url, result, find_image_url=False, http=None,
+                  timeout=FETCH_TIMEOUT, image_cache=None):
     """Parse feedparser result info ParsedFeed."""
     feed = ParsedFeed()
     feed.url = url  # TODO use feed.id
@@ -165,9 +296,17 @@ def _parse_result(url, result, find_image_url=False):
     feed.etag = result.get("etag", None)
     feed.last_modified = result.get("modified", None)
     feed.last_refresh_date = int(time.time())
+    # feedparser keeps the response headers, with lowercase names
+    feed.refresh_hint = parse_hint(
+        max_age=_max_age(result.get("headers", {})),
+        ttl=result.feed.get("ttl"),
+        update_period=result.feed.get("sy_updateperiod"),
+        update_frequency=result.feed.get("sy_updatefrequency"),
+    )
     if find_image_url:
         feed.image_url = discover_image(feed.link if feed.link is not None else
-                                        feed.url)
+                                        feed.url, http=http, timeout=timeout,
+                                        image_cache=image_cache)
     else:
         feed.image_url = None
     feed.entries = [_parse_result_entry(entry) for entry in result.entries]
@@ -210,22 +349,38 @@ def _parse_result_entry(result):
     return entry
 
 
-def discover_image(url):
+def discover_image(url, http=None, timeout=FETCH_TIMEOUT, image_cache=None):
     """Return the URL of an image associated with the given site URL.
 
     Returns None if not icon is found.
+
+    If image_cache is given, it is checked before looking for an image and
+    told what was found.
     """
+    http = http or requests.Session()
     LOG.info("Attempting to discover image for '{}'"
              .format(url.encode('utf-8')))
     # hacky way to use urlparse to get favicon path
     parsed_url = urlparse.urlparse(url)
+    site = urlparse.urlunparse((parsed_url.scheme, parsed_url.netloc,
+                                '', '', '', ''))
     favicon_url = urlparse.urlunparse((parsed_url.scheme, parsed_url.netloc,
                                        "favicon.ico", '', '', ''))
+
+    if image_cache is not None:
+        known, image_url = image_cache.lookup(site)
+        if known:
+            LOG.info("Image for '{}' is cached".format(site.encode('utf-8')))
+            return image_url
+
     try:
-        response = requests.head(favicon_url)
+        response = http.head(favicon_url, timeout=timeout)
     except requests.exceptions.RequestException:
-        response = None
+        # might not happen next time, so don't cache it
+        LOG.info("No image found")
+        return None
 
+    image_url = None
     if response:
         good_status = response.status_code == 200
         good_content_type = response.headers.get('content-type', '')\
@@ -233,7 +388,10 @@ def discover_image(url):
         good_content_size = int(response.headers.get('content-length', 0)) > 0
         if good_status and good_content_type and good_content_size:
             LOG.info("Image found at '{}'".format(url.encode('utf-8')))
-            return favicon_url
+            image_url = favicon_url
 
-    LOG.info("No image found")
-    return None
+    if image_url is None:
+        LOG.info("No image found")
+    if image_cache is not None:
+        image_cache.add(site, image_url)
+    return image_url
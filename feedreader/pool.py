@@ -0,0 +1,96 @@
+"""Database connection pool helpers."""
+
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+
+class MeteredQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a connection.
+
+    Waiting means every connection is checked out and the pool is at its
+    overflow limit, so a growing wait time means the pool is too small for
+    the load on this instance.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self._clock = time.time
+        self._lock = threading.Lock()
+        # _do_get calls itself when it loses a race, only time the outer call
+        self._getting = threading.local()
+
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def stats(self):
+        """Return a dict of pool counters and current sizes.
+
+        Wait times are in seconds.
+        """
+        with self._lock:
+            return {
+                "size": self.size(),
+                "checked_out": self.checkedout(),
+                "overflow": max(self.overflow(), 0),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "total_wait": self.total_wait,
+                "max_wait": self.max_wait,
+            }
+
+    def recreate(self):
+        # keep counting across recreation after a disconnect
+        pool = super(MeteredQueuePool, self).recreate()
+        with self._lock:
+            pool.checkouts = self.checkouts
+            pool.timeouts = self.timeouts
+            pool.total_wait = self.total_wait
+            pool.max_wait = self.max_wait
+        return pool
+
+    def _do_get(self):
+        if getattr(self._getting, "active", False):
+            return super(MeteredQueuePool, self)._do_get()
+
+        self._getting.active = True
+        start = self._clock()
+        try:
+            conn = super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+        finally:
+            self._getting.active = False
+
+        wait = self._clock() - start
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return conn
+
+
+def ping_on_checkout(engine):
+    """Test connections with SELECT 1 as they are checked out of the pool.
+
+    engine may also be a Pool.
+
+    Connections the server has dropped while idle are replaced instead of
+    failing the query that gets them. The pool retries checkout up to three
+    times before giving up.
+    """
+    @event.listens_for(engine, "checkout")
+    def ping(dbapi_connection, connection_record, connection_proxy):
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception:
+            # the DB-API module, and so its exception types, vary by database
+            raise exc.DisconnectionError()
@@ -0,0 +1,88 @@
+"""Routing of read-only database work to read replicas."""
+
+from datetime import timedelta
+import threading
+import time
+
+
+class ReplicaRouter(object):
+    """Chooses a read replica for read-only database work.
+
+    Replicas are used round-robin. A replica that fails is skipped until
+    retry_after has passed, and reads go to the primary when no replica is
+    available.
+
+    Replicas lag behind the primary, so a user who just changed something
+    might not see the change on a replica. Users who wrote within
+    sticky_for keep reading from the primary. This is only known to the
+    instance that handled the write.
+    """
+
+    def __init__(self, replica_sessions, sticky_for=timedelta(seconds=5),
+                 retry_after=timedelta(seconds=30), max_writers=10000,
+                 clock=time.time):
+        self._replica_sessions = list(replica_sessions)
+        self._sticky_for = sticky_for.total_seconds()
+        self._retry_after = retry_after.total_seconds()
+        self._max_writers = max_writers
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._next = 0
+        # replica index -> time it can be tried again
+        self._failed_until = {}
+        # username -> time reads can go to replicas again
+        self._writers = {}
+
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.failures = 0
+
+    def choose(self, username=None):
+        """Return (replica, create_session) for a read by username.
+
+        Returns None if the read should go to the primary.
+        """
+        now = self._clock()
+        with self._lock:
+            if username is not None and \
+                    self._writers.get(username, 0) > now:
+                self.primary_reads += 1
+                return None
+            for _ in range(len(self._replica_sessions)):
+                replica = self._next
+                self._next = (self._next + 1) % len(self._replica_sessions)
+                if self._failed_until.get(replica, 0) <= now:
+                    self.replica_reads += 1
+                    return replica, self._replica_sessions[replica]
+            self.primary_reads += 1
+            return None
+
+    def wrote(self, username):
+        """Send username's reads to the primary until replicas catch up."""
+        now = self._clock()
+        with self._lock:
+            if len(self._writers) >= self._max_writers:
+                self._writers = dict((user, until) for user, until
+                                     in self._writers.iteritems()
+                                     if until > now)
+            self._writers[username] = now + self._sticky_for
+
+    def failed(self, replica):
+        """Stop using replica until retry_after has passed."""
+        with self._lock:
+            self.failures += 1
+            self._failed_until[replica] = self._clock() + self._retry_after
+
+    def stats(self):
+        """Return a dict of routing counters."""
+        now = self._clock()
+        with self._lock:
+            return {
+                "replicas": len(self._replica_sessions),
+                "failed_replicas": sum(1 for until
+                                       in self._failed_until.itervalues()
+                                       if until > now),
+                "replica_reads": self.replica_reads,
+                "primary_reads": self.primary_reads,
+                "failures": self.failures,
+            }
@@ -0,0 +1,223 @@
+"""Removal of old entries so the entry tables don't grow forever."""
+
+from datetime import timedelta
+import logging
+import time
+
+from sqlalchemy import and_, exists, or_
+from tornado import gen
+
+from feedreader import database
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(object):
+    """Which entries to remove.
+
+    Entries beyond the newest max_entries of their feed, or older than
+    max_age (a timedelta), are removed. Entries newer than keep_unread_for
+    that a subscriber hasn't read are kept even so. Limits that are None
+    don't apply.
+
+    If archive is True, removed entries are copied to archived_entries.
+    """
+
+    def __init__(self, max_entries=None, max_age=None, keep_unread_for=None,
+                 archive=False):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.keep_unread_for = keep_unread_for
+        self.archive = archive
+
+    @classmethod
+    def from_config(cls, options):
+        """Return the policy for a retention section of the config file."""
+        def days(name):
+            if options.get(name) is None:
+                return None
+            return timedelta(days=options[name])
+        return cls(options.get('max_entries'), days('max_age_days'),
+                   days('keep_unread_days'), options.get('archive', False))
+
+    @property
+    def enabled(self):
+        return self.max_entries is not None or self.max_age is not None
+
+    def min_date(self, now):
+        """Return the date entries older than are removed at now, or None
+           if they aren't removed for their age."""
+        if self.max_age is None:
+            return None
+        return now - self.max_age.total_seconds()
+
+
+def expiry_date(session, feed_id, policy, now):
+    """Return the date a feed's entries older than are removed by policy at
+       now however many are added, or None if there isn't one.
+
+    A new entry older than this would be removed again by the next prune,
+    so it isn't worth saving, and guids pruned before it needn't be
+    remembered.
+    """
+    dates = []
+    if policy.max_age is not None:
+        dates.append(policy.min_date(now))
+    if policy.max_entries:
+        # the oldest of the newest max_entries entries stays the oldest
+        # kept one as entries are added
+        oldest_kept = session.query(database.Entry.date)\
+            .filter(database.Entry.feed_id == feed_id)\
+            .order_by(database.Entry.date.desc(), database.Entry.id.desc())\
+            .offset(policy.max_entries - 1)\
+            .first()
+        if oldest_kept is not None:
+            dates.append(oldest_kept.date)
+    if not dates:
+        return None
+    date = max(dates)
+    if policy.keep_unread_for is not None:
+        # new entries are unread, so these are kept anyway
+        date = min(date, now - policy.keep_unread_for.total_seconds())
+    return date
+
+
+def find_expired_entries(session, feed_id, policy, now, limit):
+    """Return ids of up to limit of a feed's entries that policy removes,
+       oldest first."""
+    Entry = database.Entry
+    expired = []
+    if policy.max_entries is not None:
+        # the newest entry past the limit, found with the keyset index
+        boundary = session.query(Entry.date, Entry.id)\
+            .filter(Entry.feed_id == feed_id)\
+            .order_by(Entry.date.desc(), Entry.id.desc())\
+            .offset(policy.max_entries)\
+            .first()
+        if boundary is not None:
+            date, id_ = boundary
+            expired.append(or_(Entry.date < date,
+                               and_(Entry.date == date, Entry.id <= id_)))
+    if policy.max_age is not None:
+        expired.append(Entry.date < policy.min_date(now))
+    if not expired:
+        return []
+
+    query = session.query(Entry.id)\
+        .filter(Entry.feed_id == feed_id)\
+        .filter(or_(*expired))
+    if policy.keep_unread_for is not None:
+        subscriptions = database.subscriptions_table
+        read = database.read_table
+        # entries a subscriber hasn't read, the inner query has to be told
+        # to correlate with both outer queries
+        unread = exists()\
+            .where(subscriptions.c.feed_id == Entry.feed_id)\
+            .where(~exists().where(and_(
+                read.c.entry_id == Entry.id,
+                read.c.username == subscriptions.c.username,
+            )).correlate(Entry.__table__, subscriptions))
+        keep_after = now - policy.keep_unread_for.total_seconds()
+        query = query.filter(or_(Entry.date < keep_after, ~unread))
+    return [id_ for id_, in query.order_by(Entry.date, Entry.id)
+                                 .limit(limit)]
+
+
+def prune_batch(session, policy, now, after_feed_id, batch_size):
+    """Remove up to batch_size entries from feeds with ids after
+       after_feed_id.
+
+    Returns (removed, cursor). Pass cursor as after_feed_id to continue
+    where this left off. It is None once the last feed has been checked.
+
+    Pruned guids of entries that would be too old to be saved again are
+    forgotten.
+    """
+    feed_ids = [id_ for id_, in session.query(database.Feed.id)
+                                       .filter(database.Feed.id >
+                                               after_feed_id)
+                                       .order_by(database.Feed.id)
+                                       .limit(batch_size)]
+    archive_date = now if policy.archive else None
+
+    pruned = database.pruned_guids_table
+    removed = 0
+    for feed_id in feed_ids:
+        min_date = expiry_date(session, feed_id, policy, now)
+        if min_date is not None:
+            # save_entries skips these for their date
+            session.execute(pruned.delete()
+                            .where(pruned.c.feed_id == feed_id)
+                            .where(pruned.c.date < min_date))
+
+        limit = batch_size - removed
+        entry_ids = find_expired_entries(session, feed_id, policy, now,
+                                         limit)
+        database.delete_entries(session, feed_id, entry_ids, archive_date)
+        removed += len(entry_ids)
+        if len(entry_ids) == limit:
+            # the feed might have more, so start with it next time
+            return removed, feed_id - 1
+
+    if len(feed_ids) < batch_size:
+        return removed, None
+    return removed, feed_ids[-1]
+
+
+class Pruner(object):
+    """Applies a RetentionPolicy to every feed, a batch at a time.
+
+    Each batch is run in its own transaction with an AsyncDatabase, so
+    neither the IOLoop nor the tables are held up for long.
+    """
+
+    def __init__(self, db, policy, batch_size=500):
+        self._db = db
+        self._policy = policy
+        self._batch_size = batch_size
+        self._running = False
+
+        self.runs = 0
+        self.removed = 0
+        self.last_run_removed = 0
+
+    @gen.coroutine
+    def run(self):
+        """Check every feed once and return the number of entries removed.
+
+        Does nothing if a run is already in progress.
+        """
+        if self._running:
+            return
+        self._running = True
+        start = time.time()
+        removed = 0
+        cursor = 0
+        try:
+            while cursor is not None:
+                batch_removed, cursor = yield self._db.run(
+                    prune_batch, self._policy, int(time.time()), cursor,
+                    self._batch_size
+                )
+                removed += batch_removed
+        except Exception:
+            # nothing waits on the run, so this would be lost otherwise
+            logger.exception("Retention run failed after removing {} "
+                             "entries".format(removed))
+        finally:
+            self._running = False
+            self.runs += 1
+            self.removed += removed
+            self.last_run_removed = removed
+
+        logger.info("Retention run removed {} entries in {:.1f}s"
+                    .format(removed, time.time() - start))
+        raise gen.Return(removed)
+
+    def stats(self):
+        """Return a dict of entries removed by runs so far."""
+        return {
+            "runs": self.runs,
+            "removed": self.removed,
+            "last_run_removed": self.last_run_removed,
+        }
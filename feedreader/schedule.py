@@ -0,0 +1,107 @@
+"""How often each feed is refreshed."""
+
+from datetime import timedelta
+
+# interval for feeds that haven't been fetched by the updater yet
+DEFAULT_INTERVAL = timedelta(hours=1)
+# how many of a feed's newest entries are used to estimate how often it
+# publishes
+PUBLISH_SAMPLE = 10
+# seconds in each sy:updatePeriod
+UPDATE_PERIODS = {
+    'hourly': 60 * 60,
+    'daily': 24 * 60 * 60,
+    'weekly': 7 * 24 * 60 * 60,
+    'monthly': 30 * 24 * 60 * 60,
+    'yearly': 365 * 24 * 60 * 60,
+}
+
+
+class RefreshSchedule(object):
+    """Picks the interval until each feed's next refresh.
+
+    Feeds that publish often are refreshed about twice for each entry they
+    publish, judging by the dates of their newest entries. Each refresh
+    that finds nothing new, including not modified responses, makes the
+    interval backoff times longer, so feeds that rarely change are
+    refreshed rarely. Failed refreshes double it.
+
+    The interval is never shorter than a hint from the feed or server, and
+    is always between min_interval and max_interval. Intervals are
+    timedeltas.
+    """
+
+    def __init__(self, min_interval=timedelta(minutes=15),
+                 max_interval=timedelta(hours=24),
+                 default_interval=DEFAULT_INTERVAL, backoff=1.5):
+        self.min_interval = int(min_interval.total_seconds())
+        self.max_interval = int(max_interval.total_seconds())
+        self.default_interval = int(default_interval.total_seconds())
+        self.backoff = backoff
+
+    def next_interval(self, interval, entry_dates=(), new_entries=0,
+                      hint=None, failed=False):
+        """Return the seconds until a feed's next refresh.
+
+        interval is the feed's previous interval in seconds, or None to
+        use the default. entry_dates are the unix dates of the entries in
+        the feed and new_entries the number that weren't stored before.
+        hint is the interval in seconds the feed asked for, if any.
+        """
+        if interval is None:
+            interval = self.default_interval
+
+        if failed:
+            interval *= 2
+        elif new_entries:
+            gap = publish_interval(entry_dates)
+            if gap is not None:
+                interval = gap / 2
+            else:
+                interval /= self.backoff
+        else:
+            interval *= self.backoff
+
+        if hint is not None:
+            interval = max(interval, min(hint, self.max_interval))
+        return int(min(max(interval, self.min_interval), self.max_interval))
+
+
+def publish_interval(entry_dates):
+    """Return the median seconds between the newest entries, or None if
+       there aren't enough to tell."""
+    dates = sorted(entry_dates, reverse=True)[:PUBLISH_SAMPLE]
+    if len(dates) < 2:
+        return None
+    gaps = sorted(newer - older for newer, older in zip(dates, dates[1:]))
+    return gaps[len(gaps) // 2]
+
+
+def parse_hint(max_age=None, ttl=None, update_period=None,
+               update_frequency=None):
+    """Return the longest interval in seconds asked for by a feed's hints,
+       or None if there are none that make sense.
+
+    max_age is the Cache-Control max-age in seconds, ttl the RSS ttl in
+    minutes and update_period and update_frequency are from the
+    syndication module. They may be the strings from the feed.
+    """
+    hints = []
+    try:
+        hints.append(int(max_age))
+    except (TypeError, ValueError):
+        pass
+    try:
+        hints.append(int(ttl) * 60)
+    except (TypeError, ValueError):
+        pass
+    if update_period is not None:
+        period = UPDATE_PERIODS.get(update_period.strip().lower())
+        try:
+            frequency = int(update_frequency or 1)
+        except ValueError:
+            frequency = 1
+        if period is not None and frequency > 0:
+            hints.append(period // frequency)
+    hints = [hint for hint in hints if hint > 0]
+    return max(hints) if hints else None
@@ -2,22 +2,52 @@
 
 #pylint: disable=E0202
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import yaml
 from celery import Celery
 import celery.exceptions
 
-from feedreader import database
-from feedreader.parsed_feed import (get_parsed_feed, FeedParseError,
-                                    FeedNotModifiedError)
+from feedreader import database, http_client
+from feedreader.image_cache import HostImageCache
+from feedreader.parsed_feed import (get_parsed_feed, FeedBodyUnchangedError,
+                                    FeedParseError, FeedNotModifiedError,
+                                    FeedRateLimitedError, FETCH_TIMEOUT)
 
 
 logger = logging.getLogger(__name__)
 
 
+# seconds a batch of fetches may take after the last download starts, on top
+# of the time connecting and reading may each take
+FETCH_BATCH_MARGIN = 10
+
+
 class Tasks(object):
 
-    def __init__(self, amqp_uri=''):
+    def __init__(self, amqp_uri='', max_fetches=20,
+                 fetch_timeout=FETCH_TIMEOUT, dns_cache=None,
+                 create_session=None, host_limiter=None):
+        """Instantiate Tasks.
+
+        fetch_feeds downloads up to max_fetches feeds at once, each in its
+        own thread. Feed servers that take longer than fetch_timeout seconds
+        to respond fail.
+
+        Connections are kept open and reused for feeds and images on the
+        same host. If a DnsCache is given, its stats are logged along with
+        the connection pool's.
+
+        If create_session is given, image discovery results are cached in
+        the database for each site.
+
+        Feed downloads wait for host_limiter, an http_client.HostLimiter, so
+        hosts with many feeds aren't sent bursts of requests. A default one
+        is used if it isn't given. Downloads in a fetch_feeds batch that
+        haven't started after its max_wait, waiting for a thread or for
+        their host, are put off until the next update, and the batch's time
+        limit allows for that wait.
+        """
         self.app = Celery()
         self.app.conf.update(
             CELERY_ACCEPT_CONTENT=['json'],
@@ -39,8 +69,24 @@ class Tasks(object):
             # silence warning from pika
             logging.getLogger("pika").setLevel(logging.ERROR)
 
+        # fetching is mostly waiting on the network, so threads can keep
+        # many fetches going at once
+        self._http = http_client.create_session(max_per_host=max_fetches)
+        self._fetch_executor = ThreadPoolExecutor(max_fetches)
+        self._fetch_timeout = fetch_timeout
+        self._dns_cache = dns_cache
+        self._host_limiter = host_limiter or http_client.HostLimiter()
+        self._image_cache = None
+        if create_session is not None:
+            self._image_cache = HostImageCache(create_session)
+
         # register tasks with celery
+        self.fetch_batch_time_limit = self._host_limiter.max_wait + \
+            2 * fetch_timeout + FETCH_BATCH_MARGIN
         self.fetch_feed = self.app.task()(self.fetch_feed)
+        self.fetch_feeds = self.app.task(
+            soft_time_limit=self.fetch_batch_time_limit
+        )(self.fetch_feeds)
 
     # celery tasks
 
@@ -58,44 +104,150 @@ class Tasks(object):
               unmodified
             - entries: list of new instances of the Entry model, or empty list
               if the feed was unmodified
+            - refresh_hint: seconds the feed or server asked to wait before
+              fetching it again, or None
+            - body_unchanged: if the feed was unmodified, True if that was
+              because it was the same as the body_digest given to
+              fetch_feeds
 
         On error, returns dict containing:
             - error: description of the error
+            - refresh_hint: if the host asked for fewer requests, the
+              seconds it asked to wait
+        """
+        # Serialize manually so tests that run in eager mode cover
+        # serialization.
+        return yaml.safe_dump(self._fetch(
+            feed_url, last_modified=last_modified, etag=etag,
+            feed_id=feed_id, find_image_url=find_image_url,
+            use_discovery=use_discovery
+        ))
+
+    def fetch_feeds(self, feeds):
+        """Fetch and parse many feeds at once, without discovery.
+
+        feeds is a list of dicts containing feed_url, and optionally
+        feed_id, etag, last_modified and body_digest.
+
+        Returns a list with a result for each feed, in the same order, under
+        "results". The results are like those of fetch_feed, except feeds
+        whose download didn't start before the batch's deadline, while
+        waiting for a thread or for their host, have a result containing:
+            - deferred: True
         """
-        logger.info("Fetch feed task STARTED for '{}'".format(feed_url))
+        deadline = self._host_limiter.deadline()
+        # take turns between hosts, so threads aren't all waiting on one
+        futures = [None] * len(feeds)
+        order = http_client.interleave_by_host(
+            [feed["feed_url"] for feed in feeds]
+        )
+        for index in order:
+            feed = feeds[index]
+            futures[index] = self._fetch_executor.submit(
+                self._fetch, feed["feed_url"], feed_id=feed.get("feed_id"),
+                etag=feed.get("etag"),
+                last_modified=feed.get("last_modified"),
+                body_digest=feed.get("body_digest"),
+                find_image_url=False, use_discovery=False, deadline=deadline
+            )
+        results = []
+        timed_out = False
+        for future in futures:
+            if timed_out and not future.done():
+                future.cancel()
+                results.append({"error": "Timed out"})
+                continue
+            try:
+                results.append(future.result())
+            except celery.exceptions.SoftTimeLimitExceeded:
+                # give up on the rest of the batch, the feeds are tried again
+                # when they are next stale
+                timed_out = True
+                future.cancel()
+                results.append({"error": "Timed out"})
+            except Exception as e:
+                logger.exception("Fetching feed failed")
+                results.append({"error": str(e)})
+        logger.info("Fetched {} feeds, {}".format(len(feeds), self.stats()))
+        return yaml.safe_dump({
+            "results": results,
+        })
+
+    def stats(self):
+        """Return a dict of HTTP connection pool, host limiter and cache
+           counters."""
+        stats = {
+            "http_pool": http_client.pool_stats(self._http),
+            "hosts": self._host_limiter.stats(),
+        }
+        if self._dns_cache is not None:
+            stats["dns_cache"] = self._dns_cache.stats()
+        if self._image_cache is not None:
+            stats["image_cache"] = self._image_cache.stats()
+        return stats
+
+    # helpers
+
+    def _fetch(self, feed_url, last_modified=None, etag=None, feed_id=None,
+               find_image_url=True, use_discovery=True, body_digest=None,
+               deadline=None):
+        """Return the unserialized result of fetch_feed."""
+        logger.info("Fetching feed '{}'".format(feed_url))
 
         try:
             feed = get_parsed_feed(
                 feed_url, last_modified=last_modified, etag=etag,
-                find_image_url=find_image_url, use_discovery=use_discovery
+                find_image_url=find_image_url, use_discovery=use_discovery,
+                http=self._http, timeout=self._fetch_timeout,
+                image_cache=self._image_cache, limiter=self._host_limiter,
+                body_digest=body_digest, deadline=deadline
             )
+        except http_client.DeadlineExceededError as e:
+            # not a failure, the feed is fetched again soon
+            logger.info("Fetching feed DEFERRED for '{}': {}"
+                        .format(feed_url, e))
+            return {
+                "deferred": True,
+            }
+        except FeedRateLimitedError as e:
+            logger.info("Fetching feed FAILED for '{}': {}"
+                        .format(feed_url, e))
+            return {
+                "error": str(e),
+                "refresh_hint": e.retry_after,
+            }
         except FeedParseError as e:
-            logger.info("Fetch feed task FAILED for '{}': {}"
+            logger.info("Fetching feed FAILED for '{}': {}"
                         .format(feed_url, e))
-            return yaml.safe_dump({
+            return {
                 "error": str(e),
-            })
-        except FeedNotModifiedError:
-            logger.info("Fetch feed task SUCCEEDED for '{}': not modified"
-                        .format(feed_url))
-            return yaml.safe_dump({
+            }
+        except FeedNotModifiedError as e:
+            body_unchanged = isinstance(e, FeedBodyUnchangedError)
+            logger.info("Fetching feed SUCCEEDED for '{}': {}".format(
+                feed_url, "unchanged" if body_unchanged else "not modified"
+            ))
+            return {
                 "feed": None,
                 "entries": [],
-            })
+                "refresh_hint": e.refresh_hint,
+                "body_unchanged": body_unchanged,
+            }
         except celery.exceptions.SoftTimeLimitExceeded:
             # probably never reach this because feedparser has a try/except
             e = "Timed out"
-            logger.info("Fetch feed task FAILED for '{}': {}"
+            logger.info("Fetching feed FAILED for '{}': {}"
                         .format(feed_url, e))
-            return yaml.safe_dump({
+            return {
                 "error": str(e),
-            })
+            }
 
 
         feed_model = database.Feed(
             feed.title, feed.url, feed.link, image_url=feed.image_url,
             etag=feed.etag, last_modified=feed.last_modified,
-            last_refresh_date=feed.last_refresh_date, id=feed_id
+            last_refresh_date=feed.last_refresh_date, id=feed_id,
+            body_digest=feed.body_digest
         )
 
         entry_models = []
@@ -104,11 +256,10 @@ class Tasks(object):
                                                entry.title, entry.author,
                                                entry.date, entry.guid))
 
-        logger.info("Fetch feed task SUCCEEDED for '{}'".format(feed.url))
+        logger.info("Fetching feed SUCCEEDED for '{}'".format(feed.url))
 
-        # Serialize manually so tests that run in eager mode cover
-        # serialization.
-        return yaml.safe_dump({
+        return {
             "feed": feed_model,
             "entries": entry_models,
-        })
+            "refresh_hint": feed.refresh_hint,
+        }
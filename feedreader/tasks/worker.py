@@ -2,7 +2,9 @@ from argparse import ArgumentParser
 
 from celery.bin.worker import worker
 
+from feedreader import database
 from feedreader.config import ConnectionConfig
+from feedreader.http_client import DnsCache, HostLimiter
 from feedreader.tasks import Tasks
 
 
@@ -11,6 +13,18 @@ def get_args():
     parser.add_argument('--config', default='deploy/production.yaml',
                         help='path to connection settings yaml')
     parser.add_argument('--number', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='tasks run at once')
+    parser.add_argument('--fetches', type=int, default=20,
+                        help='feeds each task downloads at once')
+    parser.add_argument('--host-fetches', type=int, default=2,
+                        help='feeds a process downloads from one host at once')
+    parser.add_argument('--host-rate', type=float, default=1.0,
+                        help='feed downloads a process starts per second for '
+                             'one host')
+    parser.add_argument('--host-wait', type=float, default=60,
+                        help='seconds feeds in a batch may wait to be '
+                             'downloaded before being put off')
     return parser.parse_args()
 
 
@@ -18,13 +32,25 @@ def main():
     args = get_args()
     conn_config = ConnectionConfig.from_file(args.config)
     kwargs = {
-        'concurrency': 2,
+        'concurrency': args.concurrency,
         'events': True,
         'hostname': '%h.worker.{}'.format(args.number),
         'loglevel': 'info',
     }
 
-    tasks = Tasks(conn_config.amqp_uri)
+    # workers mostly fetch feeds, so all their lookups can be cached
+    dns_cache = DnsCache()
+    dns_cache.install()
+    create_session = database.connect_db(conn_config.database_uri,
+                                         conn_config.pool)
+    # each of the worker's processes gets its own copy, so a host can be
+    # sent up to concurrency times as many requests
+    host_limiter = HostLimiter(max_per_host=args.host_fetches,
+                               per_second=args.host_rate,
+                               max_wait=args.host_wait)
+    tasks = Tasks(conn_config.amqp_uri, max_fetches=args.fetches,
+                  dns_cache=dns_cache, create_session=create_session,
+                  host_limiter=host_limiter)
     worker(app=tasks.app).run(**kwargs)
 
 
@@ -10,10 +10,12 @@ import json
 import multiprocessing
 import os
 
+from sqlalchemy import event
 from tornado.testing import AsyncHTTPTestCase
 
 from feedreader import database
 from feedreader.config import ConnectionConfig, FeederConfig
+from feedreader.executor import BoundedExecutor
 import feedreader.main
 
 
@@ -89,17 +91,32 @@ class ApiTest(AsyncHTTPTestCase):
 
     def tearDown(self):
         self.s.close()
+        # let worker threads finish before the IOLoop is closed
+        for executor in self.executors:
+            executor.shutdown()
         super(ApiTest, self).tearDown()
 
     def get_app(self):
         feeder_config = FeederConfig('', False, 8080, False, 0)
         conn_config = ConnectionConfig('', 'sqlite://')
+        hash_executor = BoundedExecutor(feeder_config.hash_threads,
+                                        feeder_config.hash_queue)
+        db_executor = BoundedExecutor(feeder_config.db_threads,
+                                      feeder_config.db_queue)
+        self.executors = [hash_executor, db_executor]
 
         def hook(Session):
             self.Session = Session
-
-        return feedreader.main.get_application(feeder_config, conn_config,
-                                               db_setup_f=hook)
+            # record every SQL statement for count_queries
+            self.statements = []
+            event.listen(Session.kw['bind'], "before_cursor_execute",
+                         lambda conn, cursor, statement, *args:
+                         self.statements.append(statement))
+
+        return feedreader.main.get_application(
+            feeder_config, conn_config, db_setup_f=hook,
+            hash_executor=hash_executor, db_executor=db_executor
+        )
 
     def assert_api_call(self, api_call, headers=None, json_body=None,
                         expect_code=None, expect_json=None,
@@ -127,6 +144,34 @@ class ApiTest(AsyncHTTPTestCase):
         except ValueError:
             return None
 
+    @contextmanager
+    def count_queries(self):
+        """Context manager giving a list of SQL statements run in the block.
+
+        The list is filled in when the block exits.
+        """
+        start = len(self.statements)
+        statements = []
+        yield statements
+        statements.extend(self.statements[start:])
+
+    def add_feeds(self, count, entries_per_feed=1):
+        """Add feeds with entries and subscribe the user to them."""
+        feeds = []
+        start = self.s.query(database.Feed).count()
+        for i in range(start, start + count):
+            feed = database.Feed("Feed {}".format(i),
+                                 "http://example.com/{}.xml".format(i),
+                                 "http://example.com/{}".format(i))
+            for j in range(entries_per_feed):
+                feed.add(database.Entry("Content", None, "Entry {}".format(j),
+                                        None, 1384402853 + j,
+                                        "guid{}".format(j)))
+            self.user.subscribe(feed)
+            feeds.append(feed)
+        self.add_commit(self.user)
+        return feeds
+
     def add_commit(self, model, model_patches=None):
         """Add a model instance to the session and commit."""
         if model_patches is not None:
@@ -184,6 +229,52 @@ class ApiTest(AsyncHTTPTestCase):
                              expect_code=200,
                              expect_json={"username": TEST_USER})
 
+    ######################################################################
+    # POST /sessions/
+    ######################################################################
+
+    def test_create_session_requires_auth(self):
+        self.assert_api_call("POST /sessions", json_body={}, expect_code=401)
+
+    def test_create_session(self):
+        res = self.assert_api_call("POST /sessions", headers=self.headers,
+                                   json_body={}, expect_code=201)
+        self.assertIn("expires", res)
+        # the token can be used instead of the password
+        self.assert_api_call("GET /users", headers={
+            "Authorization": "Bearer " + res["token"],
+        }, expect_code=200, expect_json={"username": TEST_USER})
+
+    def test_create_session_with_token(self):
+        res = self.assert_api_call("POST /sessions", headers=self.headers,
+                                   json_body={}, expect_code=201)
+        self.assert_api_call("POST /sessions", headers={
+            "Authorization": "Bearer " + res["token"],
+        }, json_body={}, expect_code=401)
+
+    def test_invalid_session_token(self):
+        self.assert_api_call("GET /users", headers={
+            "Authorization": "Bearer invalid",
+        }, expect_code=401)
+
+    def test_session_token_for_deleted_user(self):
+        res = self.assert_api_call("POST /sessions", headers=self.headers,
+                                   json_body={}, expect_code=201)
+        self.add_commit(self.feed1)
+        self.s.delete(self.user)
+        self.s.commit()
+
+        # the token is still valid, but its user is gone
+        headers = {"Authorization": "Bearer " + res["token"]}
+        self.assert_api_call("GET /users", headers=headers, expect_code=401)
+        self.assert_api_call("GET /feeds", headers=headers, expect_code=401)
+        self.assert_api_call("GET /feeds/{}".format(self.feed1.id),
+                             headers=headers, expect_code=401)
+        self.assert_api_call("DELETE /feeds/{}".format(self.feed1.id),
+                             headers=headers, expect_code=401)
+        self.assert_api_call("GET /entries/1", headers=headers,
+                             expect_code=401)
+
     ######################################################################
     # GET /feeds/
     ######################################################################
@@ -248,6 +339,89 @@ class ApiTest(AsyncHTTPTestCase):
         self.assert_api_call('GET /feeds/', headers=self.headers,
                              expect_code=200, expect_json=expect_json)
 
+    def test_get_feeds_counts_each_feed(self):
+        feeds = self.add_feeds(3, entries_per_feed=3)
+        self.user.read(feeds[0].entries[0])
+        self.user.read(feeds[2].entries[0])
+        self.user.read(feeds[2].entries[1])
+        self.add_commit(self.user)
+
+        res = self.assert_api_call('GET /feeds/', headers=self.headers,
+                                   expect_code=200)
+        self.assertEqual([feed["unreads"] for feed in res["feeds"]],
+                         [2, 3, 1])
+
+    def test_get_feeds_query_count_is_constant(self):
+        self.add_feeds(1)
+        with self.count_queries() as one_feed:
+            self.assert_api_call('GET /feeds/', headers=self.headers,
+                                 expect_code=200)
+        self.add_feeds(20)
+        with self.count_queries() as many_feeds:
+            res = self.assert_api_call('GET /feeds/', headers=self.headers,
+                                       expect_code=200)
+        self.assertEqual(len(res["feeds"]), 21)
+        self.assertEqual(len(one_feed), len(many_feeds))
+
+    def get_unreads(self):
+        """Return unread counts shown by GET /feeds/, in title order."""
+        res = self.assert_api_call('GET /feeds/', headers=self.headers,
+                                   expect_code=200)
+        return [feed["unreads"] for feed in res["feeds"]]
+
+    def test_unread_counts_follow_read_state(self):
+        feed, other_feed = self.add_feeds(2, entries_per_feed=3)
+        ids = [entry.id for entry in feed.entries]
+        self.assert_api_call("PATCH /entries/{},{}".format(*ids[:2]),
+                             headers=self.headers, json_body={"read": True},
+                             expect_code=200)
+        self.assertEqual(self.get_unreads(), [1, 3])
+
+        # already unread entries don't change the count
+        self.assert_api_call("PATCH /entries/{},{}".format(*ids[1:]),
+                             headers=self.headers, json_body={"read": False},
+                             expect_code=200)
+        self.assertEqual(self.get_unreads(), [2, 3])
+
+        self.assert_api_call("PATCH /feeds/{}/entries".format(other_feed.id),
+                             headers=self.headers, json_body={"read": True},
+                             expect_code=200)
+        self.assertEqual(self.get_unreads(), [2, 0])
+
+    def test_unread_counts_follow_new_entries(self):
+        feed, = self.add_feeds(1, entries_per_feed=1)
+        feed.add_all([self.feed1_entry1, self.feed1_entry2])
+        self.add_commit(feed)
+        self.assertEqual(self.get_unreads(), [3])
+
+    def test_unread_counts_follow_subscriptions(self):
+        feed, = self.add_feeds(1, entries_per_feed=2)
+        self.user.read(feed.entries[0])
+        self.user.unsubscribe(feed)
+        self.add_commit(self.user)
+        self.assertEqual(self.s.query(database.unread_counts_table).count(),
+                         0)
+
+        # counts start from the entries that are unread when subscribing
+        self.user.subscribe(feed)
+        self.add_commit(self.user)
+        self.assertEqual(self.get_unreads(), [1])
+
+    def test_rebuild_unread_counts(self):
+        self.add_feeds(3, entries_per_feed=2)
+        self.assertEqual(database.rebuild_unread_counts(self.s), 0)
+
+        counts = database.unread_counts_table
+        self.s.execute(counts.update().values(unreads=counts.c.unreads + 5)
+                       .where(counts.c.feed_id == 1))
+        self.s.execute(counts.delete().where(counts.c.feed_id == 2))
+        self.s.commit()
+        self.assertEqual(self.get_unreads(), [7, 0, 2])
+
+        self.assertEqual(database.rebuild_unread_counts(self.s), 2)
+        self.s.commit()
+        self.assertEqual(self.get_unreads(), [2, 2, 2])
+
     ######################################################################
     # POST /feeds/
     ######################################################################
@@ -423,6 +597,73 @@ class ApiTest(AsyncHTTPTestCase):
             expect_json={"entries": [self.feed1_entry1.id]}
         )
 
+    def test_get_feed_entries_newest_first(self):
+        self.feed1_entry2.date += 60
+        self.feed1.add(self.feed1_entry1)
+        self.feed1.add(self.feed1_entry2)
+        self.user.subscribe(self.feed1)
+        self.add_commit(self.user)
+
+        self.assert_api_call(
+            "GET /feeds/{}/entries".format(self.feed1.id),
+            headers=self.headers, expect_code=200,
+            expect_json={"entries": [self.feed1_entry2.id,
+                                     self.feed1_entry1.id]}
+        )
+
+    def test_get_feed_entries_query_count_is_constant(self):
+        feed, = self.add_feeds(1, entries_per_feed=1)
+        url = "GET /feeds/{}/entries?filter=unread".format(feed.id)
+        with self.count_queries() as one_entry:
+            self.assert_api_call(url, headers=self.headers, expect_code=200)
+        for i in range(20):
+            feed.add(database.Entry("Content", None, None, None, 1384402853,
+                                    "moreguid{}".format(i)))
+        self.add_commit(feed)
+        with self.count_queries() as many_entries:
+            res = self.assert_api_call(url, headers=self.headers,
+                                       expect_code=200)
+        self.assertEqual(len(res["entries"]), 21)
+        self.assertEqual(len(one_entry), len(many_entries))
+
+    def test_get_feed_entries_pages(self):
+        feed, = self.add_feeds(1, entries_per_feed=5)
+        # entries with the same date are ordered by id
+        feed.add(database.Entry("Content", None, None, None, 1384402853,
+                                "samedate"))
+        self.add_commit(feed)
+        ids = [entry.id for entry in feed.entries.order_by(None).order_by(
+            database.Entry.date.desc(), database.Entry.id.desc())]
+
+        url = "GET /feeds/{}/entries?limit=2".format(feed.id)
+        first = self.assert_api_call(url, headers=self.headers)
+        self.assertEqual(first["entries"], ids[:2])
+        self.assertNotIn("previous", first)
+        second = self.assert_api_call(url + "&before=" + first["next"],
+                                      headers=self.headers)
+        self.assertEqual(second["entries"], ids[2:4])
+        third = self.assert_api_call(url + "&before=" + second["next"],
+                                     headers=self.headers)
+        self.assertEqual(third["entries"], ids[4:])
+        self.assertNotIn("next", third)
+
+        # and back again
+        back = self.assert_api_call(url + "&after=" + third["previous"],
+                                    headers=self.headers)
+        self.assertEqual(back, second)
+        back = self.assert_api_call(url + "&after=" + back["previous"],
+                                    headers=self.headers)
+        self.assertEqual(back["entries"], ids[:2])
+        self.assertNotIn("previous", back)
+
+    def test_get_feed_entries_invalid_page(self):
+        feed, = self.add_feeds(1)
+        url = "GET /feeds/{}/entries?".format(feed.id)
+        for query in ["limit=0", "limit=1001", "limit=x", "before=1",
+                      "after=x:1", "before=1:1&after=1:1"]:
+            self.assert_api_call(url + query, headers=self.headers,
+                                 expect_code=400)
+
     def test_get_feed_entries_invalid_filter(self):
         # add feed, subscribe to the feed
         self.user.subscribe(self.feed1)
@@ -507,6 +748,47 @@ class ApiTest(AsyncHTTPTestCase):
                                         self.feed1_entry2.id),
             headers=self.headers, expect_code=200, expect_json=expect_json)
 
+    def test_entry_content_is_only_loaded_for_entries(self):
+        feed, = self.add_feeds(1, entries_per_feed=2)
+        with self.count_queries() as listing:
+            self.assert_api_call("GET /feeds/{}/entries".format(feed.id),
+                                 headers=self.headers, expect_code=200)
+            self.assert_api_call("GET /feeds/", headers=self.headers,
+                                 expect_code=200)
+        self.assertFalse([statement for statement in listing
+                          if "entry_contents" in statement])
+
+        with self.count_queries() as getting:
+            res = self.assert_api_call(
+                "GET /entries/{}".format(feed.entries[0].id),
+                headers=self.headers, expect_code=200)
+        self.assertEqual(res["entries"][0]["content"], "Content")
+        self.assertEqual(len([statement for statement in getting
+                              if "entry_contents" in statement]), 1)
+
+    def test_get_entries_query_count_is_constant(self):
+        feeds = self.add_feeds(2, entries_per_feed=2)
+        ids = [feed.entries[0].id for feed in feeds]
+        self.user.read(feeds[0].entries[0])
+        self.add_commit(self.user)
+        with self.count_queries() as few_feeds:
+            res = self.assert_api_call(
+                "GET /entries/{}".format(",".join(map(str, ids))),
+                headers=self.headers, expect_code=200)
+        self.assertEqual([entry["id"] for entry in res["entries"]], ids)
+        self.assertEqual([entry["read"] for entry in res["entries"]],
+                         [True, False])
+
+        feeds += self.add_feeds(20, entries_per_feed=2)
+        ids = [entry.id for feed in reversed(feeds) for entry in feed.entries]
+        with self.count_queries() as many_feeds:
+            res = self.assert_api_call(
+                "GET /entries/{}".format(",".join(map(str, ids))),
+                headers=self.headers, expect_code=200)
+        # entries are returned in the order they were requested
+        self.assertEqual([entry["id"] for entry in res["entries"]], ids)
+        self.assertEqual(len(few_feeds), len(many_feeds))
+
     ######################################################################
     # PATCH /entries/ID
     ######################################################################
@@ -566,6 +848,90 @@ class ApiTest(AsyncHTTPTestCase):
                                  "read": False
                              }, expect_code=200)
 
+    def test_patch_entries_read_state(self):
+        feed, = self.add_feeds(1, entries_per_feed=3)
+        ids = [entry.id for entry in feed.entries]
+        self.user.read(feed.entries[0])
+        self.add_commit(self.user)
+
+        url = "/entries/{}".format(",".join(map(str, ids)))
+        self.assert_api_call("PATCH " + url, headers=self.headers,
+                             json_body={"read": True}, expect_code=200)
+        res = self.assert_api_call("GET " + url, headers=self.headers)
+        self.assertEqual([entry["read"] for entry in res["entries"]],
+                         [True, True, True])
+        # already read entries are not marked twice
+        self.assertEqual(self.s.query(database.read_table).count(), 3)
+
+        self.assert_api_call("PATCH /entries/{}".format(ids[1]),
+                             headers=self.headers,
+                             json_body={"read": False}, expect_code=200)
+        res = self.assert_api_call("GET " + url, headers=self.headers)
+        self.assertEqual([entry["read"] for entry in res["entries"]],
+                         [True, False, True])
+
+    def test_patch_entries_query_count_is_constant(self):
+        feed, = self.add_feeds(1, entries_per_feed=40)
+        ids = [entry.id for entry in feed.entries]
+        with self.count_queries() as few_entries:
+            self.assert_api_call(
+                "PATCH /entries/{}".format(",".join(map(str, ids[:2]))),
+                headers=self.headers, json_body={"read": True},
+                expect_code=200)
+        with self.count_queries() as many_entries:
+            self.assert_api_call(
+                "PATCH /entries/{}".format(",".join(map(str, ids))),
+                headers=self.headers, json_body={"read": True},
+                expect_code=200)
+        self.assertEqual(len(few_entries), len(many_entries))
+        self.assertEqual(self.s.query(database.read_table).count(), 40)
+
+    ######################################################################
+    # PATCH /feeds/ID/entries
+    ######################################################################
+
+    def test_patch_feed_entries_requires_auth(self):
+        self.assert_api_call("PATCH /feeds/1/entries",
+                             json_body={"read": True}, expect_code=401)
+
+    def test_patch_feed_entries_not_subbed(self):
+        self.add_commit(self.feed1)
+        self.assert_api_call("PATCH /feeds/{}/entries".format(self.feed1.id),
+                             headers=self.headers, json_body={"read": True},
+                             expect_code=404)
+
+    def test_patch_feed_entries_read(self):
+        feed, other_feed = self.add_feeds(2, entries_per_feed=2)
+        self.assert_api_call("PATCH /feeds/{}/entries".format(feed.id),
+                             headers=self.headers, json_body={"read": True},
+                             expect_code=200)
+        self.assert_api_call("GET /feeds/{}/entries?filter=unread"
+                             .format(feed.id), headers=self.headers,
+                             expect_json={"entries": []})
+        # other feeds are not affected
+        self.assert_api_call("GET /feeds/{}/entries?filter=read"
+                             .format(other_feed.id), headers=self.headers,
+                             expect_json={"entries": []})
+
+    def test_patch_feed_entries_until(self):
+        feed, = self.add_feeds(1, entries_per_feed=3)
+        oldest, middle, newest = sorted(feed.entries, key=lambda e: e.date)
+        self.assert_api_call("PATCH /feeds/{}/entries".format(feed.id),
+                             headers=self.headers,
+                             json_body={"read": True, "until": middle.date},
+                             expect_code=200)
+        self.assert_api_call("GET /feeds/{}/entries?filter=unread"
+                             .format(feed.id), headers=self.headers,
+                             expect_json={"entries": [newest.id]})
+
+        self.assert_api_call("PATCH /feeds/{}/entries".format(feed.id),
+                             headers=self.headers,
+                             json_body={"read": False, "until": oldest.date},
+                             expect_code=200)
+        self.assert_api_call("GET /feeds/{}/entries?filter=read"
+                             .format(feed.id), headers=self.headers,
+                             expect_json={"entries": [middle.id]})
+
     ######################################################################
     # GET /feeds/ID
     ######################################################################
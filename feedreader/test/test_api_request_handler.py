@@ -1,13 +1,19 @@
 """Tests for APIRequestHandler."""
 
+from datetime import timedelta
+from tornado import gen
 from tornado.testing import AsyncHTTPTestCase
-from tornado.web import Application
+from tornado.web import Application, asynchronous
 import base64
 import json
 import pbkdf2
+import threading
 
 from feedreader import database
 from feedreader.api_request_handler import APIRequestHandler
+from feedreader.async_database import AsyncDatabase
+from feedreader.auth import CredentialCache
+from feedreader.executor import BoundedExecutor
 
 
 def get_basic_auth(user, passwd, method="Basic"):
@@ -15,11 +21,15 @@ def get_basic_auth(user, passwd, method="Basic"):
                           base64.b64encode("{}:{}".format(user, passwd)))
 
 
-def get_application(handler):
+def get_application(handler, credential_cache=None, hash_executor=None,
+                    db_executor=None, db_timeout=None):
     """Return Tornado application with demo user."""
     create_session = database.initialize_db('sqlite://')
-    app = Application([("/", handler, dict(create_session=create_session,
-                                           tasks=None, celery_poller=None))])
+    db = AsyncDatabase(create_session, db_executor, db_timeout)
+    app = Application([("/", handler, dict(
+        create_session=create_session, tasks=None, celery_poller=None,
+        credential_cache=credential_cache, hash_executor=hash_executor, db=db
+    ))])
     session = create_session()
     # TODO: better way of creating the demo user
     session.add(database.User("demo", pbkdf2.crypt("demo")))
@@ -83,6 +93,128 @@ class AuthorizationTest(AsyncHTTPTestCase):
         self.assert_auth_failed(response)
 
 
+class CachedAuthorizationTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.cache = CredentialCache()
+        return get_application(AuthorizationTestHandler, self.cache)
+
+    def test_repeated_auth_uses_cache(self):
+        for _ in range(3):
+            response = self.fetch('/', headers={
+                "Authorization": get_basic_auth("demo", "demo"),
+            })
+            self.assertEqual(response.code, 200)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+        self.assertEqual(self.cache.stats()["hits"], 2)
+
+    def test_invalid_password_after_cached_auth(self):
+        response = self.fetch('/', headers={
+            "Authorization": get_basic_auth("demo", "demo"),
+        })
+        self.assertEqual(response.code, 200)
+        response = self.fetch('/', headers={
+            "Authorization": get_basic_auth("demo", "invalid"),
+        })
+        self.assertEqual(response.code, 401)
+
+
+class AsyncAuthorizationTestHandler(APIRequestHandler):
+
+    @asynchronous
+    @gen.coroutine
+    def get(self):
+        username = yield self.authenticate()
+        self.write("ok")
+
+
+class AsyncAuthorizationTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.executor = BoundedExecutor(1, 0)
+        return get_application(AsyncAuthorizationTestHandler,
+                               hash_executor=self.executor)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super(AsyncAuthorizationTest, self).tearDown()
+
+    def test_successfull_auth(self):
+        response = self.fetch('/', headers={
+            "Authorization": get_basic_auth("demo", "demo"),
+        })
+        self.assertEqual(response.code, 200)
+
+    def test_invalid_password(self):
+        response = self.fetch('/', headers={
+            "Authorization": get_basic_auth("demo", "invalid"),
+        })
+        self.assertEqual(response.code, 401)
+
+    def test_executor_saturated(self):
+        # occupy the only hashing thread
+        event = threading.Event()
+        self.executor.submit(event.wait)
+        try:
+            response = self.fetch('/', headers={
+                "Authorization": get_basic_auth("demo", "demo"),
+            })
+        finally:
+            event.set()
+        self.assertEqual(response.code, 503)
+
+
+class DatabaseTestHandler(APIRequestHandler):
+
+    @asynchronous
+    @gen.coroutine
+    def get(self):
+        def count_users(session):
+            return session.query(database.User).count()
+        count = yield self.run_db(count_users)
+        self.write(str(count))
+
+
+class DatabaseTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.executor = BoundedExecutor(1, 1)
+        return get_application(DatabaseTestHandler,
+                               db_executor=self.executor,
+                               db_timeout=timedelta(seconds=0.05))
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super(DatabaseTest, self).tearDown()
+
+    def test_run_db(self):
+        response = self.fetch('/')
+        self.assertEqual(response.body, "1")
+
+    def test_executor_saturated(self):
+        # occupy the only database thread and queue slot
+        event = threading.Event()
+        self.executor.submit(event.wait)
+        self.executor.submit(event.wait)
+        try:
+            response = self.fetch('/')
+        finally:
+            event.set()
+        self.assertEqual(response.code, 503)
+
+    def test_timeout(self):
+        # the query waits behind a call that outlasts the timeout
+        event = threading.Event()
+        self.executor.submit(event.wait)
+        try:
+            response = self.fetch('/')
+        finally:
+            event.set()
+        self.assertEqual(response.code, 503)
+        self.assertIn("timed out",
+                      json.loads(response.body)["error"]["message"])
+
+
 class ValidationTestHandler(APIRequestHandler):
 
     def post(self):
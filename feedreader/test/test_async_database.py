@@ -0,0 +1,115 @@
+"""Tests for AsyncDatabase."""
+
+from datetime import timedelta
+import threading
+import time
+
+import pytest
+from sqlalchemy import event
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from feedreader import database
+from feedreader.async_database import AsyncDatabase, DatabaseTimeoutError
+from feedreader.executor import BoundedExecutor
+from feedreader.replicas import ReplicaRouter
+
+
+@pytest.fixture
+def create_session():
+    return database.initialize_db('sqlite://')
+
+
+def add_user(session, username):
+    session.add(database.User(username, "hash"))
+
+
+def count_users(session):
+    return session.query(database.User).count()
+
+
+def test_run_commits(create_session):
+    db = AsyncDatabase(create_session)
+    db.run(add_user, "demo").result()
+    assert db.run(count_users).result() == 1
+
+
+def test_run_rolls_back_on_error(create_session):
+    def fail(session):
+        add_user(session, "demo")
+        raise ValueError
+    db = AsyncDatabase(create_session)
+    with pytest.raises(ValueError):
+        db.run(fail).result()
+    assert db.run(count_users).result() == 0
+
+
+def test_run_in_executor(create_session):
+    executor = BoundedExecutor(2, 0)
+    db = AsyncDatabase(create_session, executor, timedelta(seconds=5))
+
+    @gen.coroutine
+    def run():
+        yield [db.run(add_user, "demo1"), db.run(add_user, "demo2")]
+        count = yield db.run(count_users)
+        raise gen.Return(count)
+    assert IOLoop().run_sync(run) == 2
+    executor.shutdown()
+    assert db.stats()["submitted"] == 3
+
+
+def test_run_timeout(create_session):
+    finish = threading.Event()
+
+    def slow_add_user(session):
+        add_user(session, "demo")
+        finish.wait()
+
+    executor = BoundedExecutor(1, 0)
+    db = AsyncDatabase(create_session, executor, timedelta(seconds=0.01))
+    with pytest.raises(DatabaseTimeoutError):
+        IOLoop().run_sync(lambda: db.run(slow_add_user))
+    finish.set()
+    executor.shutdown()
+    assert db.stats()["timeouts"] == 1
+    # the call finished after timing out, so it wasn't committed
+    assert AsyncDatabase(create_session).run(count_users).result() == 0
+
+
+def test_run_read_only_on_replica(create_session):
+    replica = database.initialize_db('sqlite://')
+    AsyncDatabase(replica).run(add_user, "demo").result()
+    db = AsyncDatabase(create_session, router=ReplicaRouter([replica]))
+    assert db.run_read_only("demo", count_users).result() == 1
+
+    # users that just wrote read from the primary
+    db.wrote("demo")
+    assert db.run_read_only("demo", count_users).result() == 0
+
+
+def test_run_read_only_replica_failure(create_session, tmpdir):
+    # sqlite can't create a database in a directory that doesn't exist
+    replica = database.connect_replica(
+        'sqlite:///' + str(tmpdir.join('missing', 'replica.db')))
+    router = ReplicaRouter([replica])
+    db = AsyncDatabase(create_session, router=router)
+    db.run(add_user, "demo").result()
+    assert db.run_read_only(None, count_users).result() == 1
+    assert router.stats()["failed_replicas"] == 1
+
+
+def test_run_timeout_while_committing(create_session):
+    def create_slow_session():
+        session = create_session()
+        event.listen(session, 'before_commit',
+                     lambda session: time.sleep(0.05))
+        return session
+
+    executor = BoundedExecutor(1, 0)
+    db = AsyncDatabase(create_slow_session, executor,
+                       timedelta(seconds=0.01))
+    # the timeout passes during the commit, which still succeeds
+    IOLoop().run_sync(lambda: db.run(add_user, "demo"))
+    executor.shutdown()
+    assert db.stats()["timeouts"] == 0
+    assert AsyncDatabase(create_session).run(count_users).result() == 1
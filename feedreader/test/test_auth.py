@@ -0,0 +1,108 @@
+"""Tests for authentication helpers."""
+
+from datetime import timedelta
+import base64
+import pytest
+
+from feedreader.auth import CredentialCache, SessionTokens
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_credential_cache_hit():
+    cache = CredentialCache()
+    assert not cache.is_verified("demo", "demo", "hash")
+    cache.add("demo", "demo", "hash")
+    assert cache.is_verified("demo", "demo", "hash")
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1,
+                             "evictions": 0}
+
+
+def test_credential_cache_wrong_password():
+    cache = CredentialCache()
+    cache.add("demo", "demo", "hash")
+    assert not cache.is_verified("demo", "invalid", "hash")
+
+
+def test_credential_cache_password_changed():
+    cache = CredentialCache()
+    cache.add("demo", "demo", "hash")
+    assert not cache.is_verified("demo", "demo", "newhash")
+    # the stale entry is dropped
+    assert not cache.is_verified("demo", "demo", "hash")
+
+
+def test_credential_cache_expiry():
+    clock = FakeClock()
+    cache = CredentialCache(ttl=timedelta(seconds=60), clock=clock)
+    cache.add("demo", "demo", "hash")
+    clock.now += 59
+    assert cache.is_verified("demo", "demo", "hash")
+    clock.now += 1
+    assert not cache.is_verified("demo", "demo", "hash")
+    assert cache.stats()["size"] == 0
+
+
+def test_credential_cache_bounded():
+    cache = CredentialCache(max_size=2)
+    cache.add("a", "a", "hash")
+    cache.add("b", "b", "hash")
+    cache.add("c", "c", "hash")
+    assert cache.stats()["evictions"] == 1
+    assert not cache.is_verified("a", "a", "hash")
+    assert cache.is_verified("c", "c", "hash")
+
+
+def test_credential_cache_invalidate():
+    cache = CredentialCache()
+    cache.add("demo", "demo", "hash")
+    cache.add("other", "other", "hash")
+    cache.invalidate("demo")
+    assert not cache.is_verified("demo", "demo", "hash")
+    assert cache.is_verified("other", "other", "hash")
+
+
+def test_session_token_roundtrip():
+    tokens = SessionTokens("secret")
+    token, expiry = tokens.create("demo")
+    assert tokens.verify(token) == "demo"
+
+
+def test_session_token_expiry():
+    clock = FakeClock()
+    tokens = SessionTokens("secret", lifetime=timedelta(seconds=60),
+                           clock=clock)
+    token, expiry = tokens.create("demo")
+    assert expiry == clock.now + 60
+    clock.now += 60
+    with pytest.raises(ValueError):
+        tokens.verify(token)
+
+
+def test_session_token_wrong_secret():
+    token, expiry = SessionTokens("secret").create("demo")
+    with pytest.raises(ValueError):
+        SessionTokens("other").verify(token)
+
+
+def test_session_token_tampered():
+    tokens = SessionTokens("secret")
+    token, expiry = tokens.create("demo")
+    signature = token.split(".", 1)[1]
+    forged = base64.urlsafe_b64encode("{}:other".format(expiry))
+    with pytest.raises(ValueError):
+        tokens.verify("{}.{}".format(forged, signature))
+
+
+def test_session_token_malformed():
+    tokens = SessionTokens("secret")
+    for token in ["", "nodot", "!!!.!!!", base64.urlsafe_b64encode("x") + ".x"]:
+        with pytest.raises(ValueError):
+            tokens.verify(token)
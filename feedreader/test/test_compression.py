@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for compressed text storage."""
+
+from feedreader.compression import (compress_text, decompress_text,
+                                    is_compressed, COMPRESSED_MARKER)
+
+
+HTML = u"<p>Ünïcode paragraph with <a href='#'>a link</a>.</p>\n" * 50
+
+
+def test_round_trip():
+    data = compress_text(HTML)
+    assert is_compressed(data)
+    assert len(data) < len(HTML.encode('utf-8'))
+    assert decompress_text(data) == HTML
+
+
+def test_short_text_is_not_compressed():
+    data = compress_text(u"short")
+    assert not is_compressed(data)
+    assert decompress_text(data) == u"short"
+
+
+def test_none():
+    assert compress_text(None) is None
+    assert decompress_text(None) is None
+
+
+def test_plain_utf8_is_read():
+    assert decompress_text(HTML.encode('utf-8')) == HTML
+
+
+def test_text_starting_with_marker():
+    text = COMPRESSED_MARKER.decode('utf-8') + u"x"
+    assert decompress_text(compress_text(text)) == text
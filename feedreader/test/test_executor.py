@@ -0,0 +1,29 @@
+"""Tests for BoundedExecutor."""
+
+import pytest
+import threading
+
+from feedreader.executor import BoundedExecutor, ExecutorSaturatedError
+
+
+def test_submit():
+    executor = BoundedExecutor(1, 0)
+    assert executor.submit(lambda x: x * 2, 21).result() == 42
+    executor.shutdown()
+    assert executor.stats() == {"pending": 0, "submitted": 1, "rejected": 0}
+
+
+def test_saturated():
+    executor = BoundedExecutor(1, 1)
+    event = threading.Event()
+    running = executor.submit(event.wait)
+    queued = executor.submit(event.wait)
+    with pytest.raises(ExecutorSaturatedError):
+        executor.submit(event.wait)
+    assert executor.stats()["rejected"] == 1
+    event.set()
+    running.result()
+    queued.result()
+    executor.shutdown()
+    # there is room again once calls finish
+    assert executor.stats()["pending"] == 0
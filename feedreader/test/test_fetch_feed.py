@@ -5,6 +5,9 @@ from os import path
 import yaml
 import logging
 
+from feedreader import database
+from feedreader.fingerprint import fingerprint
+from feedreader.http_client import HostLimiter
 from feedreader.tasks.core import Tasks
 
 
@@ -16,7 +19,8 @@ logging.getLogger().setLevel(logging.DEBUG)
 
 @pytest.fixture
 def tasks():
-    return Tasks(amqp_uri='')
+    # no need to be polite to httpretty
+    return Tasks(amqp_uri='', host_limiter=HostLimiter(per_second=1000))
 
 
 def test_connection_refused(tasks):
@@ -87,7 +91,9 @@ def test_awesome_blog(tasks):
     assert res["entries"][0].author == None
     assert res["entries"][0].date == 1384934400
     assert res["entries"][0].content.startswith("<p>Yesterday, ")
-    assert res["entries"][0].guid == "57785a2b321c948508451096cb98f23a2a697c01"
+    # guids are kept as fingerprints of the feed's guid hash
+    assert res["entries"][0].guid == \
+        fingerprint("57785a2b321c948508451096cb98f23a2a697c01")
 
     httpretty.disable()
     httpretty.reset()
@@ -126,3 +132,129 @@ def test_awesome_blog_favicon(tasks):
 
     httpretty.disable()
     httpretty.reset()
+
+
+def test_fetch_feeds(tasks):
+    httpretty.enable()
+    feed = open(path.join(TEST_DATA_DIR, "awesome-blog.xml")).read()
+    httpretty.register_uri(httpretty.GET, "http://example.com/feed.xml",
+                           body=feed, content_type="application/atom+xml",
+                           adding_headers={"Cache-Control": "max-age=900"})
+    httpretty.register_uri(httpretty.GET, "http://example.com/old.xml",
+                           status=304)
+    httpretty.register_uri(httpretty.GET, "http://example.com/gone.xml",
+                           status=404)
+
+    res = yaml.safe_load(tasks.fetch_feeds.delay([
+        {"feed_url": "http://example.com/feed.xml", "feed_id": 1},
+        {"feed_url": "http://example.com/old.xml", "etag": "foo"},
+        {"feed_url": "http://example.com/gone.xml"},
+    ]).get())
+
+    feed_res, old_res, gone_res = res["results"]
+    assert feed_res["feed"].id == 1
+    assert feed_res["entries"][0].title == "Return of the OPPO Find 5"
+    assert feed_res["refresh_hint"] == 900
+    assert old_res == {"feed": None, "entries": [], "refresh_hint": None,
+                       "body_unchanged": False}
+    assert "error" in gone_res
+
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_favicon_cached_for_site():
+    tasks = Tasks(amqp_uri='', create_session=database.initialize_db(),
+                  host_limiter=HostLimiter(per_second=1000))
+    httpretty.enable()
+    favicon_url = "http://localhost:8081/favicon.ico"
+    feed = open(path.join(TEST_DATA_DIR, "awesome-blog.xml")).read()
+    for feed_url in ["http://example.com/feed.xml",
+                     "http://example.com/other.xml"]:
+        httpretty.register_uri(httpretty.GET, feed_url,
+                               body=feed, content_type="application/atom+xml")
+    httpretty.register_uri(httpretty.HEAD, favicon_url, body="foo",
+                           content_type="image/ico")
+
+    for feed_url in ["http://example.com/feed.xml",
+                     "http://example.com/other.xml"]:
+        res = yaml.safe_load(tasks.fetch_feed.delay(feed_url).get())
+        assert res["feed"].image_url == favicon_url
+
+    # the feeds share a site, so its favicon was only checked once
+    methods = [request.method for request in httpretty.latest_requests()]
+    assert methods == ["GET", "HEAD", "GET"]
+
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_rate_limited(tasks):
+    httpretty.enable()
+    for feed_url in ["http://example.com/feed.xml",
+                     "http://example.com/other.xml"]:
+        httpretty.register_uri(httpretty.GET, feed_url, status=429,
+                               adding_headers={"Retry-After": "300"})
+
+    # the host isn't asked again until it said to
+    for feed_url in ["http://example.com/feed.xml",
+                     "http://example.com/other.xml"]:
+        res = yaml.safe_load(tasks.fetch_feed.delay(feed_url).get())
+        assert res["error"] == "Rate limited, retry after 300s"
+        assert 299 <= res["refresh_hint"] <= 300
+    assert len(httpretty.latest_requests()) == 1
+    assert tasks.stats()["hosts"]["blocked_hosts"] == 1
+
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_fetch_feeds_unchanged_body(tasks):
+    httpretty.enable()
+    feed = open(path.join(TEST_DATA_DIR, "awesome-blog.xml")).read()
+    httpretty.register_uri(httpretty.GET, "http://example.com/feed.xml",
+                           body=feed, content_type="application/atom+xml")
+
+    def fetch(body_digest):
+        res = yaml.safe_load(tasks.fetch_feeds.delay([{
+            "feed_url": "http://example.com/feed.xml",
+            "body_digest": body_digest,
+        }]).get())
+        return res["results"][0]
+
+    digest = fetch(None)["feed"].body_digest
+    assert digest is not None
+    res = fetch(digest)
+    assert res["feed"] is None
+    assert res["body_unchanged"]
+    # a different body is parsed as usual
+    assert fetch("0" * 40)["feed"].body_digest == digest
+
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_fetch_feeds_deferred_after_deadline():
+    # one feed at a time, and none after the deadline has passed
+    tasks = Tasks(amqp_uri='', host_limiter=HostLimiter(per_second=0.001,
+                                                        max_wait=0.05))
+    httpretty.enable()
+    feed = open(path.join(TEST_DATA_DIR, "awesome-blog.xml")).read()
+    for name in ["a", "b", "c"]:
+        httpretty.register_uri(httpretty.GET,
+                               "http://example.com/{}.xml".format(name),
+                               body=feed, content_type="application/atom+xml")
+
+    res = yaml.safe_load(tasks.fetch_feeds.delay([
+        {"feed_url": "http://example.com/{}.xml".format(name)}
+        for name in ["a", "b", "c"]
+    ]).get())
+
+    # the host had two turns, the other feed is put off without failing
+    deferred = [result for result in res["results"] if "deferred" in result]
+    assert deferred == [{"deferred": True}]
+    assert sum(1 for result in res["results"] if "feed" in result) == 2
+    assert tasks.fetch_batch_time_limit == 0.05 + 2 * 10 + 10
+
+    httpretty.disable()
+    httpretty.reset()
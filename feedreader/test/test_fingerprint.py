@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for string fingerprints."""
+
+from feedreader import database
+from feedreader.fingerprint import fingerprint
+
+
+def test_fingerprint():
+    key = fingerprint("guid")
+    assert isinstance(key, (int, long))
+    assert -2 ** 63 <= key < 2 ** 63
+    assert fingerprint(u"guid") == key
+    assert fingerprint("other") != key
+    # unicode is fingerprinted as UTF-8
+    assert fingerprint(u"ünïcode") == \
+        fingerprint(u"ünïcode".encode('utf-8'))
+
+
+def test_fingerprint_passes_through_fingerprints():
+    assert fingerprint(fingerprint("guid")) == fingerprint("guid")
+    assert fingerprint(None) is None
+
+
+def test_query_by_string():
+    session = database.initialize_db('sqlite://')()
+    feed = database.Feed("Feed", "http://example.com/feed.xml", None)
+    feed.add(database.Entry(None, None, None, None, 0, "guid"))
+    session.add(feed)
+    session.commit()
+
+    entry = session.query(database.Entry).filter_by(guid="guid").one()
+    assert entry.guid == fingerprint("guid")
+    assert session.query(database.Entry)\
+                  .filter(database.Entry.guid.in_(["guid", "other"]))\
+                  .count() == 1
+    session.close()
@@ -0,0 +1,192 @@
+"""Tests for the shared HTTP client."""
+
+from datetime import timedelta
+import socket
+import threading
+import time
+
+import httpretty
+import pytest
+
+from feedreader.http_client import (create_session, interleave_by_host,
+                                    pool_stats, DeadlineExceededError,
+                                    DnsCache, HostBlockedError, HostLimiter)
+
+
+class FakeResolver(object):
+
+    def __init__(self):
+        self.lookups = []
+        self.fail = False
+
+    def __call__(self, host, port, *args, **kwargs):
+        self.lookups.append(host)
+        if self.fail:
+            raise socket.gaierror("Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                 ('127.0.0.1', port))]
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_dns_cache():
+    resolver = FakeResolver()
+    clock = FakeClock()
+    cache = DnsCache(ttl=timedelta(seconds=60), clock=clock,
+                     resolve=resolver)
+
+    first = cache.getaddrinfo("example.com", 80)
+    assert cache.getaddrinfo("example.com", 80) == first
+    assert resolver.lookups == ["example.com"]
+
+    # expired lookups are made again
+    clock.now += 61
+    cache.getaddrinfo("example.com", 80)
+    assert resolver.lookups == ["example.com"] * 2
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 2}
+
+
+def test_dns_cache_keyword_arguments():
+    resolver = FakeResolver()
+    cache = DnsCache(resolve=resolver)
+    cache.getaddrinfo("example.com", 80, family=socket.AF_INET)
+    cache.getaddrinfo("example.com", 80, family=socket.AF_INET)
+    # different arguments are looked up separately
+    cache.getaddrinfo("example.com", 80, type=socket.SOCK_STREAM)
+    cache.getaddrinfo("example.com", 80)
+    assert resolver.lookups == ["example.com"] * 3
+
+
+def test_dns_cache_failures_not_cached():
+    resolver = FakeResolver()
+    cache = DnsCache(resolve=resolver)
+    resolver.fail = True
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.getaddrinfo("example.com", 80)
+    assert len(resolver.lookups) == 2
+    assert cache.stats()["size"] == 0
+
+
+def test_dns_cache_max_size():
+    resolver = FakeResolver()
+    cache = DnsCache(max_size=2, resolve=resolver)
+    for host in ["a.com", "b.com", "c.com", "c.com", "a.com"]:
+        cache.getaddrinfo(host, 80)
+    # a.com was the oldest, so it was dropped for c.com
+    assert resolver.lookups == ["a.com", "b.com", "c.com", "a.com"]
+    assert cache.stats()["size"] == 2
+
+
+def test_session_pool_stats():
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, "http://example.com/feed.xml",
+                           body="feed")
+    httpretty.register_uri(httpretty.GET, "http://example.org/feed.xml",
+                           body="feed")
+    session = create_session(max_hosts=10, max_per_host=2)
+    assert pool_stats(session) == {"hosts": 0, "connections": 0,
+                                   "requests": 0}
+
+    for url in ["http://example.com/feed.xml", "http://example.com/feed.xml",
+                "http://example.org/feed.xml"]:
+        session.get(url)
+
+    stats = pool_stats(session)
+    assert stats["hosts"] == 2
+    assert stats["requests"] == 3
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_host_limiter_concurrency():
+    limiter = HostLimiter(max_per_host=2, per_second=1000)
+    active = []
+    peaks = []
+    lock = threading.Lock()
+
+    def fetch(host, path):
+        with limiter.request("http://{}/{}".format(host, path)):
+            with lock:
+                active.append(host)
+                peaks.append(active.count(host))
+            time.sleep(0.02)
+            with lock:
+                active.remove(host)
+
+    threads = [threading.Thread(target=fetch, args=args) for args in
+               [("example.com", "a"), ("example.com", "b"),
+                ("example.com", "c"), ("example.org", "a")]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peaks) == 2
+    stats = limiter.stats()
+    assert stats["hosts"] == 2
+    assert stats["waits"] > 0
+    assert stats["queues"] == {}
+
+
+def test_host_limiter_rate():
+    limiter = HostLimiter(max_per_host=2, per_second=20)
+    start = time.time()
+    for _ in range(4):
+        with limiter.request("http://example.com/feed.xml"):
+            pass
+    # two requests could start at once, the others each waited 50ms
+    assert time.time() - start >= 0.09
+    with limiter.request("http://example.org/feed.xml"):
+        pass
+
+
+def test_host_limiter_block():
+    clock = FakeClock()
+    limiter = HostLimiter(clock=clock)
+    limiter.block("http://example.com/a.xml", 120)
+
+    with pytest.raises(HostBlockedError) as e:
+        with limiter.request("http://example.com/b.xml"):
+            pass
+    assert e.value.retry_after == 120
+    assert limiter.stats()["blocked_hosts"] == 1
+
+    clock.now += 121
+    with limiter.request("http://example.com/b.xml"):
+        pass
+    assert limiter.stats()["blocked"] == 1
+
+
+def test_host_limiter_deadline():
+    limiter = HostLimiter(max_per_host=1, per_second=1000, max_wait=0.05)
+    deadline = limiter.deadline()
+    with limiter.request("http://example.com/a.xml", deadline):
+        # the host's only slot is taken until after the deadline
+        start = time.time()
+        with pytest.raises(DeadlineExceededError):
+            with limiter.request("http://example.com/b.xml", deadline):
+                pass
+        assert time.time() - start < 1
+    # nothing starts after the deadline, even if the host is free
+    time.sleep(0.05)
+    with pytest.raises(DeadlineExceededError):
+        with limiter.request("http://example.org/a.xml", deadline):
+            pass
+    assert limiter.stats()["late"] == 2
+
+
+def test_interleave_by_host():
+    urls = ["http://a.com/1", "http://a.com/2", "http://a.com/3",
+            "http://b.com/1", "http://c.com/1", "http://b.com/2"]
+    assert [urls[i] for i in interleave_by_host(urls)] == [
+        "http://a.com/1", "http://b.com/1", "http://c.com/1",
+        "http://a.com/2", "http://b.com/2", "http://a.com/3",
+    ]
@@ -0,0 +1,57 @@
+"""Tests for the site image cache."""
+
+from datetime import timedelta
+
+import pytest
+
+from feedreader import database
+from feedreader.image_cache import HostImageCache
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def cache(clock):
+    return HostImageCache(database.initialize_db('sqlite://'),
+                          found_ttl=timedelta(days=7),
+                          missing_ttl=timedelta(days=1), clock=clock)
+
+
+def test_found(cache, clock):
+    assert cache.lookup("http://example.com") == (False, None)
+    cache.add("http://example.com", "http://example.com/favicon.ico")
+    assert cache.lookup("http://example.com") == \
+        (True, "http://example.com/favicon.ico")
+    assert cache.lookup("https://example.com") == (False, None)
+
+    clock.now += timedelta(days=7).total_seconds()
+    assert cache.lookup("http://example.com") == (False, None)
+    assert cache.stats() == {"hits": 1, "misses": 3}
+
+
+def test_missing(cache, clock):
+    cache.add("http://example.com", None)
+    assert cache.lookup("http://example.com") == (True, None)
+
+    # sites without an image are checked again sooner
+    clock.now += timedelta(days=1).total_seconds()
+    assert cache.lookup("http://example.com") == (False, None)
+
+
+def test_replace(cache):
+    cache.add("http://example.com", None)
+    cache.add("http://example.com", "http://example.com/favicon.ico")
+    assert cache.lookup("http://example.com") == \
+        (True, "http://example.com/favicon.ico")
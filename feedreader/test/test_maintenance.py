@@ -0,0 +1,53 @@
+"""Tests for database maintenance commands."""
+
+import pytest
+from sqlalchemy import select, type_coerce, LargeBinary
+
+from feedreader import database, maintenance
+from feedreader.compression import is_compressed
+
+
+HTML = u"<p>A paragraph of entry content.</p>\n" * 20
+
+
+@pytest.fixture
+def session(request):
+    session = database.initialize_db('sqlite://')()
+    request.addfinalizer(session.close)
+    feed = database.Feed("Feed", "http://example.com/feed.xml", None)
+    feed.add_all(database.Entry(HTML, None, None, None, 0, str(guid))
+                 for guid in range(3))
+    session.add(feed)
+    session.commit()
+    return session
+
+
+def stored_contents(session):
+    contents = database.EntryContent.__table__
+    return [data for data, in session.execute(
+        select([type_coerce(contents.c.content, LargeBinary)])
+    )]
+
+
+def test_compress_entry_contents(session):
+    # store content the way it was before compression
+    session.execute(database.EntryContent.__table__.update()
+                    .values(content=type_coerce(HTML.encode('utf-8'),
+                                                LargeBinary)))
+    session.commit()
+    assert not any(is_compressed(data) for data in stored_contents(session))
+
+    assert maintenance.compress_entry_contents(session, batch_size=2) == 3
+    assert all(is_compressed(data) for data in stored_contents(session))
+    assert [entry.content for entry in session.query(database.Entry)] == \
+        [HTML] * 3
+
+    # already compressed content is left alone
+    assert maintenance.compress_entry_contents(session) == 0
+
+
+def test_benchmark_compression(session):
+    results = maintenance.benchmark_compression(session)
+    assert results["entries"] == 3
+    assert results["raw_bytes"] == 3 * len(HTML)
+    assert results["stored_bytes"] < results["raw_bytes"]
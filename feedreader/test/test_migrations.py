@@ -0,0 +1,198 @@
+"""Tests for schema migrations."""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+from sqlalchemy import create_engine, inspect, BigInteger
+
+from feedreader import database, migrations
+from feedreader.fingerprint import fingerprint
+
+
+# schema from before migrations were versioned
+BASELINE_SCHEMA = [
+    """CREATE TABLE users (
+        username VARCHAR(100) NOT NULL,
+        password_hash VARCHAR(2048) NOT NULL,
+        PRIMARY KEY (username)
+    )""",
+    """CREATE TABLE feeds (
+        id INTEGER NOT NULL,
+        title VARCHAR(2048),
+        feed_url VARCHAR(191) NOT NULL,
+        site_url VARCHAR(2048),
+        image_url VARCHAR(2048),
+        last_refresh_date INTEGER,
+        last_modified VARCHAR(100),
+        etag VARCHAR(2048),
+        PRIMARY KEY (id),
+        UNIQUE (feed_url)
+    )""",
+    """CREATE TABLE subscriptions (
+        username VARCHAR(100),
+        feed_id INTEGER,
+        FOREIGN KEY(username) REFERENCES users (username) ON DELETE CASCADE,
+        FOREIGN KEY(feed_id) REFERENCES feeds (id) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE entries (
+        id INTEGER NOT NULL,
+        feed_id INTEGER NOT NULL,
+        content TEXT,
+        url VARCHAR(2048),
+        title VARCHAR(2048),
+        author VARCHAR(100),
+        date INTEGER NOT NULL,
+        guid VARCHAR(100) NOT NULL,
+        PRIMARY KEY (id),
+        CONSTRAINT feed_guid UNIQUE (feed_id, guid),
+        FOREIGN KEY(feed_id) REFERENCES feeds (id) ON DELETE CASCADE
+    )""",
+    """CREATE TABLE read (
+        username VARCHAR(100),
+        entry_id INTEGER,
+        FOREIGN KEY(username) REFERENCES users (username) ON DELETE CASCADE,
+        FOREIGN KEY(entry_id) REFERENCES entries (id) ON DELETE CASCADE
+    )""",
+]
+
+
+@pytest.fixture
+def database_uri(request):
+    tmp_dir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(tmp_dir))
+    return "sqlite:///" + os.path.join(tmp_dir, "feeder.db")
+
+
+@pytest.fixture
+def baseline_engine(database_uri):
+    """Return engine for a database with the baseline schema and data."""
+    engine = create_engine(database_uri)
+    for statement in BASELINE_SCHEMA:
+        engine.execute(statement)
+    engine.execute("INSERT INTO users VALUES ('demo', 'hash')")
+    engine.execute("INSERT INTO feeds (id, feed_url, last_refresh_date) "
+                   "VALUES (1, 'http://example.com/feed', 0)")
+    engine.execute("INSERT INTO entries (id, feed_id, content, date, guid) "
+                   "VALUES (1, 1, 'content', 0, 'guid')")
+    # duplicate rows were possible without primary keys
+    for _ in range(2):
+        engine.execute("INSERT INTO subscriptions VALUES ('demo', 1)")
+        engine.execute("INSERT INTO read VALUES ('demo', 1)")
+    return engine
+
+
+def test_new_database_is_latest_version(database_uri):
+    database.initialize_db(database_uri)
+    conn = create_engine(database_uri).connect()
+    assert migrations.get_version(conn) == migrations.latest_version()
+
+
+def test_upgrade_baseline(baseline_engine, database_uri):
+    assert migrations.get_version(baseline_engine.connect()) == 0
+    Session = database.initialize_db(database_uri)
+    assert migrations.get_version(baseline_engine.connect()) == \
+        migrations.latest_version()
+
+    # data survives the upgrade
+    session = Session()
+    user = session.query(database.User).get('demo')
+    feed = session.query(database.Feed).get(1)
+    assert user.has_subscription(feed)
+    assert user.has_read(feed.entries[0])
+    session.close()
+
+
+def test_upgrade_adds_keys_and_indexes(baseline_engine, database_uri):
+    database.initialize_db(database_uri)
+    inspector = inspect(baseline_engine)
+
+    def primary_key(table):
+        return inspector.get_pk_constraint(table)['constrained_columns']
+    assert primary_key('subscriptions') == ['username', 'feed_id']
+    assert primary_key('read') == ['username', 'entry_id']
+    assert baseline_engine.execute(
+        "SELECT COUNT(*) FROM subscriptions").scalar() == 1
+    assert baseline_engine.execute("SELECT COUNT(*) FROM read").scalar() == 1
+
+    def index_names(table):
+        return set(index['name'] for index in inspector.get_indexes(table))
+    assert 'ix_subscriptions_feed_id' in index_names('subscriptions')
+    assert 'ix_read_entry_id' in index_names('read')
+    assert 'ix_entries_feed_id_date_id' in index_names('entries')
+    assert 'ix_feeds_last_refresh_date' in index_names('feeds')
+
+
+def test_upgrade_twice(baseline_engine, database_uri):
+    database.initialize_db(database_uri)
+    database.initialize_db(database_uri)
+    assert migrations.get_version(baseline_engine.connect()) == \
+        migrations.latest_version()
+
+
+def test_upgrade_counts_unread_entries(baseline_engine, database_uri):
+    baseline_engine.execute("INSERT INTO entries (id, feed_id, content, "
+                            "date, guid) VALUES (2, 1, 'content', 0, 'new')")
+    database.initialize_db(database_uri)
+    assert baseline_engine.execute(
+        "SELECT username, feed_id, unreads FROM unread_counts").fetchall() \
+        == [('demo', 1, 1)]
+
+
+def test_upgrade_moves_entry_content(baseline_engine, database_uri):
+    Session = database.initialize_db(database_uri)
+    columns = [column['name'] for column
+               in inspect(baseline_engine).get_columns('entries')]
+    assert 'content' not in columns
+
+    session = Session()
+    assert session.query(database.Entry).get(1).content == 'content'
+    session.close()
+
+
+def test_upgrade_adds_entry_content_hash(baseline_engine, database_uri):
+    Session = database.initialize_db(database_uri)
+    session = Session()
+    # existing entries get a hash the next time their feed updates
+    assert session.query(database.Entry).get(1).content_hash is None
+    session.close()
+
+
+def test_upgrade_adds_archived_entries(baseline_engine, database_uri):
+    database.initialize_db(database_uri)
+    assert 'archived_entries' in inspect(baseline_engine).get_table_names()
+
+
+def test_upgrade_fingerprints_guids(baseline_engine, database_uri):
+    Session = database.initialize_db(database_uri)
+    session = Session()
+    assert session.query(database.Entry).get(1).guid == fingerprint('guid')
+    session.close()
+    columns = dict((column['name'], column['type']) for column
+                   in inspect(baseline_engine).get_columns('entries'))
+    assert isinstance(columns['guid'], BigInteger)
+    assert 'guid_key' not in columns
+
+
+def test_upgrade_schedules_refreshes(baseline_engine, database_uri):
+    Session = database.initialize_db(database_uri)
+    session = Session()
+    feed = session.query(database.Feed).get(1)
+    assert feed.refresh_interval is None
+    assert feed.next_refresh_date == 60 * 60
+    session.close()
+    indexes = inspect(baseline_engine).get_indexes('feeds')
+    assert 'ix_feeds_next_refresh_date' in [index['name'] for index in indexes]
+
+
+def test_upgrade_adds_feed_body_digest(baseline_engine, database_uri):
+    Session = database.initialize_db(database_uri)
+    session = Session()
+    assert session.query(database.Feed).get(1).body_digest is None
+    session.close()
+
+
+def test_upgrade_adds_pruned_guids(baseline_engine, database_uri):
+    database.initialize_db(database_uri)
+    assert 'pruned_guids' in inspect(baseline_engine).get_table_names()
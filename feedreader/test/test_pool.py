@@ -0,0 +1,91 @@
+"""Tests for database connection pool helpers."""
+
+import pytest
+from sqlalchemy import exc
+
+from feedreader.config import ConnectionConfig
+from feedreader.pool import MeteredQueuePool, ping_on_checkout
+
+
+class FakeConnection(object):
+    """DB-API connection that can be made to fail like a dropped one."""
+
+    def __init__(self):
+        self.dropped = False
+        self.closed = False
+
+    def cursor(self):
+        if self.dropped:
+            raise IOError("server has gone away")
+        return FakeCursor()
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor(object):
+
+    def execute(self, statement):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_metered_pool_counts_checkouts():
+    pool = MeteredQueuePool(FakeConnection, pool_size=2, max_overflow=0)
+    first = pool.connect()
+    second = pool.connect()
+    stats = pool.stats()
+    assert stats["checkouts"] == 2
+    assert stats["checked_out"] == 2
+    assert stats["size"] == 2
+    assert stats["timeouts"] == 0
+
+    first.close()
+    second.close()
+    assert pool.stats()["checked_out"] == 0
+
+
+def test_metered_pool_counts_timeouts():
+    pool = MeteredQueuePool(FakeConnection, pool_size=1, max_overflow=0,
+                            timeout=0.01)
+    conn = pool.connect()
+    with pytest.raises(exc.TimeoutError):
+        pool.unique_connection()
+    stats = pool.stats()
+    assert stats["timeouts"] == 1
+    assert stats["checkouts"] == 1
+    conn.close()
+
+
+def test_metered_pool_keeps_counts_when_recreated():
+    pool = MeteredQueuePool(FakeConnection)
+    pool.connect().close()
+    assert pool.recreate().stats()["checkouts"] == 1
+
+
+def test_ping_on_checkout_replaces_dropped_connections():
+    connections = []
+
+    def connect():
+        connections.append(FakeConnection())
+        return connections[-1]
+    pool = MeteredQueuePool(connect)
+    ping_on_checkout(pool)
+
+    pool.connect().close()
+    assert len(connections) == 1
+    connections[0].dropped = True
+
+    pool.connect().close()
+    assert len(connections) == 2
+    assert connections[0].closed
+
+
+def test_unknown_pool_option():
+    with pytest.raises(ValueError):
+        ConnectionConfig('', 'sqlite://', pool={'sise': 5})
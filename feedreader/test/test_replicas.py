@@ -0,0 +1,66 @@
+"""Tests for ReplicaRouter."""
+
+from datetime import timedelta
+
+from feedreader.replicas import ReplicaRouter
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_round_robin():
+    router = ReplicaRouter(["a", "b"])
+    assert [router.choose()[1] for _ in range(3)] == ["a", "b", "a"]
+    assert router.stats()["replica_reads"] == 3
+
+
+def test_no_replicas():
+    router = ReplicaRouter([])
+    assert router.choose() is None
+    assert router.stats()["primary_reads"] == 1
+
+
+def test_failed_replica_is_skipped_until_retry():
+    clock = FakeClock()
+    router = ReplicaRouter(["a", "b"], retry_after=timedelta(seconds=30),
+                           clock=clock)
+    router.failed(0)
+    assert [router.choose()[1] for _ in range(2)] == ["b", "b"]
+    assert router.stats()["failed_replicas"] == 1
+
+    router.failed(1)
+    assert router.choose() is None
+
+    clock.now += 30
+    assert router.choose() is not None
+    assert router.stats()["failed_replicas"] == 0
+
+
+def test_writers_read_from_primary():
+    clock = FakeClock()
+    router = ReplicaRouter(["a"], sticky_for=timedelta(seconds=5),
+                           clock=clock)
+    router.wrote("demo")
+    assert router.choose("demo") is None
+    assert router.choose("other") is not None
+    assert router.choose() is not None
+
+    clock.now += 5
+    assert router.choose("demo") is not None
+
+
+def test_expired_writers_are_forgotten():
+    clock = FakeClock()
+    router = ReplicaRouter(["a"], sticky_for=timedelta(seconds=5),
+                           max_writers=2, clock=clock)
+    router.wrote("demo1")
+    router.wrote("demo2")
+    clock.now += 5
+    router.wrote("demo3")
+    assert len(router._writers) == 1
@@ -0,0 +1,230 @@
+"""Tests for removing old entries."""
+
+from datetime import timedelta
+
+import pytest
+from tornado.ioloop import IOLoop
+
+from feedreader import database
+from feedreader.async_database import AsyncDatabase
+from feedreader.fingerprint import fingerprint
+from feedreader.retention import (expiry_date, find_expired_entries,
+                                  prune_batch, Pruner, RetentionPolicy)
+from feedreader.updater import save_entries
+
+NOW = 1000000
+DAY = 24 * 60 * 60
+
+
+@pytest.fixture
+def session(request):
+    Session = database.initialize_db('sqlite://')
+    session = Session()
+    request.addfinalizer(session.close)
+    user = database.User("demo", "hash")
+    session.add(user)
+    for i in range(2):
+        feed = database.Feed("Feed", "http://example.com/{}".format(i), None)
+        # one entry a day, the newest is from now
+        feed.add_all(database.Entry(u"Content {}".format(j), None,
+                                    "Entry {}".format(j), None,
+                                    NOW - (4 - j) * DAY, "guid{}".format(j))
+                     for j in range(5))
+        session.add(feed)
+        session.commit()
+        user.subscribe(feed)
+    session.commit()
+    session.create_session = Session
+    return session
+
+
+def entry_titles(session, feed_id=1):
+    return [title for title, in session.query(database.Entry.title)
+                                       .filter_by(feed_id=feed_id)
+                                       .order_by(database.Entry.date)]
+
+
+def read_entry(session, guid, feed_id=1):
+    user = session.query(database.User).one()
+    entry = session.query(database.Entry)\
+                   .filter_by(feed_id=feed_id, guid=guid).one()
+    user.read(entry)
+    session.commit()
+
+
+def test_policy_from_config():
+    policy = RetentionPolicy.from_config({"max_age_days": 30,
+                                          "archive": True})
+    assert policy.enabled
+    assert policy.max_entries is None
+    assert policy.max_age == timedelta(days=30)
+    assert policy.keep_unread_for is None
+    assert policy.archive
+    assert not RetentionPolicy.from_config({}).enabled
+
+
+def test_find_expired_by_count(session):
+    policy = RetentionPolicy(max_entries=2)
+    ids = find_expired_entries(session, 1, policy, NOW, 10)
+    assert [session.query(database.Entry).get(id_).title for id_ in ids] == \
+        ["Entry 0", "Entry 1", "Entry 2"]
+    assert len(find_expired_entries(session, 1, policy, NOW, 2)) == 2
+    assert find_expired_entries(session, 1, RetentionPolicy(max_entries=5),
+                                NOW, 10) == []
+
+
+def test_find_expired_by_age(session):
+    policy = RetentionPolicy(max_age=timedelta(days=3))
+    assert len(find_expired_entries(session, 1, policy, NOW, 10)) == 1
+    assert find_expired_entries(session, 1, RetentionPolicy(), NOW, 10) == []
+
+
+def test_find_expired_keeps_recent_unread(session):
+    policy = RetentionPolicy(max_entries=1, keep_unread_for=timedelta(days=2))
+    # entries 0 and 1 are too old to keep, 2 and 3 are kept while unread
+    assert len(find_expired_entries(session, 1, policy, NOW, 10)) == 2
+    read_entry(session, "guid3")
+    assert len(find_expired_entries(session, 1, policy, NOW, 10)) == 3
+
+
+def test_prune_keeps_unread_counts(session):
+    read_entry(session, "guid0")
+    read_entry(session, "guid4")
+
+    removed, cursor = prune_batch(session, RetentionPolicy(max_entries=2),
+                                  NOW, 0, 100)
+    session.commit()
+
+    assert (removed, cursor) == (6, None)
+    assert entry_titles(session, 1) == ["Entry 3", "Entry 4"]
+    assert entry_titles(session, 2) == ["Entry 3", "Entry 4"]
+    user = session.query(database.User).one()
+    assert [unreads for _, unreads
+            in user.get_subscriptions_with_unreads()] == [1, 2]
+    assert database.rebuild_unread_counts(session) == 0
+    assert session.query(database.EntryContent).count() == 4
+    assert session.query(database.read_table).count() == 1
+    assert session.query(database.archived_entries_table).count() == 0
+
+
+def test_prune_in_batches(session):
+    policy = RetentionPolicy(max_entries=2)
+    removed, cursor = prune_batch(session, policy, NOW, 0, 2)
+    assert (removed, cursor) == (2, 0)
+    removed, cursor = prune_batch(session, policy, NOW, cursor, 2)
+    assert (removed, cursor) == (2, 1)
+    removed, cursor = prune_batch(session, policy, NOW, cursor, 2)
+    assert (removed, cursor) == (2, 1)
+    removed, cursor = prune_batch(session, policy, NOW, cursor, 2)
+    assert (removed, cursor) == (0, None)
+    assert entry_titles(session, 2) == ["Entry 3", "Entry 4"]
+
+
+def test_prune_archives(session):
+    policy = RetentionPolicy(max_entries=4, archive=True)
+    prune_batch(session, policy, NOW, 0, 100)
+    session.commit()
+
+    archived = database.archived_entries_table
+    rows = session.query(archived).order_by(archived.c.feed_id).all()
+    assert [(row.feed_id, row.guid, row.title, row.content,
+             row.archived_date) for row in rows] == [
+        (1, fingerprint("guid0"), "Entry 0", u"Content 0", NOW),
+        (2, fingerprint("guid0"), "Entry 0", u"Content 0", NOW),
+    ]
+
+
+def feed_document():
+    """Return the entries the feeds were created with, as fetched again."""
+    return [database.Entry(u"Content {}".format(j), None,
+                           "Entry {}".format(j), None, NOW - (4 - j) * DAY,
+                           "guid{}".format(j))
+            for j in reversed(range(5))]
+
+
+def test_pruned_entries_not_saved_again(session):
+    read_entry(session, "guid0")
+    prune_batch(session, RetentionPolicy(max_entries=3), NOW, 0, 100)
+    session.commit()
+
+    # the pruned entries are still in the feed, with a change that makes
+    # the update save it
+    entries = feed_document()
+    entries[0].title = "Entry 4, updated"
+    counts = save_entries(session, 1, entries)
+    session.commit()
+
+    assert counts == {"inserted": 0, "updated": 1, "unchanged": 2,
+                      "expired": 2}
+    assert entry_titles(session, 1) == ["Entry 2", "Entry 3",
+                                        "Entry 4, updated"]
+    assert database.rebuild_unread_counts(session) == 0
+    user = session.query(database.User).one()
+    assert user.get_subscriptions_with_unreads()[0][1] == 3
+
+
+def test_entries_too_old_not_saved(session):
+    policy = RetentionPolicy(max_age=timedelta(days=3))
+    entries = feed_document()
+    entries.append(database.Entry(u"Old", None, "Old", None,
+                                  NOW - 10 * DAY, "old"))
+    counts = save_entries(session, 1, entries, policy, NOW)
+    assert counts["expired"] == 1
+    assert session.query(database.Entry).filter_by(guid="old").count() == 0
+
+
+def test_prune_forgets_old_guids(session):
+    policy = RetentionPolicy(max_age=timedelta(days=3))
+    prune_batch(session, policy, NOW, 0, 100)
+    pruned = database.pruned_guids_table
+    assert session.query(pruned).count() == 2
+    # once they are old enough to be skipped for their date
+    prune_batch(session, policy, NOW + DAY, 0, 100)
+    assert [(row.feed_id, row.guid) for row in session.query(pruned)
+            .order_by(pruned.c.feed_id, pruned.c.guid)] == \
+        sorted([(1, fingerprint("guid1")), (2, fingerprint("guid1"))])
+
+
+def test_prune_forgets_guids_past_max_entries(session):
+    policy = RetentionPolicy(max_entries=3)
+    prune_batch(session, policy, NOW, 0, 100)
+    pruned = database.pruned_guids_table
+    assert session.query(pruned).count() == 4
+    # older than the oldest entry kept, so skipped for their date
+    prune_batch(session, policy, NOW, 0, 100)
+    assert session.query(pruned).count() == 0
+
+    counts = save_entries(session, 1, feed_document(), policy, NOW)
+    session.commit()
+    assert counts == {"inserted": 0, "updated": 0, "unchanged": 3,
+                      "expired": 2}
+    assert entry_titles(session, 1) == ["Entry 2", "Entry 3", "Entry 4"]
+
+
+def test_expiry_date(session):
+    assert expiry_date(session, 1, RetentionPolicy(), NOW) is None
+    assert expiry_date(session, 1, RetentionPolicy(max_entries=10),
+                       NOW) is None
+    assert expiry_date(session, 1, RetentionPolicy(max_entries=2),
+                       NOW) == NOW - DAY
+    # the later of the two limits
+    policy = RetentionPolicy(max_entries=2, max_age=timedelta(days=3))
+    assert expiry_date(session, 1, policy, NOW) == NOW - DAY
+    policy = RetentionPolicy(max_entries=4, max_age=timedelta(hours=36))
+    assert expiry_date(session, 1, policy, NOW) == NOW - 36 * 60 * 60
+    # new entries are unread, so they are kept for keep_unread_for
+    policy = RetentionPolicy(max_entries=2,
+                             keep_unread_for=timedelta(days=2))
+    assert expiry_date(session, 1, policy, NOW) == NOW - 2 * DAY
+
+
+def test_pruner(session):
+    db = AsyncDatabase(session.create_session)
+    pruner = Pruner(db, RetentionPolicy(max_entries=3), batch_size=3)
+
+    removed = IOLoop.instance().run_sync(pruner.run)
+
+    assert removed == 4
+    assert entry_titles(session, 1) == ["Entry 2", "Entry 3", "Entry 4"]
+    assert pruner.stats() == {"runs": 1, "removed": 4,
+                              "last_run_removed": 4}
@@ -0,0 +1,53 @@
+"""Tests for picking when feeds are refreshed."""
+
+from datetime import timedelta
+
+from feedreader.schedule import parse_hint, publish_interval, RefreshSchedule
+
+HOUR = 60 * 60
+
+
+def test_publish_interval():
+    assert publish_interval([]) is None
+    assert publish_interval([100]) is None
+    assert publish_interval([0, 100, 300, 400]) == 100
+    # only the newest entries count
+    assert publish_interval(range(0, 10000, 1000) + [20000, 30000]) == 1000
+
+
+def test_backoff_without_new_entries():
+    schedule = RefreshSchedule()
+    assert schedule.next_interval(None) == 1.5 * HOUR
+    assert schedule.next_interval(HOUR, [0, 60], new_entries=0) == 1.5 * HOUR
+    assert schedule.next_interval(HOUR, failed=True) == 2 * HOUR
+
+
+def test_new_entries_follow_publish_interval():
+    schedule = RefreshSchedule()
+    dates = [i * 2 * HOUR for i in range(5)]
+    assert schedule.next_interval(10 * HOUR, dates, new_entries=1) == HOUR
+    # a single entry doesn't tell how often the feed publishes
+    assert schedule.next_interval(3 * HOUR, [0], new_entries=1) == 2 * HOUR
+
+
+def test_bounds_and_hints():
+    schedule = RefreshSchedule(min_interval=timedelta(minutes=15),
+                               max_interval=timedelta(hours=24))
+    assert schedule.next_interval(HOUR, [0, 60], new_entries=1) == 15 * 60
+    assert schedule.next_interval(20 * HOUR) == 24 * HOUR
+    assert schedule.next_interval(HOUR, [0, 60], new_entries=1,
+                                  hint=3 * HOUR) == 3 * HOUR
+    # hints can't push refreshes past the maximum
+    assert schedule.next_interval(HOUR, hint=48 * HOUR) == 24 * HOUR
+
+
+def test_parse_hint():
+    assert parse_hint() is None
+    assert parse_hint(max_age=300) == 300
+    assert parse_hint(max_age=0, ttl="60") == HOUR
+    assert parse_hint(update_period=" Daily ", update_frequency="4") == \
+        6 * HOUR
+    assert parse_hint(update_period="hourly") == HOUR
+    assert parse_hint(ttl="soon", update_period="never") is None
+    # the longest wins
+    assert parse_hint(max_age=60, ttl="30", update_period="hourly") == HOUR
@@ -0,0 +1,365 @@
+"""Tests for saving updated feeds."""
+
+from concurrent.futures import Future
+from datetime import timedelta
+import time
+
+import pytest
+from tornado.ioloop import IOLoop
+import yaml
+
+from feedreader import database
+from feedreader.fingerprint import fingerprint
+from feedreader.schedule import RefreshSchedule
+from feedreader import updater
+from feedreader.updater import save_entries, Updater
+
+
+def make_entry(guid, title="Title", content=u"<p>Content</p>", date=0):
+    return database.Entry(content, "http://example.com/entry", title,
+                          "Author", date, guid)
+
+
+@pytest.fixture
+def session(request):
+    Session = database.initialize_db('sqlite://')
+    session = Session()
+    request.addfinalizer(session.close)
+    user = database.User("demo", "hash")
+    feed = database.Feed("Feed", "http://example.com/feed.xml", None)
+    session.add_all([user, feed])
+    session.commit()
+    user.subscribe(feed)
+    session.commit()
+    session.create_session = Session
+    return session
+
+
+def get_feed(session):
+    return session.query(database.Feed).one()
+
+
+def get_unreads(session):
+    user = session.query(database.User).one()
+    return user.get_subscriptions_with_unreads()[0][1]
+
+
+def test_save_new_entries(session):
+    feed_id = get_feed(session).id
+    counts = save_entries(session, feed_id,
+                          [make_entry("a"), make_entry("b", date=1)])
+    session.commit()
+
+    assert counts == {"inserted": 2, "updated": 0, "unchanged": 0,
+                      "expired": 0}
+    entries = session.query(database.Entry)\
+                     .order_by(database.Entry.guid).all()
+    assert [entry.guid for entry in entries] == [fingerprint("a"),
+                                                 fingerprint("b")]
+    assert all(entry.feed_id == feed_id for entry in entries)
+    assert [entry.content for entry in entries] == [u"<p>Content</p>"] * 2
+    assert entries[0].content_hash == make_entry("a").compute_hash()
+    assert get_unreads(session) == 2
+
+
+def test_save_unchanged_and_changed_entries(session):
+    feed_id = get_feed(session).id
+    save_entries(session, feed_id, [make_entry("a"), make_entry("b")])
+    session.commit()
+
+    counts = save_entries(session, feed_id, [
+        make_entry("a"),
+        make_entry("b", title="New title", content=u"<p>New</p>"),
+        make_entry("c"),
+    ])
+    session.commit()
+
+    assert counts == {"inserted": 1, "updated": 1, "unchanged": 1,
+                      "expired": 0}
+    entry = session.query(database.Entry).filter_by(guid="b").one()
+    assert entry.title == "New title"
+    assert entry.content == u"<p>New</p>"
+    assert entry.content_hash == entry.compute_hash()
+    assert session.query(database.Entry).count() == 3
+    # updated entries aren't unread again
+    assert get_unreads(session) == 3
+
+
+def test_save_entries_without_hash(session):
+    # entries stored before content_hash existed are rewritten once
+    feed_id = get_feed(session).id
+    save_entries(session, feed_id, [make_entry("a")])
+    session.execute(database.Entry.__table__.update()
+                    .values(content_hash=None))
+    session.commit()
+
+    counts = save_entries(session, feed_id, [make_entry("a")])
+    assert counts == {"inserted": 0, "updated": 1, "unchanged": 0,
+                      "expired": 0}
+    counts = save_entries(session, feed_id, [make_entry("a")])
+    assert counts == {"inserted": 0, "updated": 0, "unchanged": 1,
+                      "expired": 0}
+
+
+def test_save_entries_duplicate_guids(session):
+    # the first entry with a guid is assumed to be the newest
+    feed_id = get_feed(session).id
+    counts = save_entries(session, feed_id, [make_entry("a", title="New"),
+                                             make_entry("a", title="Old")])
+    session.commit()
+
+    assert counts == {"inserted": 1, "updated": 0, "unchanged": 0,
+                      "expired": 0}
+    assert session.query(database.Entry.title).scalar() == "New"
+
+
+def test_save_entries_in_batches(session, monkeypatch):
+    # stored entries are looked up a few guids at a time
+    monkeypatch.setattr(updater, "GUID_BATCH", 2)
+    feed_id = get_feed(session).id
+    save_entries(session, feed_id, [make_entry(guid) for guid in "abc"])
+    session.commit()
+
+    counts = save_entries(session, feed_id, [
+        make_entry("a"), make_entry("b", title="New title"), make_entry("c"),
+        make_entry("d"), make_entry("e"),
+    ])
+    assert counts == {"inserted": 2, "updated": 1, "unchanged": 2,
+                      "expired": 0}
+
+
+def test_hash_changes_with_each_field():
+    hashes = set([
+        make_entry("a").compute_hash(),
+        make_entry("a", title="Other").compute_hash(),
+        make_entry("a", content=u"Other").compute_hash(),
+        make_entry("a", content=None).compute_hash(),
+        make_entry("a", date=1).compute_hash(),
+    ])
+    assert len(hashes) == 5
+    # the guid isn't part of the hash
+    assert make_entry("a").compute_hash() == make_entry("b").compute_hash()
+
+
+def test_update_saves_results(session, io_loop):
+    feed = get_feed(session)
+    poller = FakePoller()
+    updater = Updater(RefreshSchedule(), session.create_session,
+                      FakeTasks(), poller, io_loop=io_loop)
+
+    for _ in range(2):
+        updater.force_update(session, feed)
+        poller.finish([{
+            "feed": database.Feed("Feed", feed.feed_url, None, id=feed.id),
+            "entries": [make_entry("a")],
+        }])
+        run_callbacks(io_loop)
+
+    assert updater.stats() == {"inserted": 1, "updated": 0, "unchanged": 1,
+                               "expired": 0, "deferred": 0, "in_flight": 0}
+    assert session.query(database.Entry.guid).scalar() == fingerprint("a")
+    # new entries, then nothing new
+    session.expire_all()
+    assert get_feed(session).refresh_interval == int(60 * 60 / 1.5 * 1.5)
+
+
+def test_update_reschedules(session, io_loop):
+    feed = get_feed(session)
+    poller = FakePoller()
+    schedule = RefreshSchedule(min_interval=timedelta(minutes=1))
+    updater = Updater(schedule, session.create_session, FakeTasks(), poller,
+                      io_loop=io_loop)
+
+    def refresh(result):
+        updater.force_update(session, feed)
+        poller.finish([result])
+        run_callbacks(io_loop)
+        session.expire_all()
+        assert feed.next_refresh_date - int(time.time()) in \
+            (feed.refresh_interval - 1, feed.refresh_interval)
+        return feed.refresh_interval
+
+    # entries published every ten minutes
+    assert refresh({
+        "feed": database.Feed("Feed", feed.feed_url, None, id=feed.id),
+        "entries": [make_entry(str(i), date=i * 600) for i in range(5)],
+    }) == 300
+    assert refresh({"feed": None, "entries": []}) == 450
+    assert refresh({"error": "Timed out"}) == 900
+    # not modified, but asked not to come back for two hours
+    assert refresh({"feed": None, "entries": [],
+                    "refresh_hint": 2 * 60 * 60}) == 2 * 60 * 60
+
+
+def test_update_remembers_feed_body(session, io_loop):
+    feed = get_feed(session)
+    poller = FakePoller()
+    updater = Updater(RefreshSchedule(), session.create_session,
+                      FakeTasks(), poller, io_loop=io_loop)
+
+    updater.force_update(session, feed)
+    poller.finish([{
+        "feed": database.Feed("Feed", feed.feed_url, None, etag="v1",
+                              body_digest="abc", id=feed.id),
+        "entries": [],
+    }])
+    run_callbacks(io_loop)
+    session.expire_all()
+    assert (feed.etag, feed.body_digest) == ("v1", "abc")
+
+    # the next fetch can tell if the feed changed
+    updater.force_update(session, feed)
+    assert poller.fetches[-1] == feed.feed_url
+    poller.finish([{"feed": None, "entries": [], "body_unchanged": True}])
+    run_callbacks(io_loop)
+    updater.force_update(session, feed)
+    poller.finish()
+    run_callbacks(io_loop)
+
+    assert updater.stats() == {"inserted": 0, "updated": 0, "unchanged": 0,
+                               "expired": 0, "body_unchanged": 1,
+                               "not_modified": 1, "deferred": 0,
+                               "in_flight": 0}
+
+
+def test_update_deferred(session, io_loop):
+    feed = get_feed(session)
+    session.query(database.Feed).update({"refresh_interval": 600})
+    session.commit()
+    poller = FakePoller()
+    updater = Updater(RefreshSchedule(), session.create_session,
+                      FakeTasks(), poller, io_loop=io_loop)
+
+    updater.force_update(session, feed)
+    poller.finish([{"deferred": True}])
+    run_callbacks(io_loop)
+
+    # due again straight away, without backing off
+    session.expire_all()
+    assert feed.refresh_interval == 600
+    assert feed.next_refresh_date <= int(time.time())
+    assert updater.stats() == {"deferred": 1, "in_flight": 0}
+
+
+def test_update_with_errors(session, io_loop):
+    poller = FakePoller()
+    updater = Updater(RefreshSchedule(), session.create_session,
+                      FakeTasks(), poller, io_loop=io_loop)
+
+    updater.force_update(session, get_feed(session))
+    poller.finish([{"error": "Failed to download or parse feed"}])
+    run_callbacks(io_loop)
+
+    assert updater.stats() == {"deferred": 0, "in_flight": 0}
+
+
+class FakeTasks(object):
+
+    def fetch_feeds(self, feeds):
+        pass
+
+
+class FakePoller(object):
+    """Records fetches and leaves them pending until finish is called."""
+
+    def __init__(self):
+        self.fetches = []
+        self.futures = []
+
+    def run_task(self, task, feeds):
+        future = Future()
+        self.fetches.extend(feed["feed_url"] for feed in feeds)
+        self.futures.append((future, len(feeds)))
+        return future
+
+    def finish(self, results=None):
+        """Finish pending fetches with results, or as not modified."""
+        for future, count in self.futures:
+            if not future.done():
+                not_modified = [{"feed": None, "entries": []}] * count
+                future.set_result(yaml.safe_dump({
+                    "results": results or not_modified,
+                }))
+
+
+@pytest.fixture
+def io_loop(request):
+    io_loop = IOLoop()
+    request.addfinalizer(lambda: io_loop.close(all_fds=True))
+    return io_loop
+
+
+def add_stale_feeds(session, count):
+    session.query(database.Feed).update({"next_refresh_date": 0})
+    session.add_all(database.Feed("Feed", "http://example.com/{}".format(i),
+                                  None, next_refresh_date=i + 1)
+                    for i in range(count - 1))
+    session.commit()
+
+
+def run_callbacks(io_loop):
+    """Run the loop long enough for callbacks that add callbacks."""
+    io_loop.add_timeout(timedelta(seconds=0.01), io_loop.stop)
+    io_loop.start()
+
+
+def test_claim_stale(session):
+    add_stale_feeds(session, 4)
+    session.query(database.Feed).filter_by(id=2)\
+        .update({"refresh_interval": 60})
+    session.commit()
+
+    feeds = database.Feed.claim_stale(session, 2, 10)
+    session.commit()
+
+    # most overdue first, and only feeds that are due
+    assert [feed.feed_url for feed in feeds] == [
+        "http://example.com/feed.xml", "http://example.com/0",
+        "http://example.com/1",
+    ]
+    assert [feed.last_refresh_date for feed in feeds] == [2, 2, 2]
+    # due again after their interval, unless they are rescheduled
+    assert [feed.next_refresh_date for feed in feeds] == [3602, 62, 3602]
+    assert database.Feed.claim_stale(session, 2, 10) == []
+
+
+def test_do_updates_in_batches(session, io_loop):
+    add_stale_feeds(session, 5)
+    poller = FakePoller()
+    updater = Updater(RefreshSchedule(), session.create_session,
+                      FakeTasks(), poller, batch_size=2, max_in_flight=10,
+                      io_loop=io_loop)
+
+    updater.do_updates()
+    assert len(poller.fetches) == 2
+    # the rest are claimed on later iterations of the loop
+    run_callbacks(io_loop)
+    assert len(poller.fetches) == 5
+    assert len(set(poller.fetches)) == 5
+    assert updater.stats()["in_flight"] == 5
+
+    poller.finish()
+    run_callbacks(io_loop)
+    assert updater.stats()["in_flight"] == 0
+
+
+def test_do_updates_limits_fetches_in_flight(session, io_loop):
+    add_stale_feeds(session, 5)
+    poller = FakePoller()
+    updater = Updater(RefreshSchedule(), session.create_session,
+                      FakeTasks(), poller, batch_size=2, max_in_flight=3,
+                      io_loop=io_loop)
+
+    updater.do_updates()
+    run_callbacks(io_loop)
+    assert len(poller.fetches) == 3
+
+    # nothing more is claimed until fetches finish
+    updater.do_updates()
+    assert len(poller.fetches) == 3
+
+    poller.finish()
+    run_callbacks(io_loop)
+    updater.do_updates()
+    run_callbacks(io_loop)
+    assert len(poller.fetches) == 5
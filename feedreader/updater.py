@@ -1,103 +1,343 @@
+from collections import defaultdict, OrderedDict
 import logging
 import time
 import yaml
 
+from sqlalchemy import bindparam
 from tornado import ioloop
 
-from feedreader import database
+from feedreader import database, retention
+from feedreader.schedule import RefreshSchedule
 
 logger = logging.getLogger(__name__)
 
+# most guids looked up in one IN clause
+GUID_BATCH = 500
+
+
+def _fetch_args(feed):
+    """Return the arguments fetch_feeds needs to update feed."""
+    return {
+        "feed_id": feed.id,
+        "feed_url": feed.feed_url,
+        "etag": feed.etag,
+        "last_modified": feed.last_modified,
+        "body_digest": feed.body_digest,
+    }
+
 
 class Updater(object):
 
-    def __init__(self, update_period, create_session_f, tasks, celery_poller):
+    def __init__(self, schedule, create_session_f, tasks, celery_poller,
+                 batch_size=100, max_in_flight=50, retention=None,
+                 io_loop=None):
         """Instantiate Updater.
 
-        update_period is a timedelta specifing when a feed is stale.
+        schedule is the RefreshSchedule that decides when each feed is
+        stale again after it is refreshed. None uses the default one.
+
+        Stale feeds are claimed batch_size at a time, and no more are
+        claimed while max_in_flight fetches are waiting for results.
+
+        If a RetentionPolicy is given as retention, entries it would remove
+        aren't saved.
         """
-        self._update_period = update_period
+        self._schedule = schedule or RefreshSchedule()
         self._create_session_f = create_session_f
         self._tasks = tasks
         self._celery_poller = celery_poller
+        self._batch_size = batch_size
+        self._max_in_flight = max_in_flight
+        self._retention = retention
+        self._io_loop = io_loop or ioloop.IOLoop.instance()
+        self._in_flight = 0
+
+        # inserted, updated, unchanged and expired entries since starting
+        self.entry_counts = defaultdict(int)
+        # fetches that found the feed not modified, by the server's say so
+        # or because it was the same as last time
+        self.unmodified_counts = defaultdict(int)
+        # fetches put off because they didn't start before their batch's
+        # deadline
+        self.deferred = 0
 
     def do_updates(self):
-        """Collect stale feeds and force_update them."""
-        logger.debug("Collecting stale feeds...")
+        """Claim a batch of stale feeds and start fetching them.
 
-        session = self._create_session_f()
+        If there are more stale feeds and room for more fetches, another
+        batch is claimed on the next IOLoop iteration so other callbacks
+        can run in between.
+        """
+        limit = min(self._batch_size, self._max_in_flight - self._in_flight)
+        if limit <= 0:
+            logger.debug("{} feed fetches in progress, not claiming more"
+                         .format(self._in_flight))
+            return
 
-        stale_date = int(time.time()) - self._update_period.total_seconds()
-        stale_feeds = database.Feed.find_last_updated_before(session,
-                                                             stale_date)
-        logger.debug("Found stale feeds: {}".format(stale_feeds))
+        now = int(time.time())
+        session = self._create_session_f()
+        try:
+            stale_feeds = database.Feed.claim_stale(session, now, limit)
+            # read everything needed before committing expires the feeds
+            fetches = [_fetch_args(feed) for feed in stale_feeds]
+            # mark the feeds as updated now, so if something goes wrong we
+            # don't try again immediately
+            session.commit()
+        finally:
+            session.close()
+        logger.debug("Claimed {} stale feeds".format(len(fetches)))
 
-        for feed in stale_feeds:
-            self.force_update(session, feed)
+        if fetches:
+            self._fetch(fetches)
 
-        session.close()
+        if len(fetches) == limit and self._in_flight < self._max_in_flight:
+            self._io_loop.add_callback(self.do_updates)
 
     def force_update(self, session, feed):
         """Update a feed regardless of how stale it is."""
-        logger.info("Starting update of stale feed {}".format(feed.id))
-
-        # set the feed to have been updated now
-        # do this now so if something goes wrong we don't try again immediately
         feed.last_refresh_date = int(time.time())
+        fetch = _fetch_args(feed)
         session.commit()
+        self._fetch([fetch])
+
+    def stats(self):
+        """Return a dict of entry, unmodified and deferred feed counts from
+           all updates so far and the number of fetches in progress."""
+        stats = dict(self.entry_counts)
+        stats.update(self.unmodified_counts)
+        stats["deferred"] = self.deferred
+        stats["in_flight"] = self._in_flight
+        return stats
+
+    def _fetch(self, fetches):
+        logger.info("Starting update of stale feeds {}"
+                    .format([fetch["feed_id"] for fetch in fetches]))
 
-        # Fetch feed without url or image discover, using any etag or
-        # last-modified headers.
-        future = self._celery_poller.run_task(
-            self._tasks.fetch_feed, feed.feed_url, feed_id=feed.id,
-            etag=feed.etag, last_modified=feed.last_modified,
-            find_image_url=False, use_discovery=False
+        # The batch is fetched concurrently by one worker, without url or
+        # image discovery, using any etag or last-modified headers.
+        future = self._celery_poller.run_task(self._tasks.fetch_feeds,
+                                              fetches)
+        self._in_flight += len(fetches)
+        self._io_loop.add_future(
+            future, lambda future: self._fetch_done(future, fetches)
         )
-        ioloop.IOLoop.instance().add_future(future, self._post_feed_update)
 
-    def _post_feed_update(self, future):
-        """Given result from fetch_feed task, update the feed in the DB."""
-        res = yaml.safe_load(future.result())
+    def _fetch_done(self, future, fetches):
+        self._in_flight -= len(fetches)
+        results = yaml.safe_load(future.result())["results"]
+        # results are in the same order as the fetches
+        for fetch, res in zip(fetches, results):
+            # one bad feed shouldn't stop the rest of the batch
+            try:
+                self._save_update(fetch["feed_id"], res)
+            except Exception:
+                logger.exception("Failed to save update of stale feed {}"
+                                 .format(fetch["feed_id"]))
 
-        if "error" in res:
-            logger.warning("Failed to update stale feed: '{}'"
-                           .format(res["error"]))
+    def _save_update(self, feed_id, res):
+        """Given a result from the fetch tasks, update the feed in the DB and
+           schedule its next refresh."""
+        if res.get("deferred"):
+            self._defer(feed_id)
             return
 
-        feed = res["feed"]
-        entries = res["entries"]
+        counts = None
+        session = self._create_session_f()
+        try:
+            if "error" in res:
+                logger.warning("Failed to update stale feed {}: '{}'"
+                               .format(feed_id, res["error"]))
+            elif res["feed"] is None:
+                if res.get("body_unchanged"):
+                    reason = "body_unchanged"
+                else:
+                    reason = "not_modified"
+                logger.info("Stale feed {} has not been modified ({})"
+                            .format(feed_id, reason))
+                self.unmodified_counts[reason] += 1
+            else:
+                logger.info("Got result for stale feed {}".format(feed_id))
+                counts = save_entries(session, feed_id, res["entries"],
+                                      self._retention, int(time.time()))
 
-        if feed is None:
-            logger.info("Stale feed has not been modified")
+            feed = session.query(database.Feed).get(feed_id)
+            if res.get("feed") is not None:
+                # remember what was fetched, so an unchanged feed isn't
+                # downloaded or parsed again
+                feed.etag = res["feed"].etag
+                feed.last_modified = res["feed"].last_modified
+                feed.body_digest = res["feed"].body_digest
+            interval = self._reschedule(feed, res, counts)
+            session.commit()
+        finally:
+            session.close()
+
+        logger.info("Refreshing feed {} again in {}s".format(feed_id,
+                                                              interval))
+        if counts is None:
             return
-        else:
-            logger.info("Got result for stale feed {}".format(feed.id))
+        logger.info("Updated stale feed {}: {inserted} inserted, {updated} "
+                    "updated, {unchanged} unchanged, {expired} expired"
+                    .format(feed_id, **counts))
+        for name, count in counts.iteritems():
+            self.entry_counts[name] += count
 
+    def _defer(self, feed_id):
+        """Make a feed that wasn't fetched before its batch's deadline due
+           again, without changing its interval."""
+        logger.info("Update of stale feed {} put off, its fetch didn't "
+                    "start in time".format(feed_id))
+        self.deferred += 1
         session = self._create_session_f()
+        try:
+            session.execute(
+                database.Feed.__table__.update()
+                    .where(database.Feed.id == feed_id)
+                    .values(next_refresh_date=int(time.time()))
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    def _reschedule(self, feed, res, counts):
+        """Set when a feed is next refreshed from the result of refreshing
+           it and return the interval."""
+        interval = self._schedule.next_interval(
+            feed.refresh_interval,
+            entry_dates=[entry.date for entry in res.get("entries", [])],
+            new_entries=counts["inserted"] if counts else 0,
+            hint=res.get("refresh_hint"),
+            failed="error" in res,
+        )
+        feed.refresh_interval = interval
+        feed.next_refresh_date = int(time.time()) + interval
+        return interval
+
 
-        # only add the first entry with a given guid
-        # this assumes the first one is the newest
-        entries_by_guid = {}
-        for entry in entries:
-            if entry.guid not in entries_by_guid:
-                entries_by_guid[entry.guid] = entry
-
-        for entry in entries_by_guid.values():
-            # if guid is unique for this feed's entries, this is a new entry
-            existing_entry = session.query(database.Entry)\
-                                    .filter(database.Entry.feed_id == feed.id)\
-                                    .filter(database.Entry.guid == entry.guid)\
-                                    .all()
-            if len(existing_entry) == 0:
-                logger.info("Adding new entry for stale feed {}"
-                            .format(feed.id))
+def save_entries(session, feed_id, entries, policy=None, now=None):
+    """Insert a feed's new entries and update the ones that changed.
+
+    entries are Entry instances that aren't in a session. Only the first
+    entry with a given guid is used, this assumes the first one is the
+    newest. Entries whose content_hash matches the stored one are skipped.
+
+    New entries that the retention policy has removed before, or that are
+    too old for it at the unix date now, aren't inserted.
+
+    Returns a dict with the number of entries inserted, updated, left
+    unchanged and not inserted because they expired.
+    """
+    entries_by_guid = OrderedDict()
+    for entry in entries:
+        if entry.guid not in entries_by_guid:
+            entry.content_hash = entry.compute_hash()
+            entries_by_guid[entry.guid] = entry
+
+    # guid -> (id, content_hash) of the entries already stored for the feed
+    existing = {}
+    for guids in _batches(entries_by_guid.keys(), GUID_BATCH):
+        existing.update(
+            (guid, (id_, content_hash)) for guid, id_, content_hash
+            in session.query(database.Entry.guid, database.Entry.id,
+                             database.Entry.content_hash)
+                      .filter(database.Entry.feed_id == feed_id)
+                      .filter(database.Entry.guid.in_(guids))
+        )
+
+    pruned = database.pruned_guids_table
+    pruned_guids = set()
+    for guids in _batches(entries_by_guid.keys(), GUID_BATCH):
+        pruned_guids.update(guid for guid, in
+                            session.query(pruned.c.guid)
+                                   .filter(pruned.c.feed_id == feed_id)
+                                   .filter(pruned.c.guid.in_(guids)))
+    min_date = None
+    if policy is not None:
+        min_date = retention.expiry_date(session, feed_id, policy, now)
+
+    new_entries = []
+    changed_entries = []
+    expired = 0
+    for guid, entry in entries_by_guid.iteritems():
+        if guid not in existing:
+            if guid in pruned_guids or \
+                    (min_date is not None and entry.date < min_date):
+                expired += 1
             else:
-                logger.info("Updating entry for stale feed {}".format(feed.id))
-                # modify the existing entry
-                entry.id = existing_entry[0].id
+                new_entries.append(entry)
+            continue
+        entry.id, content_hash = existing[guid]
+        if content_hash != entry.content_hash:
+            changed_entries.append(entry)
 
-            entry.feed_id = feed.id
-            session.merge(entry)
+    if new_entries:
+        _insert_entries(session, feed_id, new_entries)
+        # new entries are unread for everyone subscribed to the feed
+        database.add_unreads(session, feed_id, len(new_entries))
+    if changed_entries:
+        _update_entries(session, changed_entries)
 
-        session.commit()
-        session.close()
+    return {
+        "inserted": len(new_entries),
+        "updated": len(changed_entries),
+        "unchanged": len(entries_by_guid) - len(new_entries) -
+                     len(changed_entries) - expired,
+        "expired": expired,
+    }
+
+
+def _entry_row(entry, prefix=''):
+    return dict((prefix + name, getattr(entry, name)) for name in
+                ('url', 'title', 'author', 'date', 'content_hash'))
+
+
+def _batches(items, size):
+    """Yield lists of up to size items from the list items."""
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _insert_entries(session, feed_id, entries):
+    entries_table = database.Entry.__table__
+    contents_table = database.EntryContent.__table__
+
+    rows = []
+    for entry in entries:
+        row = _entry_row(entry)
+        row.update(feed_id=feed_id, guid=entry.guid)
+        rows.append(row)
+    session.execute(entries_table.insert(), rows)
+
+    # executemany doesn't return the new ids
+    guids = [entry.guid for entry in entries]
+    ids = dict(session.query(database.Entry.guid, database.Entry.id)
+                      .filter(database.Entry.feed_id == feed_id)
+                      .filter(database.Entry.guid.in_(guids)))
+    session.execute(contents_table.insert(), [
+        {"entry_id": ids[entry.guid], "content": entry.content}
+        for entry in entries
+    ])
+
+
+def _update_entries(session, entries):
+    entries_table = database.Entry.__table__
+    contents_table = database.EntryContent.__table__
+
+    # bind names can't be the same as column names, or they are set
+    values = dict((name, bindparam('new_' + name)) for name in
+                  ('url', 'title', 'author', 'date', 'content_hash'))
+    session.execute(
+        entries_table.update()
+                     .where(entries_table.c.id == bindparam('match_id'))
+                     .values(**values),
+        [dict(_entry_row(entry, 'new_'), match_id=entry.id)
+         for entry in entries]
+    )
+    session.execute(
+        contents_table.update()
+                      .where(contents_table.c.entry_id ==
+                             bindparam('match_id'))
+                      .values(content=bindparam('new_content')),
+        [{"match_id": entry.id, "new_content": entry.content}
+         for entry in entries]
+    )
@@ -114,7 +114,7 @@
    *
    * @factory
    * @var {Boolean} authenticated Is the visitor authenticated?
-   * @var {String} authorization The authorization token of the current user.
+   * @var {String} authorization The session token of the current user.
    * @var {Function} call Returns an authenticated `Restangular` instance.
    * @var {Function} getAuthHeader Creates the header needed to make API calls.
    * @var {Function} login Logs the current visitor in.
@@ -124,10 +124,13 @@
    */
   this.factory('User', function($q, Restangular, Cookie) {
     var endpoint = Restangular.one('users')
-      , authKey = 'auth'
+      , sessions = Restangular.all('sessions')
+      , tokenKey = 'token'
+      , expiresKey = 'expires'
       , usernameKey = 'username'
-      , authenticated = Cookie.has(authKey)
-      , authorization = Cookie.get(authKey)
+      , authenticated = Cookie.has(tokenKey) &&
+          Cookie.get(expiresKey) > moment().unix()
+      , authorization = Cookie.get(tokenKey)
       , username = Cookie.get(usernameKey);
 
     /**
@@ -153,55 +156,53 @@
      * Generates a header object that needs to be used by every other service to
      * make their API calls.
      *
-     * @param {String} [auth=this.authorization] The authorization token.
+     * @param {String} [token=this.authorization] The session token.
      * @returns {Object} Returns the header object.
      */
-    function getAuthHeader(auth) {
-      auth || (auth = this.authorization);
+    function getAuthHeader(token) {
+      token || (token = this.authorization);
 
       return {
-        Authorization: 'xBasic ' + auth
+        Authorization: 'Bearer ' + token
       };
     }
 
     /**
-     * Logs in a visitor by checking the server to see if the he or she exists
-     * and if the username and password pair matches.
+     * Logs in a visitor by exchanging his or her username and password for a
+     * session token, which is used for all other API calls.
      *
      * @param {String} username The username of the visitor.
      * @param {String} password The password of the visitor.
      * @returns {Promise} Returns the promise of the login API hit.
      */
     function login(username, password) {
-      var auth = btoa(username + ':' + password)
-        , header = getAuthHeader(auth);
+      var header = {
+        Authorization: 'xBasic ' + btoa(username + ':' + password)
+      };
 
-      return endpoint.get({}, header).then(_.bind(function() {
+      return sessions.post({}, {}, header).then(_.bind(function(result) {
         this.authenticated = true;
-        this.authorization = auth;
+        this.authorization = result.token;
         this.username = username;
-        Cookie.set(authKey, auth).set(usernameKey, username);
+        Cookie.set(tokenKey, result.token)
+          .set(expiresKey, result.expires)
+          .set(usernameKey, username);
       }, this), $q.reject);
     }
 
     /**
-     * Registers a new user.
+     * Registers a new user and logs him or her in.
      *
      * @param {String} username The username of the new user.
      * @param {String} password The password of the new user.
      * @returns {Promise} Returns the promise of the registration API hit.
      */
     function register(username, password) {
-      var auth = btoa(username + ':' + password);
-
       return endpoint.all('').post({
         username: username,
         password: password
       }).then(_.bind(function() {
-        this.authenticated = true;
-        this.authorization = auth;
-        this.username = username;
-        Cookie.set(authKey, auth).set(usernameKey, username);
+        return this.login(username, password);
       }, this), $q.reject);
     }
 
@@ -211,7 +212,7 @@
     function logout() {
       this.authenticated = false;
       this.username = '';
-      Cookie.remove(authKey).remove(usernameKey);
+      Cookie.remove(tokenKey).remove(expiresKey).remove(usernameKey);
     }
 
     return {
@@ -410,25 +411,42 @@
      * Fetches all the articles belonging to a feed identified by `id`. These
      * articles will not have their full content. Instead, a truncated version
      * will be requested for the purposes of a short preview in the article
-     * list view.
+     * list view. The API returns a feed's entries a page at a time, so pages
+     * are fetched until there are no more.
      *
      * @param {Number} id The id of the feed.
      * @returns {Promise} Returns the promise of the fetch articles API hit.
      */
     function update(id) {
-      return endpoint.one(id).getList('entries').then(_.bind(function(result) {
-        if (!result.entries.length) {
-          this.id = id;
-          this.list = [];
-          return;
-        }
+      var articles = [];
+
+      function fetchPage(params) {
+        var entries = endpoint.one(id).getList('entries', params);
+
+        return entries.then(function(result) {
+          if (!result.entries.length) {
+            return articles;
+          }
+
+          return Article.get(result.entries, {
+            truncate: 300
+          }).then(function(page) {
+            articles = articles.concat(page.entries);
+
+            if (!result.next) {
+              return articles;
+            }
+
+            return fetchPage({
+              before: result.next
+            });
+          }, $q.reject);
+        }, $q.reject);
+      }
 
-        return Article.get(result.entries, {
-          truncate: 300
-        }).then(_.bind(function(result) {
-          this.id = id;
-          this.list = result.entries;
-        }, this), $q.reject);
+      return fetchPage({}).then(_.bind(function(articles) {
+        this.id = id;
+        this.list = articles;
       }, this), $q.reject);
     }
 